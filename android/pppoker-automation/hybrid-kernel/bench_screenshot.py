@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Screenshot pipeline benchmark for the Hybrid Kernel.
+
+Captures the connected device's screen with each configuration of capture_screen() and reports
+the time to pull the frame, the time to downscale and encode it, the payload sent to the vision
+model, the estimated upload time and the estimated image tokens, so you can pick the
+SCREENSHOT_* settings for your device and link.
+
+No OpenAI calls are made.
+
+Usage:
+    python bench_screenshot.py [--runs 5] [--uplink-mbps 10] [--config raw:1280:jpeg:80 ...]
+"""
+
+import argparse
+import math
+import os
+import statistics
+
+# The kernel creates its OpenAI client on import; the benchmark never calls it
+os.environ.setdefault("OPENAI_API_KEY", "unused")
+
+import hybrid_kernel
+
+DEFAULT_CONFIGS = [
+    "png:0:png",  # The original pipeline: device PNG at full resolution
+    "raw:0:jpeg:80",
+    "raw:1280:jpeg:80",
+    "raw:1024:jpeg:70",
+    "raw:1280:webp:80",
+    "png:1280:jpeg:80",
+]
+
+def parse_config(value: str) -> tuple[str, int, str, int]:
+    """Parse SOURCE:LONG_EDGE:FORMAT[:QUALITY], e.g. raw:1280:jpeg:80."""
+    parts = value.split(":")
+    if len(parts) not in (3, 4) or parts[0] not in ("raw", "png") or parts[2] not in ("jpeg", "webp", "png"):
+        raise argparse.ArgumentTypeError(f"expected SOURCE:LONG_EDGE:FORMAT[:QUALITY], got '{value}'")
+    quality = int(parts[3]) if len(parts) == 4 else hybrid_kernel.SCREENSHOT_QUALITY
+    return parts[0], int(parts[1]), parts[2], quality
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Estimate GPT-4o image tokens at high detail: 85 plus 170 per 512px tile after OpenAI's own resizing."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare screenshot capture-to-upload time per configuration")
+    parser.add_argument("--runs", "-r", type=int, default=5, help="Captures per configuration (default: 5)")
+    parser.add_argument("--uplink-mbps", type=float, default=10.0,
+                        help="Upload bandwidth used to estimate the upload time (default: 10)")
+    parser.add_argument("--config", "-c", type=parse_config, action="append",
+                        help="SOURCE:LONG_EDGE:FORMAT[:QUALITY], e.g. raw:1280:jpeg:80; repeatable")
+    args = parser.parse_args()
+
+    configs = args.config or [parse_config(value) for value in DEFAULT_CONFIGS]
+    if hybrid_kernel.Image is None:
+        print("⚠️ Pillow is not installed: every configuration falls back to the device PNG")
+
+    print(f"{'Config':<20} {'Size':>10} {'Capture ms':>11} {'Encode ms':>10} {'Payload KB':>11} "
+          f"{'Upload ms':>10} {'Total ms':>9} {'~Tokens':>8}")
+    for source, long_edge, image_format, quality in configs:
+        shots = []
+        for _ in range(args.runs):
+            shot = hybrid_kernel.capture_screen(source, long_edge, image_format, quality)
+            if shot is None:
+                break
+            shots.append(shot)
+        name = f"{source}:{long_edge}:{image_format}" + (f":{quality}" if image_format != "png" else "")
+        if not shots:
+            print(f"{name:<20} ❌ capture failed")
+            continue
+
+        capture = statistics.median(shot.capture_time for shot in shots) * 1000
+        encode = statistics.median(shot.encode_time for shot in shots) * 1000
+        # The image travels base64-encoded inside the JSON request
+        payload = statistics.median(len(shot.base64()) for shot in shots)
+        upload = payload * 8 / (args.uplink_mbps * 1e6) * 1000
+        width, height = shots[0].size
+        print(f"{name:<20} {f'{width}x{height}':>10} {capture:>11.0f} {encode:>10.0f} {payload / 1024:>11.0f} "
+              f"{upload:>10.0f} {capture + encode + upload:>9.0f} {estimate_image_tokens(width, height):>8}")
+
+    print(f"\nMedians of {args.runs} captures. Upload time assumes {args.uplink_mbps:g} Mbps.")
+
+if __name__ == "__main__":
+    main()
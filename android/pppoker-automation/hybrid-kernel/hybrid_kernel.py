@@ -15,15 +15,51 @@ import subprocess
 import json
 import base64
 import argparse
+import atexit
+import hashlib
+import io
+import re
+import select
+import struct
+import threading
+from collections import OrderedDict
 from typing import Dict, Any, List, Optional
 from openai import OpenAI
 
+try:
+    from PIL import Image, ImageChops
+except ImportError:  # Without Pillow, screenshots are sent as full-size device PNGs
+    Image = ImageChops = None
+
 # --- CONFIGURATION ---
 ADB_PATH = "adb"
 MODEL_TEXT = "gpt-4o"  # For uiautomator (text only, cheaper)
 MODEL_VISION = "gpt-4o"  # For screenshot (vision, more expensive)
 SCREEN_DUMP_PATH = "/sdcard/window_dump.xml"
-LOCAL_DUMP_PATH = "/tmp/window_dump.xml"
+ADB_PERSISTENT_SHELL = True  # Reuse one `adb shell` session instead of forking adb per action
+SCREENSHOT_SOURCE = "raw"  # "raw" framebuffer (no PNG encoding on the device) or "png" (screencap -p)
+SCREENSHOT_LONG_EDGE = 1280  # Downscale screenshots to this long edge (0 = device resolution)
+SCREENSHOT_FORMAT = "jpeg"  # jpeg, webp or png
+SCREENSHOT_QUALITY = 80  # jpeg/webp quality
+STABLE_PROBE = "hash"  # "hash" (md5 computed on the device, exact) or "frame" (pulls the whole frame, tolerates tiny changes)
+STABLE_SAMPLES = 3  # Consecutive matching samples that count as a settled screen
+STABLE_INTERVAL = 0.25  # Seconds between samples
+STABLE_TOLERANCE = 2.0  # Mean thumbnail pixel difference (0-255) that still counts as a match
+SETTLE_TIMEOUT = 5  # Longest wait for the screen to settle after an action
+UNCHANGED_POLICY = "backoff"  # Screen unchanged after an action: "reissue" it, "backoff" and look again, or "escalate"
+UNCHANGED_MAX_SKIPS = 2  # LLM calls skipped in a row on an unchanged screen before escalating anyway
+UNCHANGED_BACKOFF = 1.0  # First backoff wait in seconds, doubled on every skip
+PHASH_SIZE = 16  # Perceptual hash grid, PHASH_SIZE x PHASH_SIZE bits
+PHASH_THRESHOLD = 0  # Differing hash bits still counted as the same screen (the hash is coarse, see README)
+UNCHANGED_THUMBNAIL = 512  # Long edge of the grayscale thumbnail that confirms an unchanged screen
+UNCHANGED_TOLERANCE = 8  # Largest thumbnail pixel difference (0-255) on a screen that counts as unchanged
+DECISION_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                   "hybrid-kernel", "decision_cache.json")  # Holds goal text; "" disables it
+DECISION_CACHE_SIZE = 500  # Screens remembered; the least recently used are evicted first
+DECISION_CACHE_MIN_CONFIRMATIONS = 2  # Times the LLM must choose an action on a screen before it is replayed
+DECISION_CACHE_TOLERANCE = 24  # Pixels two choices may differ by and still count as the same action
+DECISION_CACHE_THUMBNAIL = 128  # Long edge of the thumbnail screenshots are remembered and matched by
+STATUS_BAR_HEIGHT = 0.05  # Top fraction of a screenshot (clock, battery, icons) the decision cache ignores
 
 client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
@@ -48,21 +84,116 @@ def run_adb(args: List[str], timeout: int = 10) -> str:
         print(f"  [ADB Error] {e}")
         return ""
 
+class AdbShell:
+    """
+    Long-lived `adb shell` session that runs device commands without forking adb each time.
+
+    Commands are written to the shell's stdin one per line, followed by a marker with the
+    exit code, and the output is read back up to that marker.
+    """
+
+    def __init__(self, adb_path: str = ADB_PATH):
+        self.adb_path = adb_path
+        self.process: Optional[subprocess.Popen] = None
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def start(self):
+        """Open the shell session."""
+        self.process = subprocess.Popen(
+            [self.adb_path, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0
+        )
+
+    def close(self):
+        """Close the shell session."""
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def run(self, args: List[str], timeout: int = 10) -> Optional[str]:
+        """
+        Run a command in the session, like `adb shell <args>`.
+        Returns the output ("" on timeout), or None if the session broke before the command
+        finished (it is reopened on the next call).
+        """
+        with self.lock:
+            self.counter += 1
+            marker = f"__HK_DONE_{self.counter}__".encode()
+            # Like `adb shell a b c`, the arguments are joined into one command line for the device
+            # shell; stdin is closed so a command can't swallow the ones queued after it
+            command = b"{ " + " ".join(args).encode() + b"\n} </dev/null; printf '\\n%s %d\\n' " + marker + b" $?\n"
+            try:
+                if self.process is None or self.process.poll() is not None:
+                    self.start()
+                self.process.stdin.write(command)
+                output = self._read_until(b"\n" + marker + b" ", timeout)
+            except TimeoutError:
+                # The command may still be running; don't retry it, just start over next time
+                print(f"  [ADB Timeout] Command timed out")
+                self.close()
+                return ""
+            except OSError:
+                output = None
+            if output is None:
+                self.close()
+                return None
+            output, _, exit_code = output.rpartition(b"\n" + marker + b" ")
+            text = output.decode("utf-8", errors="replace").strip()
+            if exit_code.strip() != b"0" and text:
+                print(f"  [ADB Warning] {text}")
+            return text
+
+    def _read_until(self, marker: bytes, timeout: float) -> Optional[bytes]:
+        """Read the shell's output up to the end of the line holding marker, None on EOF."""
+        data = b""
+        fd = self.process.stdout.fileno()
+        deadline = time.monotonic() + timeout
+        while True:
+            end = data.find(marker)
+            if end != -1 and data.find(b"\n", end + len(marker)) != -1:
+                return data
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                return None
+            data += chunk
+
+_shell: Optional[AdbShell] = None
+
+def adb_shell(args: List[str], timeout: int = 10) -> str:
+    """Run a device shell command, over the persistent session when possible (falls back to run_adb)."""
+    global _shell
+    if ADB_PERSISTENT_SHELL:
+        if _shell is None:
+            _shell = AdbShell()
+            atexit.register(_shell.close)
+        output = _shell.run(args, timeout)
+        if output is not None:
+            return output
+    return run_adb(["shell"] + args, timeout)
+
 def tap(x: int, y: int):
     """Tap at coordinates."""
     print(f"  👆 Tap ({x}, {y})")
-    run_adb(["shell", "input", "tap", str(x), str(y)])
+    adb_shell(["input", "tap", str(x), str(y)])
 
 def swipe(x1: int, y1: int, x2: int, y2: int, duration: int = 300):
     """Swipe gesture."""
     print(f"  👆 Swipe ({x1},{y1}) -> ({x2},{y2})")
-    run_adb(["shell", "input", "swipe", str(x1), str(y1), str(x2), str(y2), str(duration)])
+    adb_shell(["input", "swipe", str(x1), str(y1), str(x2), str(y2), str(duration)])
 
 def type_text(text: str):
     """Type text (spaces replaced with %s for ADB)."""
     escaped = text.replace(" ", "%s").replace("'", "\\'")
     print(f"  ⌨️ Type: {text}")
-    run_adb(["shell", "input", "text", escaped])
+    adb_shell(["input", "text", escaped])
 
 def press_key(key: str):
     """Press a key (BACK, HOME, ENTER, etc)."""
@@ -71,12 +202,12 @@ def press_key(key: str):
         "delete": "67", "tab": "61"
     }.get(key.lower(), key)
     print(f"  🔘 Key: {key}")
-    run_adb(["shell", "input", "keyevent", keycode])
+    adb_shell(["input", "keyevent", keycode])
 
 def start_app(package: str):
     """Start an app by package name."""
     print(f"  📱 Starting: {package}")
-    run_adb(["shell", "monkey", "-p", package, "-c", "android.intent.category.LAUNCHER", "1"])
+    adb_shell(["monkey", "-p", package, "-c", "android.intent.category.LAUNCHER", "1"])
 
 def wait(seconds: int = 3):
     """Wait for UI to update."""
@@ -87,14 +218,8 @@ def wait(seconds: int = 3):
 
 def get_uiautomator_dump() -> Optional[str]:
     """Get UI hierarchy via uiautomator dump. Returns None if fails or empty."""
-    run_adb(["shell", "uiautomator", "dump", SCREEN_DUMP_PATH])
-    run_adb(["pull", SCREEN_DUMP_PATH, LOCAL_DUMP_PATH])
-
-    if not os.path.exists(LOCAL_DUMP_PATH):
-        return None
-
-    with open(LOCAL_DUMP_PATH, "r", encoding="utf-8") as f:
-        content = f.read()
+    # Read the dump back through the shell instead of a separate `adb pull`
+    content = adb_shell(["uiautomator", "dump", SCREEN_DUMP_PATH, ">/dev/null", "&&", "cat", SCREEN_DUMP_PATH])
 
     # Check if it has useful content
     if len(content) < 500 or content.count("clickable=\"true\"") < 2:
@@ -128,22 +253,219 @@ def parse_ui_elements(xml_content: str) -> List[Dict]:
 
     return elements
 
+class Screenshot:
+    """An encoded screen capture, with the mapping from its pixels back to device pixels."""
+
+    def __init__(self, data: bytes, mime_type: str, size: tuple[int, int], device_size: tuple[int, int]):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+        self.device_size = device_size
+        self.capture_time = 0.0  # Seconds to pull the frame from the device
+        self.encode_time = 0.0  # Seconds to decode, downscale and encode it
+        self.phash: Optional[int] = None  # Perceptual hash, when the frame was decoded
+        self.thumbnail: Optional["Image.Image"] = None  # Grayscale thumbnail, when the frame was decoded
+
+    def base64(self) -> str:
+        """Encoded image as base64."""
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def data_url(self) -> str:
+        """Encoded image as a data URL for the vision model."""
+        return f"data:{self.mime_type};base64,{self.base64()}"
+
+    def to_device(self, x: int, y: int) -> tuple[int, int]:
+        """Map a point in screenshot pixels to device pixels."""
+        return (round(x * self.device_size[0] / self.size[0]), round(y * self.device_size[1] / self.size[1]))
+
+    def map_action(self, action: Dict[str, Any]) -> Dict[str, Any]:
+        """Map the coordinates of an action the model chose on this screenshot to device pixels."""
+        action = dict(action)
+        for x_key, y_key in (("x", "y"), ("x1", "y1"), ("x2", "y2")):
+            if x_key in action and y_key in action:
+                try:
+                    action[x_key], action[y_key] = self.to_device(float(action[x_key]), float(action[y_key]))
+                except (TypeError, ValueError):
+                    pass
+        return action
+
+def perceptual_hash(image: "Image.Image") -> int:
+    """Difference hash: each bit says whether a cell of a tiny grayscale copy is brighter than its right neighbour."""
+    small = image.resize((PHASH_SIZE + 1, PHASH_SIZE), Image.BOX).convert("L").tobytes()
+    bits = 0
+    for row in range(PHASH_SIZE):
+        for col in range(PHASH_SIZE):
+            i = row * (PHASH_SIZE + 1) + col
+            bits = (bits << 1) | (small[i] > small[i + 1])
+    return bits
+
+def screen_thumbnail(image: "Image.Image") -> "Image.Image":
+    """Grayscale copy reduced by an integer factor to about UNCHANGED_THUMBNAIL pixels on the long edge."""
+    return image.reduce(max(max(image.size) // UNCHANGED_THUMBNAIL, 1)).convert("L")
+
+def thumbnails_match(a: "Image.Image", b: "Image.Image") -> bool:
+    """Whether no pixel of two thumbnails differs by more than UNCHANGED_TOLERANCE."""
+    return a.size == b.size and ImageChops.difference(a, b).getextrema()[1] <= UNCHANGED_TOLERANCE
+
+def perception_signature(context: Any, is_screenshot: bool) -> Any:
+    """
+    Signature of what the model would see: the perceptual hash and thumbnail of a screenshot
+    (a digest of its data without Pillow), or a digest of the UI elements.
+    """
+    if is_screenshot:
+        if context.thumbnail is not None:
+            return context.phash, context.thumbnail
+        return hashlib.sha1(context.data).hexdigest()
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()
+
+def same_perception(a: Any, b: Any) -> bool:
+    """Whether two perception signatures show the same screen."""
+    if isinstance(a, tuple) and isinstance(b, tuple):
+        # The hash is too coarse to see small changes like typed text, so it can only rule a change
+        # in; whether the screen is really unchanged is decided pixel by pixel on the thumbnail
+        if bin(a[0] ^ b[0]).count("1") > PHASH_THRESHOLD:
+            return False
+        return thumbnails_match(a[1], b[1])
+    return a is not None and a == b
+
+def exec_out(args: List[str], timeout: int = 10) -> bytes:
+    """Run `adb exec-out` and return its binary output (empty on failure)."""
+    try:
+        result = subprocess.run([ADB_PATH, "exec-out"] + args, capture_output=True, timeout=timeout)
+        return result.stdout if result.returncode == 0 else b""
+    except subprocess.TimeoutExpired:
+        print(f"  [ADB Timeout] Screenshot timed out")
+        return b""
+    except Exception as e:
+        print(f"  [ADB Error] {e}")
+        return b""
+
+def read_raw_frame(data: bytes) -> Optional["Image.Image"]:
+    """Decode raw `screencap` output: a 12-byte (16 from Android 9) header, then RGBA/RGBX pixels."""
+    if len(data) < 12:
+        return None
+    width, height, pixel_format = struct.unpack_from("<3I", data)
+    header = len(data) - width * height * 4
+    # Formats 1 and 2 are RGBA_8888 and RGBX_8888; anything else is left to the PNG path
+    if pixel_format not in (1, 2) or header not in (12, 16):
+        return None
+    # The screen is opaque, so drop alpha while unpacking rather than converting later
+    return Image.frombytes("RGB", (width, height), data[header:], "raw", "RGBX")
+
+def capture_screen(source: str = None, long_edge: int = None, image_format: str = None,
+                   quality: int = None) -> Optional[Screenshot]:
+    """
+    Capture the screen for the vision model: pull the frame, downscale it to long_edge and encode
+    it as image_format. Defaults come from the SCREENSHOT_* settings. Returns None on failure.
+    """
+    source = source or SCREENSHOT_SOURCE
+    long_edge = SCREENSHOT_LONG_EDGE if long_edge is None else long_edge
+    image_format = (image_format or SCREENSHOT_FORMAT).lower()
+    quality = quality or SCREENSHOT_QUALITY
+
+    started = time.perf_counter()
+    image = None
+    if source == "raw" and Image is not None:
+        image = read_raw_frame(exec_out(["screencap"]))
+    png = None
+    if image is None:
+        png = exec_out(["screencap", "-p"])
+        if not png:
+            return None
+    captured = time.perf_counter()
+
+    if png is not None:
+        # Width and height are the first fields of the PNG IHDR chunk
+        size = struct.unpack(">II", png[16:24])
+        if Image is None or (image_format == "png" and (not long_edge or max(size) <= long_edge)):
+            # Nothing to change: send the device's PNG as is
+            shot = Screenshot(png, "image/png", size, size)
+            shot.capture_time = captured - started
+            return shot
+
+    if image is None:
+        image = Image.open(io.BytesIO(png))
+    device_size = image.size
+    scale = long_edge / max(device_size) if long_edge else 1.0
+    if scale < 1.0:
+        size = (max(round(device_size[0] * scale), 1), max(round(device_size[1] * scale), 1))
+        # Box filtering averages every source pixel: cheap, and sharp enough for UI text
+        image = image.resize(size, Image.BOX)
+
+    buffer = io.BytesIO()
+    if image_format == "png":
+        image.save(buffer, "PNG", compress_level=1)
+    elif image_format == "webp":
+        image.convert("RGB").save(buffer, "WEBP", quality=quality, method=0)
+    else:
+        image_format = "jpeg"
+        image.convert("RGB").save(buffer, "JPEG", quality=quality)
+    shot = Screenshot(buffer.getvalue(), f"image/{image_format}", image.size, device_size)
+    shot.phash = perceptual_hash(image)
+    shot.thumbnail = screen_thumbnail(image)
+    shot.capture_time = captured - started
+    shot.encode_time = time.perf_counter() - captured
+    return shot
+
 def get_screenshot_base64() -> str:
     """Capture screenshot and return as base64."""
-    result = subprocess.run(
-        [ADB_PATH, "exec-out", "screencap", "-p"],
-        capture_output=True,
-        timeout=10
-    )
+    shot = capture_screen()
+    return shot.base64() if shot else ""
 
-    if result.returncode == 0 and result.stdout:
-        return base64.b64encode(result.stdout).decode('utf-8')
-    return ""
-
-def get_screen_state() -> tuple[str, bool]:
+def screen_signature() -> Any:
+    """
+    Signature of the current screen for stability checks: a hash of the framebuffer computed on
+    the device, so only the digest crosses USB, or with STABLE_PROBE = "frame" a tiny grayscale
+    thumbnail of the whole pulled frame. Returns None if the screen can't be read.
+    """
+    if STABLE_PROBE == "frame" and Image is not None:
+        # A raw frame is ~10 MB at 1080p: far heavier per sample than the hash
+        image = read_raw_frame(exec_out(["screencap"]))
+        if image is not None:
+            # Integer box reduction to ~96px on the long edge; a few ms even for 1440p frames
+            return image.reduce(max(max(image.size) // 96, 1)).convert("L").tobytes()
+    # Runs in the persistent shell, without forking adb per sample
+    digest = adb_shell(["screencap", "|", "md5sum"]).split()
+    return digest[0] if digest else None
+
+def signatures_match(a: Any, b: Any) -> bool:
+    """Whether two screen signatures show the same screen."""
+    if a is None or b is None:
+        return False
+    if isinstance(a, bytes) and isinstance(b, bytes):
+        if len(a) != len(b):
+            return False
+        return sum(abs(x - y) for x, y in zip(a, b)) / len(a) <= STABLE_TOLERANCE
+    return a == b
+
+def wait_until_stable(timeout: float = SETTLE_TIMEOUT, samples: int = STABLE_SAMPLES,
+                      interval: float = STABLE_INTERVAL) -> float:
+    """
+    Wait until `samples` consecutive screen samples match, or until timeout.
+    Falls back to a fixed wait if the screen can't be sampled. Returns the seconds waited.
     """
-    Get screen state. Returns (context_string, is_screenshot).
-    Tries uiautomator first, falls back to screenshot.
+    started = time.monotonic()
+    previous = screen_signature()
+    if previous is None:
+        wait(timeout)
+        return timeout
+    matches = 1
+    while matches < samples:
+        if time.monotonic() - started + interval > timeout:
+            print(f"  ⏳ Screen still changing after {time.monotonic() - started:.1f}s")
+            return time.monotonic() - started
+        time.sleep(interval)
+        current = screen_signature()
+        matches = matches + 1 if signatures_match(previous, current) else 1
+        previous = current
+    elapsed = time.monotonic() - started
+    print(f"  ⏳ Screen settled after {elapsed:.1f}s")
+    return elapsed
+
+def get_screen_state() -> tuple[Any, bool]:
+    """
+    Get screen state. Returns (context, is_screenshot), where context is the UI elements JSON
+    or a Screenshot. Tries uiautomator first, falls back to screenshot.
     """
     # Try uiautomator first (faster, cheaper)
     xml = get_uiautomator_dump()
@@ -156,10 +478,10 @@ def get_screen_state() -> tuple[str, bool]:
 
     # Fallback to screenshot (for Unity apps)
     print("  📸 Using screenshot (Unity/game app detected)")
-    b64 = get_screenshot_base64()
+    shot = capture_screen()
 
-    if b64:
-        return b64, True
+    if shot:
+        return shot, True
 
     return "Error: Could not get screen state", False
 
@@ -188,7 +510,8 @@ You are an Android automation agent with VISION. You can see screenshots of the
 
 Your job is to achieve the user's goal by looking at the screen and deciding what to tap/type.
 
-The screen resolution is approximately 1080x2400 pixels. Estimate coordinates based on visual position.
+Coordinates are pixels of the screenshot you receive; its size is given with every screenshot.
+Estimate coordinates based on visual position.
 
 Output ONLY a valid JSON object with your next action:
 - {"action": "tap", "x": 540, "y": 1200, "reason": "Clicking the blue button in center"}
@@ -216,18 +539,25 @@ IMPORTANT for PPPoker:
 Be precise with coordinates based on what you SEE. Always explain your reasoning.
 """
 
-def get_llm_decision(goal: str, context: str, is_screenshot: bool) -> Dict[str, Any]:
-    """Ask LLM for next action."""
+def get_llm_decision(goal: str, context: Any, is_screenshot: bool, note: str = "") -> Dict[str, Any]:
+    """
+    Ask LLM for next action. Coordinates chosen on a screenshot are mapped to device pixels.
+    A note (e.g. that the last action had no visible effect) is added to the user message.
+    """
+    if note:
+        note = f"\n\nNOTE: {note}"
 
     if is_screenshot:
         # Vision model with image
+        width, height = context.size
         messages = [
             {"role": "system", "content": SYSTEM_PROMPT_VISION},
             {
                 "role": "user",
                 "content": [
-                    {"type": "text", "text": f"GOAL: {goal}\n\nAnalyze this screenshot and decide the next action:"},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{context}"}}
+                    {"type": "text", "text": f"GOAL: {goal}{note}\n\nScreenshot size: {width}x{height} pixels.\n"
+                                             f"Analyze this screenshot and decide the next action:"},
+                    {"type": "image_url", "image_url": {"url": context.data_url()}}
                 ]
             }
         ]
@@ -236,7 +566,7 @@ def get_llm_decision(goal: str, context: str, is_screenshot: bool) -> Dict[str,
         # Text model with UI elements
         messages = [
             {"role": "system", "content": SYSTEM_PROMPT_TEXT},
-            {"role": "user", "content": f"GOAL: {goal}\n\nUI ELEMENTS:\n{context}"}
+            {"role": "user", "content": f"GOAL: {goal}{note}\n\nUI ELEMENTS:\n{context}"}
         ]
         model = MODEL_TEXT
 
@@ -247,7 +577,177 @@ def get_llm_decision(goal: str, context: str, is_screenshot: bool) -> Dict[str,
         max_tokens=500
     )
 
-    return json.loads(response.choices[0].message.content)
+    decision = json.loads(response.choices[0].message.content)
+    if is_screenshot:
+        decision = context.map_action(decision)
+    return decision
+
+# --- DECISION CACHE ---
+
+GOAL_NUMBER = re.compile(r"(?<!\d)\d+(?:[.,]\d+)*(?!\d)")
+
+class DecisionCache:
+    """
+    Persistent LRU cache of the actions the LLM chose, keyed by goal template and screen.
+
+    The goal template is the goal with its numbers replaced by '#', so the same flow with another
+    agent ID or amount shares entries; goal numbers in typed text are stored as placeholders and
+    filled in on replay. Screenshots match within the unchanged-screen tolerance, other screens
+    exactly. An action is only replayed once the LLM has chosen it on that screen min_confirmations
+    times, and is forgotten if a replay has no effect.
+    """
+
+    def __init__(self, path: str, max_entries: int = DECISION_CACHE_SIZE,
+                 min_confirmations: int = DECISION_CACHE_MIN_CONFIRMATIONS):
+        self.path = path
+        self.max_entries = max_entries
+        self.min_confirmations = min_confirmations
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # Least recently used first
+        self.thumbnails: Dict[str, "Image.Image"] = {}  # Decoded signatures of the "thumbnail" entries
+        self.hits = 0
+        self.load()
+
+    @staticmethod
+    def goal_template(goal: str) -> tuple[str, List[str]]:
+        """Goal with its numbers replaced by '#', and the numbers that were replaced."""
+        template = " ".join(GOAL_NUMBER.sub("#", goal).lower().split())
+        return template, GOAL_NUMBER.findall(goal)
+
+    @staticmethod
+    def screen_key(context: Any, is_screenshot: bool) -> tuple[str, Any]:
+        """
+        (kind, signature) of a screen: a screenshot's thumbnail without the status bar, whose clock and
+        battery change all the time (the perceptual hash is too coarse to tell an empty field from a
+        filled one), a digest of the screenshot without Pillow, or a digest of the UI elements with
+        digits in their text normalized, so e.g. a changing balance is the same screen.
+        """
+        if is_screenshot:
+            if context.thumbnail is not None:
+                thumbnail = context.thumbnail
+                thumbnail = thumbnail.crop((0, round(thumbnail.height * STATUS_BAR_HEIGHT), *thumbnail.size))
+                return "thumbnail", thumbnail.reduce(max(max(thumbnail.size) // DECISION_CACHE_THUMBNAIL, 1))
+            return "sha1", hashlib.sha1(context.data).hexdigest()
+        elements = sorted(
+            (e["class"], e["id"], re.sub(r"\d", "#", e["text"]), e["clickable"], e["center"])
+            for e in json.loads(context)
+        )
+        return "elements", hashlib.sha1(json.dumps(elements, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def load(self):
+        """Load the cache file, if there is one."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for entry in json.load(f)["entries"]:
+                    self.entries[entry["key"]] = entry
+                    if entry["kind"] == "thumbnail" and Image is not None:
+                        image = Image.open(io.BytesIO(base64.b64decode(entry["signature"])))
+                        image.load()
+                        self.thumbnails[entry["key"]] = image
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"  ⚠️ Ignoring unreadable decision cache {self.path}: {e}")
+            self.entries.clear()
+            self.thumbnails.clear()
+
+    def save(self):
+        """Write the cache file (replaced atomically, so an interrupted run can't corrupt it)."""
+        if not self.path:
+            return
+        temp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": 1, "entries": list(self.entries.values())}, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"  ⚠️ Could not save decision cache: {e}")
+
+    def _find(self, template: str, kind: str, signature: Any) -> Optional[Dict[str, Any]]:
+        """Entry for a goal template and screen."""
+        if kind != "thumbnail":
+            return self.entries.get(f"{template}\n{kind}:{signature}")
+        # Screenshots rarely repeat pixel for pixel, so they are compared with the screens seen with
+        # this goal, most recently used first
+        for key in reversed(self.entries):
+            entry = self.entries[key]
+            thumbnail = self.thumbnails.get(key)
+            if thumbnail is not None and entry["goal"] == template and thumbnails_match(thumbnail, signature):
+                return entry
+        return None
+
+    def _remove(self, key: str):
+        """Drop an entry and its decoded thumbnail."""
+        del self.entries[key]
+        self.thumbnails.pop(key, None)
+
+    @staticmethod
+    def _same_action(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+        """Whether two actions are the same, ignoring the reason and small coordinate differences."""
+        for key in (set(a) | set(b)) - {"reason"}:
+            va, vb = a.get(key), b.get(key)
+            if isinstance(va, (int, float)) and isinstance(vb, (int, float)):
+                if abs(va - vb) > DECISION_CACHE_TOLERANCE:
+                    return False
+            elif va != vb:
+                return False
+        return True
+
+    def lookup(self, template: str, kind: str, signature: Any, params: List[str]) -> Optional[Dict[str, Any]]:
+        """Cached action for this goal and screen, if it is trusted, with the goal's numbers filled in."""
+        entry = self._find(template, kind, signature)
+        if entry is None or entry["confirmations"] < self.min_confirmations:
+            return None
+        # Saved with the next record or at the end of the run, not on every hit
+        entry["hits"] += 1
+        self.entries.move_to_end(entry["key"])
+        self.hits += 1
+
+        action = dict(entry["action"])
+        if isinstance(action.get("text"), str):
+            for i, param in enumerate(params):
+                action["text"] = action["text"].replace(f"<#{i}>", param)
+        action["reason"] = f"(cached, confirmed {entry['confirmations']}x) {action.get('reason', '')}".strip()
+        return action
+
+    def record(self, template: str, kind: str, signature: Any, decision: Dict[str, Any], params: List[str]):
+        """Record the LLM's decision on a screen: agreeing with the cached one confirms it, otherwise it replaces it."""
+        action = dict(decision)
+        if isinstance(action.get("text"), str):
+            # Longest first, so a number that is part of a longer one isn't replaced inside it
+            for i, param in sorted(enumerate(params), key=lambda item: -len(item[1])):
+                action["text"] = re.sub(rf"(?<!\d){re.escape(param)}(?!\d)", f"<#{i}>", action["text"])
+
+        entry = self._find(template, kind, signature)
+        if entry is not None and self._same_action(entry["action"], action):
+            entry["confirmations"] += 1
+        else:
+            if entry is not None:
+                self._remove(entry["key"])
+            stored = signature
+            if kind == "thumbnail":
+                buffer = io.BytesIO()
+                signature.save(buffer, "PNG")
+                stored = base64.b64encode(buffer.getvalue()).decode("ascii")
+                key = f"{template}\n{kind}:{hashlib.sha1(buffer.getvalue()).hexdigest()}"
+                self.thumbnails[key] = signature
+            else:
+                key = f"{template}\n{kind}:{signature}"
+            entry = {"key": key, "goal": template, "kind": kind, "signature": stored,
+                     "action": action, "confirmations": 1, "hits": 0}
+            self.entries[key] = entry
+        entry["updated"] = time.time()
+        self.entries.move_to_end(entry["key"])
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+        self.save()
+
+    def reject(self, template: str, kind: str, signature: Any):
+        """Forget the action cached for a screen, e.g. because it had no visible effect."""
+        entry = self._find(template, kind, signature)
+        if entry is not None:
+            self._remove(entry["key"])
+            self.save()
 
 # --- ACTION EXECUTION ---
 
@@ -272,10 +772,11 @@ def execute_action(action: Dict[str, Any]) -> bool:
     elif act_type == "home":
         press_key("home")
     elif act_type == "wait":
-        wait(action.get("seconds", 3))
+        # The requested time is an upper bound: stop as soon as the screen settles
+        wait_until_stable(action.get("seconds", 3))
     elif act_type == "start_app":
         start_app(action.get("package", ""))
-        wait(5)  # Always wait after starting app
+        wait_until_stable(5)  # Always wait after starting app
     elif act_type == "done":
         print("\n✅ Goal achieved!")
         return False
@@ -286,8 +787,8 @@ def execute_action(action: Dict[str, Any]) -> bool:
 
 # --- MAIN AGENT LOOP ---
 
-def run_agent(goal: str, max_steps: int = 20):
-    """Run the agent loop."""
+def run_agent(goal: str, max_steps: int = 20, use_cache: bool = True):
+    """Run the agent loop. With use_cache, trusted decisions from earlier runs are replayed without the LLM."""
     print(f"\n🚀 Hybrid Android Kernel")
     print(f"📋 Goal: {goal}")
     print("-" * 50)
@@ -297,6 +798,17 @@ def run_agent(goal: str, max_steps: int = 20):
     if force_screenshot:
         print("🎮 Detected game/Unity app - forcing screenshot mode")
 
+    cache = DecisionCache(DECISION_CACHE_PATH) if use_cache and DECISION_CACHE_PATH else None
+    template, params = DecisionCache.goal_template(goal)
+    if cache is not None:
+        print(f"💾 Decision cache: {len(cache.entries)} screens remembered")
+
+    last_decision = None
+    last_signature = None
+    last_screen = None  # Cache key of the screen the last decision was made on
+    last_cached = False  # Whether the last decision was replayed from the cache
+    unchanged = 0  # Consecutive steps on which the last action had no visible effect
+
     for step in range(1, max_steps + 1):
         print(f"\n[Step {step}/{max_steps}]")
 
@@ -305,41 +817,88 @@ def run_agent(goal: str, max_steps: int = 20):
 
         if force_screenshot:
             # Skip uiautomator for games
-            b64 = get_screenshot_base64()
-            context, is_screenshot = (b64, True) if b64 else ("Error: Screenshot failed", False)
+            shot = capture_screen()
+            context, is_screenshot = (shot, True) if shot else ("Error: Screenshot failed", False)
         else:
             context, is_screenshot = get_screen_state()
 
-        if "Error" in context:
+        if not is_screenshot and context.startswith("Error"):
             print(f"  ❌ {context}")
             wait(2)
             continue
 
-        mode = "📸 Vision" if is_screenshot else "📝 UIAutomator"
-        print(f"  {mode} mode")
+        if is_screenshot:
+            print(f"  📸 Vision mode ({context.size[0]}x{context.size[1]} {context.mime_type}, "
+                  f"{len(context.data) // 1024} KB)")
+        else:
+            print(f"  📝 UIAutomator mode")
+
+        # Don't pay for another LLM call on the same screen the last decision was made on
+        signature = perception_signature(context, is_screenshot)
+        note = ""
+        if last_decision is not None and same_perception(signature, last_signature):
+            unchanged += 1
+            # A replayed action gets no second chance: it was cached for a different state of the app
+            if not last_cached and UNCHANGED_POLICY != "escalate" and unchanged <= UNCHANGED_MAX_SKIPS:
+                # Typing twice would duplicate the text, so that is never re-issued
+                if UNCHANGED_POLICY == "reissue" and last_decision.get("action") != "type":
+                    print(f"  🔁 Screen unchanged - re-issuing the last action ({unchanged}/{UNCHANGED_MAX_SKIPS})")
+                    if not execute_action(last_decision):
+                        break
+                    wait_until_stable()
+                else:
+                    delay = UNCHANGED_BACKOFF * 2 ** (unchanged - 1)
+                    print(f"  💤 Screen unchanged - looking again in {delay:g}s ({unchanged}/{UNCHANGED_MAX_SKIPS})")
+                    wait(delay)
+                continue
+            print("  ⚠️ Screen unchanged - asking the LLM for a different action")
+            if cache is not None and last_cached:
+                cache.reject(template, *last_screen)
+            # The new decision gets its own skips if it has no effect either
+            unchanged = 0
+            note = (f"The screen did not change after your last action ({json.dumps(last_decision, ensure_ascii=False)}). "
+                    "It probably had no effect; choose a different action.")
+        else:
+            unchanged = 0
+        last_signature = signature
 
         # 2. Reasoning
-        print("  🧠 Thinking...")
-        try:
-            decision = get_llm_decision(goal, context, is_screenshot)
-        except Exception as e:
-            print(f"  ❌ LLM Error: {e}")
-            wait(2)
-            continue
+        screen = DecisionCache.screen_key(context, is_screenshot)
+        decision = cache.lookup(template, *screen, params) if cache is not None and not note else None
+        last_cached = decision is not None
+        if last_cached:
+            print("  ⚡ Screen seen before - replaying the cached action")
+        else:
+            print("  🧠 Thinking...")
+            try:
+                decision = get_llm_decision(goal, context, is_screenshot, note)
+            except Exception as e:
+                print(f"  ❌ LLM Error: {e}")
+                wait(2)
+                continue
+            # A decision made under the "no effect" note is a workaround for this run, not what the
+            # screen calls for, so it is not learned
+            if cache is not None and not note:
+                cache.record(template, *screen, decision, params)
+        last_decision = decision
+        last_screen = screen
 
         # 3. Action
         if not execute_action(decision):
             break
 
         # Wait for UI to update
-        wait(2)
+        wait_until_stable()
 
+    if cache is not None:
+        cache.save()
+        print(f"\n💾 Decision cache: {cache.hits} LLM calls saved, {len(cache.entries)} screens remembered")
     print("\n🏁 Agent finished")
 
 def interactive_mode():
     """Interactive mode - enter commands one at a time."""
     print("\n🎮 Interactive Mode")
-    print("Commands: tap X Y | type TEXT | swipe | back | home | screenshot | goal GOAL | quit")
+    print("Commands: tap X Y | type TEXT | swipe | back | home | screenshot | settle [MAX] | goal GOAL | quit")
     print("-" * 50)
 
     while True:
@@ -372,12 +931,18 @@ def interactive_mode():
             press_key("home")
         elif action == "screenshot":
             print("  📸 Capturing...")
-            b64 = get_screenshot_base64()
-            print(f"  ✅ Got {len(b64)} bytes")
+            shot = capture_screen()
+            if shot:
+                print(f"  ✅ Got {shot.size[0]}x{shot.size[1]} {shot.mime_type}, {len(shot.base64())} bytes "
+                      f"(capture {shot.capture_time * 1000:.0f}ms, encode {shot.encode_time * 1000:.0f}ms)")
+            else:
+                print("  ❌ Screenshot failed")
         elif action == "start" and args:
             start_app(args)
         elif action == "wait":
             wait(int(args) if args else 3)
+        elif action == "settle":
+            wait_until_stable(float(args) if args else SETTLE_TIMEOUT)
         elif action == "goal" and args:
             run_agent(args)
         elif action == "scan":
@@ -396,13 +961,14 @@ if __name__ == "__main__":
     parser.add_argument("goal", nargs="?", help="Goal to achieve")
     parser.add_argument("--interactive", "-i", action="store_true", help="Interactive mode")
     parser.add_argument("--max-steps", "-n", type=int, default=20, help="Max steps")
+    parser.add_argument("--no-cache", action="store_true", help="Always ask the LLM, ignoring the decision cache")
 
     args = parser.parse_args()
 
     if args.interactive:
         interactive_mode()
     elif args.goal:
-        run_agent(args.goal, args.max_steps)
+        run_agent(args.goal, args.max_steps, not args.no_cache)
     else:
         # Default: interactive
         interactive_mode()
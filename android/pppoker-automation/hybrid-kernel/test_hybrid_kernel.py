@@ -0,0 +1,272 @@
+"""
+Unit tests for the hybrid kernel's device-independent logic (no adb or API calls).
+
+Run with:
+    python -m pytest test_hybrid_kernel.py
+"""
+
+import itertools
+import json
+import os
+import struct
+
+# The OpenAI client is created at import time; the tests never call it
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import pytest
+from PIL import Image, ImageDraw
+
+import hybrid_kernel as hk
+
+# --- SCREENSHOTS ---
+
+def raw_frame(width: int, height: int, header_size: int, pixel: bytes = b"\x10\x20\x30\xff") -> bytes:
+    """Build `screencap` output: width, height, format (and colorspace from Android 9), then RGBA pixels."""
+    header = struct.pack("<3I", width, height, 1) + b"\x00" * (header_size - 12)
+    return header + pixel * (width * height)
+
+def test_read_raw_frame_accepts_both_header_sizes():
+    for header_size in (12, 16):
+        image = hk.read_raw_frame(raw_frame(4, 3, header_size))
+        assert image.mode == "RGB"
+        assert image.size == (4, 3)
+        assert image.getpixel((3, 2)) == (0x10, 0x20, 0x30)
+
+def test_read_raw_frame_rejects_unknown_data():
+    assert hk.read_raw_frame(b"") is None
+    assert hk.read_raw_frame(raw_frame(4, 3, 12)[:-4]) is None  # Truncated
+    assert hk.read_raw_frame(struct.pack("<3I", 4, 3, 4) + b"\x00" * 48) is None  # RGB_565
+
+def test_map_action_scales_coordinates_to_device_pixels():
+    shot = hk.Screenshot(b"", "image/jpeg", (576, 1280), (1080, 2400))
+    action = shot.map_action({"action": "swipe", "x1": 288, "y1": 640, "x2": 288, "y2": 0, "reason": "r"})
+    assert action == {"action": "swipe", "x1": 540, "y1": 1200, "x2": 540, "y2": 0, "reason": "r"}
+    assert shot.map_action({"action": "tap", "x": "?", "y": 10}) == {"action": "tap", "x": "?", "y": 10}
+
+# --- SETTLING ---
+
+class FakeClock:
+    """Stands in for time.monotonic and time.sleep, so waits take no real time."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+def settle(monkeypatch, signatures, **kwargs) -> tuple[float, int]:
+    """Run wait_until_stable over a sequence of screen signatures; returns (seconds waited, samples taken)."""
+    clock = FakeClock()
+    samples = iter(signatures)
+    taken = []
+    monkeypatch.setattr(hk.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(hk.time, "sleep", clock.sleep)
+    monkeypatch.setattr(hk, "wait", clock.sleep)
+    monkeypatch.setattr(hk, "screen_signature", lambda: taken.append(1) or next(samples))
+    return hk.wait_until_stable(**kwargs), len(taken)
+
+def test_screen_signature_defaults_to_the_hash_computed_on_the_device(monkeypatch):
+    commands = []
+    monkeypatch.setattr(hk, "adb_shell", lambda args, timeout=10: commands.append(args) or "0123abcd  -\n")
+    monkeypatch.setattr(hk, "exec_out", lambda *args, **kwargs: pytest.fail("pulled the whole frame"))
+    assert hk.screen_signature() == "0123abcd"
+    assert commands == [["screencap", "|", "md5sum"]]
+
+def test_signatures_match():
+    assert hk.signatures_match("0123abcd", "0123abcd")
+    assert not hk.signatures_match("0123abcd", "4567abcd")
+    assert not hk.signatures_match(None, None)
+    # Frame thumbnails match on the mean pixel difference
+    assert hk.signatures_match(bytes([100] * 100), bytes([100] * 90 + [120] * 10))
+    assert not hk.signatures_match(bytes([100] * 100), bytes([100] * 80 + [120] * 20))
+    assert not hk.signatures_match(bytes(100), bytes(99))
+
+def test_wait_until_stable_returns_once_enough_samples_match(monkeypatch):
+    waited, taken = settle(monkeypatch, ["a", "b", "c", "c", "c", "d"], samples=3, interval=0.25)
+    assert (waited, taken) == (1.0, 5)
+
+def test_wait_until_stable_gives_up_at_the_timeout(monkeypatch):
+    waited, taken = settle(monkeypatch, itertools.count(), timeout=2.0, samples=3, interval=0.25)
+    assert (waited, taken) == (2.0, 9)
+
+def test_wait_until_stable_falls_back_to_a_fixed_wait(monkeypatch):
+    assert settle(monkeypatch, [None], timeout=3.0) == (3.0, 1)
+
+# --- PERCEPTION ---
+
+def amount_screen(digits: int = 0, checked: bool = False, clock: int = 0) -> Image.Image:
+    """A 1080x2340 transfer screen with `digits` characters typed into its amount field and `clock` in its status bar."""
+    image = Image.new("RGB", (1080, 2340), (240, 240, 245))
+    draw = ImageDraw.Draw(image)
+    for i in range(4):
+        # Clock digits, a different stroke per minute
+        draw.rectangle((40 + i * 30, 30, 46 + i * 30 + (clock + i) % 4 * 6, 80), fill=(20, 20, 20))
+    draw.rectangle((60, 200, 1020, 400), fill=(30, 60, 120))
+    draw.rectangle((60, 900, 1020, 1020), fill="white", outline=(180, 180, 180), width=3)
+    for i in range(digits):
+        # Glyph-sized strokes, about what a 48px font draws
+        draw.rectangle((90 + i * 30, 935, 96 + i * 30, 985), fill=(20, 20, 20))
+        draw.rectangle((90 + i * 30, 935, 110 + i * 30, 941), fill=(20, 20, 20))
+    draw.rectangle((60, 1100, 100, 1140), outline=(100, 100, 100), width=3)
+    if checked:
+        draw.line((68, 1120, 80, 1132, 94, 1106), fill=(0, 120, 0), width=5)
+    draw.rectangle((300, 1900, 780, 2040), fill=(0, 150, 80))
+    return image
+
+def screenshot(image: Image.Image) -> hk.Screenshot:
+    """A Screenshot carrying the signatures capture_screen computes, at the default 1280px long edge."""
+    small = image.resize((591, 1280), Image.BOX)
+    shot = hk.Screenshot(b"", "image/jpeg", small.size, image.size)
+    shot.phash = hk.perceptual_hash(small)
+    shot.thumbnail = hk.screen_thumbnail(small)
+    return shot
+
+def signature(image: Image.Image):
+    return hk.perception_signature(screenshot(image), True)
+
+def test_identical_screens_are_unchanged():
+    assert hk.same_perception(signature(amount_screen()), signature(amount_screen()))
+
+def test_typed_text_and_toggles_are_changes():
+    empty = signature(amount_screen())
+    changed = [amount_screen(digits=1), amount_screen(digits=3), amount_screen(digits=5), amount_screen(checked=True)]
+    for image in changed:
+        assert not hk.same_perception(empty, signature(image))
+
+def test_perceptual_hash_is_too_coarse_on_its_own():
+    # Why the thumbnail decides: typing barely moves the 256-bit hash
+    empty = hk.perceptual_hash(amount_screen())
+    assert bin(empty ^ hk.perceptual_hash(amount_screen(digits=3))).count("1") <= 2
+
+def test_ui_element_signatures_compare_exactly():
+    elements = '[{"text": "Send", "center": [540, 1970]}]'
+    assert hk.same_perception(hk.perception_signature(elements, False), hk.perception_signature(elements, False))
+    assert not hk.same_perception(hk.perception_signature(elements, False),
+                                  hk.perception_signature(elements.replace("Send", "Sent"), False))
+
+# --- DECISION CACHE ---
+
+TAP_SEND = {"action": "tap", "x": 540, "y": 1970, "reason": "Send"}
+
+def test_goal_template_replaces_numbers():
+    assert hk.DecisionCache.goal_template("Envie 1.000 fichas  para 13180661") == \
+        ("envie # fichas para #", ["1.000", "13180661"])
+
+def test_action_is_replayed_only_after_enough_confirmations():
+    cache = hk.DecisionCache("", min_confirmations=2)
+    cache.record("goal", "sha1", "s1", TAP_SEND, [])
+    assert cache.lookup("goal", "sha1", "s1", []) is None
+    cache.record("goal", "sha1", "s1", dict(TAP_SEND, x=550), [])  # Within DECISION_CACHE_TOLERANCE
+    action = cache.lookup("goal", "sha1", "s1", [])
+    assert (action["action"], action["x"], action["y"]) == ("tap", 540, 1970)
+    assert cache.hits == 1
+
+def test_a_different_choice_resets_the_confirmations():
+    cache = hk.DecisionCache("", min_confirmations=2)
+    cache.record("goal", "sha1", "s1", TAP_SEND, [])
+    cache.record("goal", "sha1", "s1", {"action": "back"}, [])
+    assert cache.lookup("goal", "sha1", "s1", []) is None
+    cache.record("goal", "sha1", "s1", {"action": "back"}, [])
+    assert cache.lookup("goal", "sha1", "s1", [])["action"] == "back"
+
+def test_rejected_entries_are_forgotten():
+    cache = hk.DecisionCache("", min_confirmations=1)
+    cache.record("goal", "sha1", "s1", TAP_SEND, [])
+    cache.reject("goal", "sha1", "s1")
+    assert cache.lookup("goal", "sha1", "s1", []) is None
+
+def test_goal_numbers_in_typed_text_are_filled_in_on_replay():
+    cache = hk.DecisionCache("", min_confirmations=1)
+    template, params = hk.DecisionCache.goal_template("send 100 chips to 13180661")
+    cache.record(template, "sha1", "s1", {"action": "type", "text": "13180661"}, params)
+    _, params = hk.DecisionCache.goal_template("send 50 chips to 999")
+    assert cache.lookup(template, "sha1", "s1", params)["text"] == "999"
+
+def test_least_recently_used_entries_are_evicted():
+    cache = hk.DecisionCache("", max_entries=2, min_confirmations=1)
+    cache.record("goal", "sha1", "s1", TAP_SEND, [])
+    cache.record("goal", "sha1", "s2", TAP_SEND, [])
+    cache.lookup("goal", "sha1", "s1", [])
+    cache.record("goal", "sha1", "s3", TAP_SEND, [])
+    assert cache.lookup("goal", "sha1", "s2", []) is None
+    assert cache.lookup("goal", "sha1", "s1", []) is not None
+
+def test_cache_persists_across_runs(tmp_path):
+    path = str(tmp_path / "decision_cache.json")
+    cache = hk.DecisionCache(path, min_confirmations=1)
+    cache.record("goal", "sha1", "s1", TAP_SEND, [])
+    cache.lookup("goal", "sha1", "s1", [])
+    cache.save()
+    reloaded = hk.DecisionCache(path, min_confirmations=1)
+    assert reloaded.lookup("goal", "sha1", "s1", [])["x"] == 540
+    assert reloaded.entries["goal\nsha1:s1"]["hits"] == 2
+
+def test_unreadable_cache_file_is_ignored(tmp_path):
+    path = tmp_path / "decision_cache.json"
+    path.write_text("{oops")
+    assert not hk.DecisionCache(str(path)).entries
+
+def test_screen_key_tells_an_empty_field_from_a_filled_one():
+    empty = hk.DecisionCache.screen_key(screenshot(amount_screen()), True)[1]
+    assert hk.thumbnails_match(empty, hk.DecisionCache.screen_key(screenshot(amount_screen()), True)[1])
+    assert not hk.thumbnails_match(empty, hk.DecisionCache.screen_key(screenshot(amount_screen(digits=1)), True)[1])
+
+def test_screenshots_are_matched_without_the_status_bar():
+    cache = hk.DecisionCache("", min_confirmations=1)
+    cache.record("goal", *hk.DecisionCache.screen_key(screenshot(amount_screen(clock=0)), True), TAP_SEND, [])
+    assert cache.lookup("goal", *hk.DecisionCache.screen_key(screenshot(amount_screen(clock=1)), True), []) is not None
+    assert cache.lookup("goal", *hk.DecisionCache.screen_key(screenshot(amount_screen(digits=1)), True), []) is None
+    assert cache.lookup("other goal", *hk.DecisionCache.screen_key(screenshot(amount_screen()), True), []) is None
+    # Without the crop, the clock alone makes it another screen
+    assert not hk.thumbnails_match(screenshot(amount_screen(clock=0)).thumbnail, screenshot(amount_screen(clock=1)).thumbnail)
+
+def test_screenshot_entries_persist_across_runs(tmp_path):
+    path = str(tmp_path / "decision_cache.json")
+    cache = hk.DecisionCache(path, min_confirmations=1)
+    cache.record("goal", *hk.DecisionCache.screen_key(screenshot(amount_screen()), True), TAP_SEND, [])
+    reloaded = hk.DecisionCache(path, min_confirmations=1)
+    assert reloaded.lookup("goal", *hk.DecisionCache.screen_key(screenshot(amount_screen(clock=2)), True), [])["x"] == 540
+
+def test_screen_key_normalizes_digits_in_ui_elements():
+    def elements(balance: str, y: int) -> str:
+        return json.dumps([{"text": balance, "id": "balance", "class": "TextView", "clickable": False, "center": [540, y]}])
+    assert hk.DecisionCache.screen_key(elements("1,200", 300), False) == \
+        hk.DecisionCache.screen_key(elements("1,350", 300), False)
+    assert hk.DecisionCache.screen_key(elements("1,200", 300), False) != \
+        hk.DecisionCache.screen_key(elements("1,200", 400), False)
+
+# --- AGENT LOOP ---
+
+def test_type_then_send_flow_is_learned_without_false_escalations(monkeypatch, tmp_path):
+    state = {}
+    llm_calls = []
+
+    def decide(goal, context, is_screenshot, note=""):
+        llm_calls.append(note)
+        if state["sent"]:
+            return {"action": "done"}
+        if state["digits"]:
+            return dict(TAP_SEND)
+        return {"action": "type", "text": goal.split()[2]}
+
+    monkeypatch.setattr(hk, "DECISION_CACHE_PATH", str(tmp_path / "decision_cache.json"))
+    monkeypatch.setattr(hk, "capture_screen", lambda: screenshot(amount_screen(state["digits"], state["sent"])))
+    monkeypatch.setattr(hk, "get_llm_decision", decide)
+    monkeypatch.setattr(hk, "type_text", lambda text: state.update(digits=state["digits"] + len(text), typed=text))
+    monkeypatch.setattr(hk, "tap", lambda x, y: state.update(sent=True))
+    monkeypatch.setattr(hk, "wait_until_stable", lambda *args, **kwargs: 0)
+    monkeypatch.setattr(hk, "wait", lambda seconds=0: pytest.fail("backed off on a changed screen"))
+
+    calls_per_run = []
+    for amount in ("100", "100", "25000"):
+        state.update(digits=0, sent=False, typed="")
+        llm_calls.clear()
+        hk.run_agent(f"pppoker send {amount} chips", max_steps=6)
+        assert state["typed"] == amount and state["sent"]
+        assert not any(llm_calls), "escalated with a 'no effect' note"
+        calls_per_run.append(len(llm_calls))
+    # Confirmed after two runs; with another amount, only the screens showing it are new
+    assert calls_per_run == [3, 3, 2]
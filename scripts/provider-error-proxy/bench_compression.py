@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Compression benchmark for the Provider Error Proxy.
+
+Compares the default mode, where aiohttp decompresses upstream responses and the proxy sends
+them to the client uncompressed, with --preserve-encoding, where the compressed bytes are
+forwarded as-is. For each mode it reports proxy CPU time per request and the response bytes
+sent to the client.
+
+A local upstream stand-in serves a gzip-compressed chat completion, so no network access or
+API keys are needed.
+
+Usage:
+    uv run python bench_compression.py [--requests 500] [--concurrency 8] [--body-kb 64]
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+from aiohttp import web, ClientSession
+
+PROXY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy.py')
+
+
+def free_port() -> int:
+    """Find a free local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def make_completion(body_kb: int) -> bytes:
+    """Build an OpenAI-style chat completion of roughly body_kb kilobytes."""
+    # Seeded random words compress roughly like real model output; a repeated sentence would not
+    rng = random.Random(0)
+    words = ("the model response proxy token stream provider request error retry context "
+             "function tool result message assistant user goose session compaction limit").split()
+    content = ''
+    while len(content) < body_kb * 1024:
+        content += ' '.join(rng.choice(words) for _ in range(12)) + '. '
+    return json.dumps({
+        'id': 'chatcmpl-bench',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': 'gpt-4o',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': body_kb * 256, 'total_tokens': 100 + body_kb * 256},
+    }).encode('utf-8')
+
+
+async def start_upstream(port: int, body_kb: int) -> web.AppRunner:
+    """Start a local upstream that serves a pre-compressed completion."""
+    payload = gzip.compress(make_completion(body_kb))
+
+    async def handle(request: web.Request) -> web.Response:
+        await request.read()
+        return web.Response(
+            body=payload,
+            headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'}
+        )
+
+    app = web.Application()
+    app.router.add_route('*', '/{path:.*}', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    return runner
+
+
+async def wait_for_port(port: int, timeout: float = 10.0):
+    """Wait until something is listening on the port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('localhost', port)
+            writer.close()
+            await writer.wait_closed()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"Proxy did not start listening on port {port}")
+
+
+def children_cpu_seconds() -> float:
+    """CPU time (user + system) of all terminated and waited-for child processes."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def run_proxy(upstream_port: int, preserve_encoding: bool, requests: int, concurrency: int) -> dict:
+    """
+    Run a proxy subprocess, optionally drive load through it, and measure it.
+
+    Returns:
+        Dict with proxy CPU seconds, response bytes received, and per-request latencies
+    """
+    port = free_port()
+    cmd = [sys.executable, PROXY_PATH, '--port', str(port), '--no-stdin']
+    if preserve_encoding:
+        cmd.append('--preserve-encoding')
+    env = dict(os.environ, OPENAI_REAL_HOST=f'http://localhost:{upstream_port}')
+
+    cpu_before = children_cpu_seconds()
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    latencies = []
+    received = 0
+    try:
+        await wait_for_port(port)
+        if requests:
+            url = f'http://localhost:{port}/v1/chat/completions'
+            body = json.dumps({'model': 'gpt-4o', 'messages': [{'role': 'user', 'content': 'hello'}]})
+            headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip, deflate'}
+            semaphore = asyncio.Semaphore(concurrency)
+
+            # Don't decompress on the client side either, so we count the bytes actually sent
+            async with ClientSession(auto_decompress=False) as session:
+                async def one_request():
+                    nonlocal received
+                    async with semaphore:
+                        started = time.perf_counter()
+                        async with session.post(url, data=body, headers=headers) as resp:
+                            received += len(await resp.read())
+                        latencies.append(time.perf_counter() - started)
+
+                await asyncio.gather(*(one_request() for _ in range(requests)))
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        'cpu': children_cpu_seconds() - cpu_before,
+        'received': received,
+        'latencies': latencies,
+    }
+
+
+async def benchmark(requests: int, concurrency: int, body_kb: int):
+    """Benchmark both compression modes and print a comparison table."""
+    upstream_port = free_port()
+    upstream = await start_upstream(upstream_port, body_kb)
+    compressed_size = len(gzip.compress(make_completion(body_kb)))
+    print(f"Upstream body: {body_kb} KB JSON, {compressed_size / 1024:.1f} KB gzip")
+    print(f"Load: {requests} requests, concurrency {concurrency}")
+    print()
+
+    results = {}
+    try:
+        for name, preserve in (('decompress (default)', False), ('--preserve-encoding', True)):
+            # Startup and shutdown cost, subtracted so only per-request work is compared
+            idle = await run_proxy(upstream_port, preserve, 0, concurrency)
+            loaded = await run_proxy(upstream_port, preserve, requests, concurrency)
+            results[name] = (max(loaded['cpu'] - idle['cpu'], 0.0), loaded)
+    finally:
+        await upstream.cleanup()
+
+    print(f"{'Mode':<24} {'CPU ms/req':>11} {'Bytes/req':>11} {'Total MB':>9} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, (cpu, loaded) in results.items():
+        latencies = sorted(loaded['latencies'])
+        p50 = latencies[len(latencies) // 2] * 1000
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000
+        print(f"{name:<24} {cpu / requests * 1000:>11.3f} {loaded['received'] / requests:>11.0f} "
+              f"{loaded['received'] / 1024 / 1024:>9.2f} {p50:>8.2f} {p95:>8.2f}")
+
+
+def main():
+    """Main entry point."""
+    parser = ArgumentParser(description='Compare proxy CPU and bytes on the wire with and without --preserve-encoding')
+    parser.add_argument('--requests', type=int, default=500, help='Requests per mode (default: 500)')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent requests (default: 8)')
+    parser.add_argument('--body-kb', type=int, default=64, help='Uncompressed response size in KB (default: 64)')
+    args = parser.parse_args()
+
+    asyncio.run(benchmark(args.requests, args.concurrency, args.body_kb))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Overhead benchmark for the Provider Error Proxy.
+
+Drives a concurrent load through the proxy against a local upstream stand-in and reports, for each
+workload, the latency the proxy adds on top of calling the upstream directly (p50/p95/p99), requests
+per second and the proxy's resident memory. Workloads cover non-streaming completions, SSE streams
+and large request bodies, each with and without fault injection active.
+
+The upstream runs in its own process and answers instantly, so the numbers measure the proxy's own
+cost. No network access or API keys are needed.
+
+Usage:
+    uv run python benchmark.py [--requests 2000] [--concurrency 32] [--large-kb 1024] [--fault "u 10%"]
+"""
+
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from collections import Counter
+
+from aiohttp import web, ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from bench_compression import free_port, wait_for_port
+
+PROXY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy.py')
+WORKLOADS = ('json', 'sse', 'large')
+
+
+def run_upstream(port: int, sse_events: int, response_kb: int):
+    """Serve OpenAI-style completions and SSE streams without delay (runs in its own process)."""
+    content = 'benchmark ' * (response_kb * 1024 // 10)
+    completion = json.dumps({
+        'id': 'chatcmpl-bench',
+        'object': 'chat.completion',
+        'model': 'gpt-4o',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': 50, 'total_tokens': 150},
+    }).encode('utf-8')
+    event = ('data: ' + json.dumps({
+        'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'model': 'gpt-4o',
+        'choices': [{'index': 0, 'delta': {'content': ' token'}, 'finish_reason': None}],
+    }) + '\n\n').encode('utf-8')
+    tail = b'data: {"choices":[],"usage":{"prompt_tokens":100,"completion_tokens":50}}\n\ndata: [DONE]\n\n'
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        body = await request.read()
+        # The load generator puts the stream flag first, so there's no need to parse large bodies
+        if not body.startswith(b'{"stream": true'):
+            return web.Response(body=completion, content_type='application/json')
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for _ in range(sse_events):
+            await response.write(event)
+        await response.write(tail)
+        await response.write_eof()
+        return response
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_route('*', '/{path:.*}', handle)
+    web.run_app(app, host='localhost', port=port, access_log=None, print=None, handle_signals=True)
+
+
+def request_body(workload: str, large_kb: int) -> bytes:
+    """Build the request body for a workload."""
+    content = 'x' * (large_kb * 1024) if workload == 'large' else 'hello'
+    return json.dumps({
+        'stream': workload == 'sse',
+        'model': 'gpt-4o',
+        'messages': [{'role': 'user', 'content': content}],
+    }).encode('utf-8')
+
+
+async def run_load(url: str, body: bytes, requests: int, concurrency: int, timeout: float = 30.0) -> dict:
+    """
+    Send requests with a fixed number of concurrent clients and read every response to the end.
+
+    Returns:
+        Dict with the latencies of successful requests, status counts ('error' for aborted or
+        timed out requests) and the wall time
+    """
+    latencies = []
+    statuses = Counter()
+    remaining = requests
+    headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer benchmark'}
+
+    session = ClientSession(connector=TCPConnector(limit=concurrency), timeout=ClientTimeout(total=timeout))
+    async with session:
+        async def client():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, data=body, headers=headers) as resp:
+                        async for _ in resp.content.iter_any():
+                            pass
+                except (ClientError, asyncio.TimeoutError):
+                    statuses['error'] += 1
+                    continue
+                statuses[resp.status] += 1
+                if resp.status == 200:
+                    latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {'latencies': sorted(latencies), 'statuses': statuses, 'elapsed': elapsed}
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return math.nan
+    rank = max(math.ceil(percent / 100.0 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def rss_mb(pid: int) -> float:
+    """Resident memory in MB of a process and its children, e.g. --workers (via ps, for Linux and macOS)."""
+    try:
+        output = subprocess.run(['ps', '-ax', '-o', 'pid=,ppid=,rss='], capture_output=True, text=True).stdout
+    except OSError:
+        return math.nan
+    processes = [tuple(int(field) for field in line.split()) for line in output.splitlines() if line.strip()]
+    tree = {pid}
+    grown = True
+    while grown:
+        grown = False
+        for child, parent, _ in processes:
+            if parent in tree and child not in tree:
+                tree.add(child)
+                grown = True
+    total = sum(rss for child, _, rss in processes if child in tree)
+    return total / 1024 if total else math.nan
+
+
+def start_proxy(upstream_port: int, extra_args: list[str]) -> tuple[subprocess.Popen, int]:
+    """Start a proxy subprocess pointed at the upstream stand-in."""
+    port = free_port()
+    cmd = [sys.executable, PROXY_PATH, '--port', str(port), '--no-stdin', *extra_args]
+    env = dict(os.environ, OPENAI_REAL_HOST=f'http://localhost:{upstream_port}')
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, port
+
+
+async def benchmark(args):
+    """Run every workload directly and through the proxy, and print a comparison table."""
+    upstream_port = free_port()
+    upstream = multiprocessing.Process(target=run_upstream, args=(upstream_port, args.sse_events, args.response_kb),
+                                       daemon=True)
+    upstream.start()
+    workloads = [workload.strip() for workload in args.workloads.split(',')]
+    print(f"Load: {args.requests} requests per run, concurrency {args.concurrency}")
+    print(f"Workloads: json = {args.response_kb} KB completion, sse = {args.sse_events} events, "
+          f"large = {args.large_kb} KB request body")
+    if args.proxy_args:
+        print(f"Proxy arguments: {' '.join(args.proxy_args)}")
+    print()
+
+    rows = []
+    try:
+        await wait_for_port(upstream_port)
+        direct = {}
+        for workload in workloads:
+            body = request_body(workload, args.large_kb)
+            upstream_url = f'http://localhost:{upstream_port}/v1/chat/completions'
+            await run_load(upstream_url, body, args.warmup, args.concurrency, args.timeout)
+            direct[workload] = await run_load(upstream_url, body, args.requests, args.concurrency, args.timeout)
+
+        for fault in ('', args.fault):
+            process, port = start_proxy(upstream_port, args.proxy_args)
+            try:
+                await wait_for_port(port)
+                idle_rss = rss_mb(process.pid)
+                proxy_url = f'http://localhost:{port}/v1/chat/completions'
+                for workload in workloads:
+                    body = request_body(workload, args.large_kb)
+                    # (Re-)apply the fault after warm-up, so a count-based fault is spent on the measured run
+                    await run_load(proxy_url, body, args.warmup, args.concurrency, args.timeout)
+                    if fault:
+                        await set_mode(port, fault)
+                    result = await run_load(proxy_url, body, args.requests, args.concurrency, args.timeout)
+                    rows.append((workload, fault or 'none', direct[workload], result, idle_rss, rss_mb(process.pid)))
+            finally:
+                process.terminate()
+                process.wait()
+    finally:
+        upstream.terminate()
+        upstream.join()
+
+    width = max([len('Faults')] + [len(row[1]) for row in rows])
+    print(f"{'Workload':<8} {'Faults':<{width}} {'RPS':>8} {'Direct RPS':>11} {'+p50 ms':>8} {'+p95 ms':>8} "
+          f"{'+p99 ms':>8} {'Injected':>9} {'RSS MB':>15}")
+    for workload, fault, direct_result, result, idle_rss, loaded_rss in rows:
+        added = [
+            (percentile(result['latencies'], p) - percentile(direct_result['latencies'], p)) * 1000
+            for p in (50, 95, 99)
+        ]
+        injected = sum(count for status, count in result['statuses'].items() if status != 200)
+        print(f"{workload:<8} {fault:<{width}} {args.requests / result['elapsed']:>8.0f} "
+              f"{args.requests / direct_result['elapsed']:>11.0f} {added[0]:>8.2f} {added[1]:>8.2f} {added[2]:>8.2f} "
+              f"{injected:>9} {f'{idle_rss:.0f} -> {loaded_rss:.0f}':>15}")
+    print()
+    print("+pNN: latency percentile through the proxy minus the same percentile calling the upstream directly,")
+    print("over successful requests. RSS: proxy resident memory when idle -> after the run.")
+
+
+async def set_mode(port: int, command: str):
+    """Apply a fault command through the proxy's control API."""
+    async with ClientSession() as session:
+        async with session.post(f'http://localhost:{port}/__proxy/mode', data=command) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"Proxy rejected fault command '{command}': {await resp.text()}")
+
+
+def main():
+    """Main entry point."""
+    parser = ArgumentParser(description="Measure the latency, throughput and memory the proxy adds")
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per run (default: 2000)')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent clients (default: 32)')
+    parser.add_argument('--warmup', type=int, default=100, help='Warm-up requests before each run (default: 100)')
+    parser.add_argument('--workloads', type=str, default=','.join(WORKLOADS),
+                        help=f"Comma-separated workloads to run (default: {','.join(WORKLOADS)})")
+    parser.add_argument('--response-kb', type=int, default=2, help='Completion size for json (default: 2)')
+    parser.add_argument('--sse-events', type=int, default=50, help='Events per SSE stream (default: 50)')
+    parser.add_argument('--large-kb', type=int, default=1024, help='Request body size for large (default: 1024)')
+    parser.add_argument('--fault', type=str, default='u 10%',
+                        help='Fault command active in the fault runs (default: "u 10%%")')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='Per-request timeout in seconds, so stalled streams end (default: 30)')
+    parser.add_argument('proxy_args', nargs='*', metavar='-- PROXY_ARG',
+                        help='Extra proxy arguments after "--", e.g. -- --workers 4 --emulate-context')
+    args = parser.parse_args()
+
+    unknown = set(args.workloads.split(',')) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads: {', '.join(sorted(unknown))}")
+    asyncio.run(benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
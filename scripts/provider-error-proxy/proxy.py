@@ -6,7 +6,7 @@ This proxy intercepts HTTP traffic to AI providers and can inject errors interac
 It supports the major providers: OpenAI, Anthropic, Google, OpenRouter, Tetrate, and Databricks.
 
 Usage:
-    uv run python proxy.py [--port PORT]
+    uv run python proxy.py [--port PORT] [--workers N] [--rules RULES.yaml] [--scenario SCENARIO.yaml] [--record CASSETTE | --replay CASSETTE | --mock-upstream]
 
 Interactive commands:
     n - No error (pass through) - permanent mode
@@ -16,8 +16,20 @@ Interactive commands:
     c * - Context length exceeded error (100% of requests)
     r - Rate limit error
     u - Unknown server error (500)
+    l 2s - Delay response headers by 2s (same count/percentage modifiers as c)
+    t 500ms-3s 30% - Time-to-first-token delay on SSE streams (30% of streams)
+    k exp:50ms * - Delay before every SSE chunk (all streams)
+    s abort:5 - Close the connection after 5 SSE events (also stall, malformed, duplicate, error; "s off" clears)
+    r 3 @anthropic - Limit a command to a provider, path prefix (@/v1/messages) or both
+    r * @rule:NAME - Limit a command to the requests matched by a routing rule (--rules)
     q - Quit
 
+Control API (for automated harnesses):
+    POST /__proxy/mode    - Apply a command, e.g. curl -X POST localhost:8888/__proxy/mode -d 'r 30%'
+    GET  /__proxy/state   - Current fault state as JSON
+    GET  /__proxy/metrics - Prometheus metrics
+    GET  /__proxy/usage   - Token usage totals per provider and model
+
 To use with Goose, set the provider host environment variables:
     export OPENAI_HOST=http://localhost:8888
     export ANTHROPIC_HOST=http://localhost:8888
@@ -25,21 +37,39 @@ To use with Goose, set the provider host environment variables:
 """
 
 import asyncio
+import base64
+import collections
+import contextlib
+import fnmatch
+import functools
+import hashlib
+import io
+import json
 import logging
+import logging.handlers
+import math
+import multiprocessing
 import os
+import queue
 import random
+import re
+import signal
+import socket
 import threading
+import time
 from argparse import ArgumentParser
 from enum import Enum
-from typing import Optional
+from typing import Callable, Optional
 
-from aiohttp import web, ClientSession, ClientTimeout
+import yaml
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, TraceConfig
 from aiohttp.web import Request, Response, StreamResponse
 
 # Configure logging
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format=LOG_FORMAT
 )
 logger = logging.getLogger(__name__)
 
@@ -62,6 +92,15 @@ ALWAYS_FORWARD_PATHS = [
     '/api/2.0/',  # Databricks management API
 ]
 
+# Response headers that only apply to the upstream connection
+HOP_BY_HOP_RESPONSE_HEADERS = ('connection', 'keep-alive', 'transfer-encoding')
+
+# Path prefix reserved for the proxy's own endpoints (never forwarded upstream)
+CONTROL_PATH_PREFIX = '/__proxy/'
+
+# Largest request body the proxy will buffer in memory (only when a feature needs the whole body)
+MAX_BUFFERED_BODY_SIZE = 256 * 1024 * 1024
+
 
 class ErrorMode(Enum):
     """Error injection modes."""
@@ -71,6 +110,403 @@ class ErrorMode(Enum):
     SERVER_ERROR = 4
 
 
+class LatencyMode(Enum):
+    """Latency injection modes."""
+    HEADER_DELAY = 1  # Delay before the response headers are sent
+    FIRST_TOKEN_DELAY = 2  # Delay between SSE headers and the first chunk
+    CHUNK_DELAY = 3  # Delay before every SSE chunk
+
+
+# Command letters for latency modes
+LATENCY_COMMANDS = {
+    'l': LatencyMode.HEADER_DELAY,
+    't': LatencyMode.FIRST_TOKEN_DELAY,
+    'k': LatencyMode.CHUNK_DELAY,
+}
+
+
+class StreamFaultMode(Enum):
+    """Mid-stream fault modes for SSE responses."""
+    ABORT = 1  # Close the connection mid-stream
+    STALL = 2  # Stop sending, but keep the connection open
+    MALFORMED = 3  # Insert a data: line that is not valid JSON
+    DUPLICATE = 4  # Send an event twice
+    ERROR_EVENT = 5  # Send the provider's error event and end the stream
+
+
+# Names for stream fault modes in "s" commands
+STREAM_FAULT_COMMANDS = {
+    'abort': StreamFaultMode.ABORT,
+    'stall': StreamFaultMode.STALL,
+    'malformed': StreamFaultMode.MALFORMED,
+    'duplicate': StreamFaultMode.DUPLICATE,
+    'error': StreamFaultMode.ERROR_EVENT,
+}
+
+
+def parse_duration(value: str) -> float:
+    """Parse a duration such as '250ms', '1.5s', '10m', '24h' or '2' (seconds) into seconds."""
+    value = value.strip().lower()
+    if value.endswith('ms'):
+        seconds = float(value[:-2]) / 1000.0
+    elif value.endswith('s'):
+        seconds = float(value[:-1])
+    elif value.endswith('m'):
+        seconds = float(value[:-1]) * 60.0
+    elif value.endswith('h'):
+        seconds = float(value[:-1]) * 3600.0
+    else:
+        seconds = float(value)
+    if seconds < 0.0:
+        raise ValueError(f"Negative duration: {value}")
+    return seconds
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration in seconds for display."""
+    if seconds < 1.0:
+        return f"{seconds * 1000:.0f}ms"
+    return f"{seconds:g}s"
+
+
+# Bandwidth units, in bytes per second; bit rates are what links are usually quoted in
+RATE_UNITS = (('gbps', 1e9 / 8), ('mbps', 1e6 / 8), ('kbps', 1e3 / 8), ('bps', 1 / 8),
+              ('gb/s', 1024 ** 3), ('mb/s', 1024 ** 2), ('kb/s', 1024), ('b/s', 1))
+
+
+def parse_rate(value: str) -> float:
+    """Parse a bandwidth such as '64kbps', '1.5mbps', '128kb/s' or '8000' (bytes/s) into bytes per second."""
+    value = value.strip().lower()
+    multiplier = 1.0
+    for suffix, suffix_multiplier in RATE_UNITS:
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+            multiplier = suffix_multiplier
+            break
+    rate = float(value) * multiplier
+    if rate <= 0.0:
+        raise ValueError("bandwidth must be positive")
+    return rate
+
+
+def format_rate(rate: float) -> str:
+    """Format a bandwidth in bytes per second for display, in bits per second."""
+    bits = rate * 8
+    for suffix, scale in (('Gbps', 1e9), ('Mbps', 1e6), ('kbps', 1e3)):
+        if bits >= scale:
+            return f"{bits / scale:g}{suffix}"
+    return f"{bits:g}bps"
+
+
+class DelaySpec:
+    """
+    A delay to inject: either fixed or sampled from a distribution.
+
+    Supported forms:
+        2s, 500ms, 1.5         - fixed delay
+        500ms-3s               - uniform between the two bounds
+        exp:2s                 - exponential with the given mean
+        lognormal:500ms,8s     - lognormal with the given median and p99 (realistic slow tail)
+    """
+
+    # z-score of the 99th percentile of the standard normal distribution
+    P99_Z = 2.326
+
+    def __init__(self, kind: str, first: float, second: float = 0.0):
+        """
+        Initialize the delay spec.
+
+        Args:
+            kind: One of 'fixed', 'uniform', 'exp', 'lognormal'
+            first: Fixed delay, lower bound, mean or median (seconds)
+            second: Upper bound or p99 (seconds), unused for fixed/exp
+        """
+        self.kind = kind
+        self.first = first
+        self.second = second
+
+    @classmethod
+    def parse(cls, spec: str) -> 'DelaySpec':
+        """Parse a delay spec string. Raises ValueError if invalid."""
+        spec = spec.strip().lower()
+        if spec.startswith('exp:'):
+            return cls('exp', parse_duration(spec[4:]))
+        if spec.startswith('lognormal:'):
+            median_str, _, p99_str = spec[10:].partition(',')
+            median, p99 = parse_duration(median_str), parse_duration(p99_str)
+            if median <= 0.0 or p99 < median:
+                raise ValueError("lognormal needs 0 < median <= p99")
+            return cls('lognormal', median, p99)
+        if '-' in spec:
+            low_str, _, high_str = spec.partition('-')
+            low, high = parse_duration(low_str), parse_duration(high_str)
+            if high < low:
+                raise ValueError("range upper bound is below lower bound")
+            return cls('uniform', low, high)
+        return cls('fixed', parse_duration(spec))
+
+    def sample(self, rng: random.Random) -> float:
+        """Sample a delay in seconds from the given random number generator."""
+        if self.kind == 'uniform':
+            return rng.uniform(self.first, self.second)
+        if self.kind == 'exp':
+            return rng.expovariate(1.0 / self.first) if self.first > 0.0 else 0.0
+        if self.kind == 'lognormal':
+            sigma = math.log(self.second / self.first) / self.P99_Z
+            return rng.lognormvariate(math.log(self.first), sigma)
+        return self.first
+
+    def __str__(self) -> str:
+        if self.kind == 'uniform':
+            return f"{format_duration(self.first)}-{format_duration(self.second)}"
+        if self.kind == 'exp':
+            return f"exp(mean {format_duration(self.first)})"
+        if self.kind == 'lognormal':
+            return f"lognormal(median {format_duration(self.first)}, p99 {format_duration(self.second)})"
+        return format_duration(self.first)
+
+
+class StreamFaultSpec:
+    """
+    A mid-stream fault and where in the stream it fires.
+
+    Supported forms:
+        abort          - after the first SSE event
+        abort:5        - after 5 SSE events
+        stall:10kb     - after 10 KB of the stream (also b and mb)
+    """
+
+    def __init__(self, mode: StreamFaultMode, after: int = 1, unit: str = 'events'):
+        """
+        Initialize the stream fault spec.
+
+        Args:
+            mode: The fault to inject
+            after: Number of SSE events or bytes to relay before the fault
+            unit: 'events' or 'bytes'
+        """
+        self.mode = mode
+        self.after = after
+        self.unit = unit
+
+    @classmethod
+    def parse(cls, spec: str) -> 'StreamFaultSpec':
+        """Parse a stream fault spec string. Raises ValueError if invalid."""
+        name, _, after_str = spec.strip().lower().partition(':')
+        if name not in STREAM_FAULT_COMMANDS:
+            raise ValueError(f"unknown stream fault '{name}', use {', '.join(STREAM_FAULT_COMMANDS)}")
+        mode = STREAM_FAULT_COMMANDS[name]
+        if not after_str:
+            return cls(mode)
+        unit = 'events'
+        multiplier = 1
+        for suffix, suffix_multiplier in (('kb', 1024), ('mb', 1024 * 1024), ('b', 1)):
+            if after_str.endswith(suffix):
+                unit = 'bytes'
+                multiplier = suffix_multiplier
+                after_str = after_str[:-len(suffix)]
+                break
+        after = int(float(after_str) * multiplier)
+        if after < 0:
+            raise ValueError("position must not be negative")
+        if mode == StreamFaultMode.DUPLICATE and after == 0:
+            raise ValueError("duplicate needs at least one event to repeat")
+        return cls(mode, after, unit)
+
+    def __str__(self) -> str:
+        name = next(name for name, mode in STREAM_FAULT_COMMANDS.items() if mode == self.mode)
+        if self.unit == 'bytes':
+            return f"{name} after {self.after} bytes"
+        return f"{name} after {self.after} event{'s' if self.after != 1 else ''}"
+
+
+class FaultRule:
+    """An active error or latency injection with count/percentage trigger semantics."""
+
+    def __init__(self, fault, count: int = 1, percentage: float = 0.0):
+        """
+        Initialize the rule.
+
+        Args:
+            fault: The ErrorMode, DelaySpec or StreamFaultSpec to inject
+            count: Number of requests to affect (0 with percentage mode)
+            percentage: Percentage of requests to affect (0.0-1.0, 0.0 for count mode)
+        """
+        self.fault = fault
+        self.count = count
+        self.percentage = percentage
+
+    def fire(self, rng: random.Random) -> bool:
+        """Decide whether this request is affected, consuming a count if so."""
+        if self.percentage > 0.0:
+            return rng.random() < self.percentage
+        if self.count > 0:
+            self.count -= 1
+            return True
+        return False
+
+    def is_exhausted(self) -> bool:
+        """Whether the rule can never fire again."""
+        return self.percentage == 0.0 and self.count == 0
+
+    def describe(self) -> str:
+        """Describe the rule for status output."""
+        fault = self.fault.name if isinstance(self.fault, ErrorMode) else str(self.fault)
+        if self.percentage > 0.0:
+            return f"{fault} ({self.percentage*100:.0f}%)"
+        return f"{fault} ({self.count} remaining)"
+
+    def to_dict(self) -> dict:
+        """Serialize the rule for the control API."""
+        return {'count': self.count, 'percentage': self.percentage}
+
+
+class SharedFaultState:
+    """
+    Fault state shared by the --workers processes.
+
+    The rules are published as a JSON snapshot with a version number, which each worker
+    reloads when the version changes. Remaining counts live in shared counter slots that
+    are only decremented under the lock, so count mode ("c 4") stays exact across workers.
+    Each slot has a generation, so a worker holding a stale snapshot can never consume a
+    count from a slot that has since been reused for another rule.
+    """
+
+    MAX_SLOTS = 4096
+    SNAPSHOT_SIZE = 1024 * 1024
+
+    def __init__(self, workers: int):
+        self.lock = multiprocessing.Lock()
+        # Requests handled by each worker, written only by that worker
+        self.request_counts = multiprocessing.RawArray('Q', workers)
+        self.version = multiprocessing.RawValue('Q', 0)
+        self.snapshot_length = multiprocessing.RawValue('I', 0)
+        self.snapshot = multiprocessing.RawArray('c', self.SNAPSHOT_SIZE)
+        self.counts = multiprocessing.RawArray('q', self.MAX_SLOTS)
+        self.generations = multiprocessing.RawArray('Q', self.MAX_SLOTS)
+        self.next_slot = multiprocessing.RawValue('I', 0)
+
+    def allocate(self, count: int, live_slots: set[int]) -> tuple[int, int]:
+        """
+        Allocate a counter slot, round robin so freed slots are reused as late as possible.
+
+        Must be called with the lock held.
+
+        Returns:
+            Tuple of (slot, generation)
+        """
+        for _ in range(self.MAX_SLOTS):
+            slot = self.next_slot.value
+            self.next_slot.value = (slot + 1) % self.MAX_SLOTS
+            if slot not in live_slots:
+                self.generations[slot] += 1
+                self.counts[slot] = count
+                return (slot, self.generations[slot])
+        raise ValueError(f"Too many active fault rules (limit {self.MAX_SLOTS})")
+
+    def take(self, slot: int, generation: int) -> bool:
+        """Consume one count from a slot, if the slot still belongs to the rule and has counts left."""
+        with self.lock:
+            if self.generations[slot] == generation and self.counts[slot] > 0:
+                self.counts[slot] -= 1
+                return True
+        return False
+
+    def remaining(self, slot: int, generation: int) -> int:
+        """Counts left in a slot (0 once the slot was reused for another rule)."""
+        if self.generations[slot] != generation:
+            return 0
+        return self.counts[slot]
+
+    def publish(self, data: bytes):
+        """Publish a new snapshot. Must be called with the lock held."""
+        if len(data) > self.SNAPSHOT_SIZE:
+            raise ValueError(f"Fault state too large to share ({len(data)} bytes)")
+        self.snapshot[:len(data)] = data
+        self.snapshot_length.value = len(data)
+        self.version.value += 1
+
+    def read(self) -> tuple[int, bytes]:
+        """Read the current (version, snapshot). Must be called with the lock held."""
+        return (self.version.value, self.snapshot[:self.snapshot_length.value])
+
+
+class SharedFaultRule(FaultRule):
+    """A count-mode fault rule whose remaining count lives in SharedFaultState."""
+
+    def __init__(self, fault, shared: SharedFaultState, slot: int, generation: int):
+        self.fault = fault
+        self.percentage = 0.0
+        self.shared = shared
+        self.slot = slot
+        self.generation = generation
+
+    @property
+    def count(self) -> int:
+        return self.shared.remaining(self.slot, self.generation)
+
+    def fire(self, rng: random.Random) -> bool:
+        """Decide whether this request is affected, consuming a shared count if so."""
+        return self.shared.take(self.slot, self.generation)
+
+
+# A fault target is (provider, path prefix, routing rule name); None matches anything
+FaultTarget = tuple[Optional[str], Optional[str], Optional[str]]
+GLOBAL_TARGET: FaultTarget = (None, None, None)
+
+
+def format_target(target: FaultTarget) -> str:
+    """Format a fault target for display."""
+    provider, path, rule = target
+    if target == GLOBAL_TARGET:
+        return 'all requests'
+    return ' '.join(part for part in (provider, f"{path}*" if path else None, f"rule {rule}" if rule else None) if part)
+
+
+class FaultProfile:
+    """The error and latency rules that apply to one fault target."""
+
+    def __init__(self):
+        self.error: Optional[FaultRule] = None
+        self.latency: dict[LatencyMode, FaultRule] = {}
+        self.stream: Optional[FaultRule] = None
+
+    def rules(self) -> list[FaultRule]:
+        """All active rules of the profile."""
+        rules = [*self.latency.values()]
+        if self.error is not None:
+            rules.append(self.error)
+        if self.stream is not None:
+            rules.append(self.stream)
+        return rules
+
+    def is_empty(self) -> bool:
+        """Whether the profile has no active rules."""
+        return self.error is None and not self.latency and self.stream is None
+
+    def to_dict(self, target: FaultTarget) -> dict:
+        """Serialize the profile for the control API."""
+        provider, path, rule = target
+        error = None
+        if self.error is not None:
+            error = {'mode': self.error.fault.name, **self.error.to_dict()}
+        stream = None
+        if self.stream is not None:
+            spec = self.stream.fault
+            stream = {'mode': spec.mode.name, 'after': spec.after, 'unit': spec.unit, **self.stream.to_dict()}
+        return {
+            'provider': provider,
+            'path': path,
+            'rule': rule,
+            'error': error,
+            'latency': {
+                mode.name: {'delay': str(rule.fault), **rule.to_dict()}
+                for mode, rule in self.latency.items()
+            },
+            'stream': stream,
+        }
+
+
 # Error responses for each provider and error type
 ERROR_CONFIGS = {
     'openai': {
@@ -253,241 +689,2936 @@ ERROR_CONFIGS = {
 }
 
 
-class ErrorProxy:
-    """HTTP proxy that can inject errors into provider responses."""
-    
-    def __init__(self):
-        """Initialize the error proxy."""
-        self.error_mode = ErrorMode.NO_ERROR
-        self.error_count = 0  # Remaining errors to inject (0 = unlimited/percentage mode)
-        self.error_percentage = 0.0  # Percentage of requests to error (0.0 = count mode)
-        self.request_count = 0
-        self.session: Optional[ClientSession] = None
-        self.lock = threading.Lock()
-        
-    def set_error_mode(self, mode: ErrorMode, count: int = 1, percentage: float = 0.0):
+# End of an SSE event: a blank line (Google streams use CRLF line endings)
+SSE_EVENT_BOUNDARY = re.compile(rb'\r?\n\r?\n')
+
+# A truncated event whose data: line is not valid JSON
+MALFORMED_SSE_EVENT = b'data: {"id": "proxy-malformed", "choices": [{"delta": {"content": "\n\n'
+
+# How often a stalled stream checks whether the client has given up (seconds)
+STALL_POLL_INTERVAL = 0.1
+
+
+def stream_error_event(provider: str) -> bytes:
+    """Build the SSE event a provider sends when a stream fails partway through."""
+    body = ERROR_CONFIGS.get(provider, ERROR_CONFIGS['openai'])[ErrorMode.SERVER_ERROR]['body']
+    event = f"data: {json.dumps(body)}\n\n"
+    # Anthropic names its events; an "error" event carries the same body as an error response
+    if provider == 'anthropic':
+        event = f"event: error\n{event}"
+    return event.encode('utf-8')
+
+
+async def send_chunk(response: StreamResponse, data: bytes, stats: 'RequestStats'):
+    """Write data to the client, paced by the request's bandwidth limit if it has one."""
+    if stats.pacer is not None:
+        await stats.pacer.send(response, data)
+    else:
+        await response.write(data)
+    stats.bytes_out += len(data)
+
+
+class StreamFaultInjector:
+    """
+    Applies a stream fault to one SSE response while it is relayed.
+
+    Faults fire at an SSE event boundary, so an inserted or repeated event never lands in
+    the middle of another one. Byte positions for abort and stall cut the stream at exactly
+    that byte instead, mid-event, like a dropped connection would. Until the fault fires the
+    stream is scanned for event boundaries; after that chunks pass through untouched.
+    """
+
+    def __init__(self, spec: StreamFaultSpec, request: Request, provider: str, on_fire: Callable[[], None]):
         """
-        Set the error injection mode.
-        
+        Initialize the injector.
+
         Args:
-            mode: The error mode to use
-            count: Number of errors to inject (default 1, 0 for unlimited)
-            percentage: Percentage of requests to error (0.0-1.0, 0.0 for count mode)
+            spec: The fault to inject
+            request: The client request, whose connection abort and stall act on
+            provider: Provider whose error event format to use
+            on_fire: Called when the fault fires
         """
-        with self.lock:
-            self.error_mode = mode
-            self.error_count = count
-            self.error_percentage = percentage
-            
-    def should_inject_error(self) -> bool:
+        self.spec = spec
+        self.request = request
+        self.provider = provider
+        self.on_fire = on_fire
+        self.offset = 0  # Stream bytes seen so far
+        self.events = 0  # Complete SSE events seen so far
+        self.pending = b''  # Start of the current, incomplete event
+        self.fired = False
+        self.ended = False  # The fault ended the stream
+
+    def _split(self, chunk: bytes) -> tuple[bytes, Optional[bytes], bytes]:
         """
-        Determine if we should inject an error for this request.
-        
+        Split a chunk at the fault position.
+
         Returns:
-            True if an error should be injected, False otherwise
+            Tuple of (bytes before the fault, last complete event or None if the fault
+            does not fire in this chunk, bytes after the fault)
         """
-        with self.lock:
-            if self.error_mode == ErrorMode.NO_ERROR:
-                return False
-                
-            # Percentage mode
-            if self.error_percentage > 0.0:
-                return random.random() < self.error_percentage
-            
-            # Count mode
-            if self.error_count > 0:
-                self.error_count -= 1
-                # If this was the last error, switch back to NO_ERROR
-                if self.error_count == 0:
-                    self.error_mode = ErrorMode.NO_ERROR
-                return True
-            elif self.error_count == 0 and self.error_percentage == 0.0:
-                # Count reached zero, switch back to NO_ERROR
-                self.error_mode = ErrorMode.NO_ERROR
-                return False
+        spec = self.spec
+        start = self.offset
+        self.offset += len(chunk)
+        if spec.after == 0:
+            return (b'', b'', chunk)
+        if spec.unit == 'bytes' and spec.mode in (StreamFaultMode.ABORT, StreamFaultMode.STALL):
+            if self.offset < spec.after:
+                return (chunk, None, b'')
+            cut = spec.after - start
+            return (chunk[:cut], b'', chunk[cut:])
 
-            return False
-            
-    def get_error_mode(self) -> ErrorMode:
-        """Get the current error injection mode."""
-        with self.lock:
-            return self.error_mode
-    
-    def get_error_config(self) -> tuple[ErrorMode, int, float]:
-        """Get the current error configuration."""
-        with self.lock:
-            return (self.error_mode, self.error_count, self.error_percentage)
-        
-    async def start_session(self):
-        """Start the aiohttp client session."""
-        timeout = ClientTimeout(total=600)  # Match provider timeout
-        self.session = ClientSession(timeout=timeout)
-        
-    async def close_session(self):
-        """Close the aiohttp client session."""
-        if self.session:
-            await self.session.close()
-            
-    def detect_provider(self, request: Request) -> str:
-        """
-        Detect which provider this request is for based on headers and path.
+        buffer = self.pending + chunk
+        base = start - len(self.pending)  # Stream offset of the buffer
+        event_start = 0
+        for match in SSE_EVENT_BOUNDARY.finditer(buffer):
+            end = match.end()
+            self.events += 1
+            if (self.events >= spec.after) if spec.unit == 'events' else (base + end >= spec.after):
+                cut = end - len(self.pending)
+                return (chunk[:cut], buffer[event_start:end], chunk[cut:])
+            event_start = end
+        self.pending = buffer[event_start:]
+        return (chunk, None, b'')
 
-        Args:
-            request: The incoming HTTP request
+    async def write(self, response: StreamResponse, chunk: bytes, stats: 'RequestStats') -> bool:
+        """
+        Write a chunk to the client, injecting the fault when its position is reached.
 
         Returns:
-            Provider name
-        """
-        path = request.path.lower()
-
-        # Check for databricks-specific paths first (before header checks)
-        if '/serving-endpoints/' in path or '/api/2.0/' in path or '/oidc/' in path:
-            return 'databricks'
-
-        # Check for provider-specific headers
-        if 'x-api-key' in request.headers:
-            return 'anthropic'
-        if 'x-goog-api-key' in request.headers:
-            return 'google'
-        if 'authorization' in request.headers:
-            auth = request.headers['authorization'].lower()
-            if 'bearer' in auth:
-                # Most providers use bearer tokens, check path for hints
-                if 'anthropic' in path or 'messages' in path:
-                    return 'anthropic'
-                if 'google' in path or 'generativelanguage' in path:
-                    return 'google'
-                if 'openrouter' in path:
-                    return 'openrouter'
-                if 'tetrate' in path:
-                    return 'tetrate'
-                if 'databricks' in path:
-                    return 'databricks'
-                # Default to openai for bearer tokens
-                return 'openai'
-
-        # Default to openai if we can't determine
-        return 'openai'
-        
-    def should_always_forward(self, request: Request) -> bool:
+            False once the fault has ended the stream; stop relaying and call finish()
         """
-        Check if this request should always be forwarded (never injected with errors).
+        if self.fired:
+            await send_chunk(response, chunk, stats)
+            return True
+        head, event, tail = self._split(chunk)
+        if head:
+            await send_chunk(response, head, stats)
+        if event is None:
+            return True
 
-        Args:
-            request: The incoming HTTP request
+        self.fired = True
+        self.pending = b''
+        self.on_fire()
+        mode = self.spec.mode
+        if mode == StreamFaultMode.ABORT:
+            # Close without the final chunk of the chunked encoding, so the client sees a truncated body
+            if self.request.transport is not None:
+                self.request.transport.close()
+            self.ended = True
+            return False
+        if mode == StreamFaultMode.STALL:
+            self.ended = True
+            return False
+        if mode == StreamFaultMode.ERROR_EVENT:
+            await send_chunk(response, stream_error_event(self.provider), stats)
+            self.ended = True
+            return False
+        await send_chunk(response, MALFORMED_SSE_EVENT if mode == StreamFaultMode.MALFORMED else event, stats)
+        if tail:
+            await send_chunk(response, tail, stats)
+        return True
 
-        Returns:
-            True if request should always be forwarded
-        """
-        path = request.path
-        for forward_path in ALWAYS_FORWARD_PATHS:
-            if forward_path in path:
-                return True
-        return False
+    async def finish(self, response: StreamResponse):
+        """End the response: normally, by stalling until the client gives up, or not at all after an abort."""
+        if not self.ended or self.spec.mode == StreamFaultMode.ERROR_EVENT:
+            await response.write_eof()
+        elif self.spec.mode == StreamFaultMode.STALL:
+            while self.request.transport is not None and not self.request.transport.is_closing():
+                await asyncio.sleep(STALL_POLL_INTERVAL)
+
+
+# Built-in routing rules, in the same format as a --rules file. Paths are matched lowercased.
+# They reproduce the original detection: databricks paths first, then provider-specific
+# API key headers, then path hints for bearer tokens, and openai when nothing matches.
+DEFAULT_ROUTING_RULES = [
+    {'name': 'always-forward',
+     'match': {'path_regex': '|'.join(re.escape(path) for path in ALWAYS_FORWARD_PATHS)},
+     'forward_only': True},
+    {'name': 'databricks-paths', 'match': {'path_regex': r'/serving-endpoints/|/api/2\.0/|/oidc/'},
+     'provider': 'databricks'},
+    {'name': 'anthropic-key', 'match': {'headers': {'x-api-key': True}}, 'provider': 'anthropic'},
+    {'name': 'google-key', 'match': {'headers': {'x-goog-api-key': True}}, 'provider': 'google'},
+    {'name': 'bearer-anthropic', 'match': {'path_regex': 'anthropic|messages', 'headers': {'authorization': 'bearer'}},
+     'provider': 'anthropic'},
+    {'name': 'bearer-google', 'match': {'path_regex': 'google|generativelanguage', 'headers': {'authorization': 'bearer'}},
+     'provider': 'google'},
+    {'name': 'bearer-openrouter', 'match': {'path_regex': 'openrouter', 'headers': {'authorization': 'bearer'}},
+     'provider': 'openrouter'},
+    {'name': 'bearer-tetrate', 'match': {'path_regex': 'tetrate', 'headers': {'authorization': 'bearer'}},
+     'provider': 'tetrate'},
+    {'name': 'bearer-databricks', 'match': {'path_regex': 'databricks', 'headers': {'authorization': 'bearer'}},
+     'provider': 'databricks'},
+]
 
-    def get_target_url(self, request: Request, provider: str) -> str:
+# Provider used when no routing rule sets one
+DEFAULT_PROVIDER = 'openai'
+
+
+class RoutingRule:
+    """
+    One entry of the routing table.
+
+    A rule matches on a path prefix or regex (not both) and on header predicates, where
+    true means the header must be present, false that it must be absent, and a string is a
+    case-insensitive regex the value must contain. A matching rule can set the provider,
+    mark the request forward-only (never faulted), and carry fault commands that apply to
+    the requests it matches.
+    """
+
+    def __init__(self, name: str, path_prefix: Optional[str] = None, path_regex: Optional[str] = None,
+                 headers: Optional[dict] = None, provider: Optional[str] = None,
+                 forward_only: Optional[bool] = None, faults: tuple[str, ...] = (), builtin: bool = False):
         """
-        Construct the target URL for the provider.
+        Initialize the rule. Raises ValueError if it is invalid.
 
         Args:
-            request: The incoming HTTP request
-            provider: The detected provider name
-
-        Returns:
-            Full target URL
+            name: Rule name, used to target faults at the rule
+            path_prefix: Path prefix to match (lowercased)
+            path_regex: Regex searched for in the lowercased path
+            headers: Header predicates by header name
+            provider: Provider that matching requests are routed to
+            forward_only: Whether matching requests are always forwarded without faults
+            faults: Fault commands (e.g. "r 30%") applied to matching requests
+            builtin: Whether this is one of the built-in rules (those are not fault targets)
         """
-        # Check for provider-specific real host in environment
-        real_host_env = f"{provider.upper()}_REAL_HOST"
-        base_host = os.environ.get(real_host_env)
+        if path_prefix is not None and path_regex is not None:
+            raise ValueError(f"rule '{name}' has both path_prefix and path_regex")
+        if path_prefix is not None and not path_prefix.startswith('/'):
+            raise ValueError(f"rule '{name}' path_prefix must start with /")
+        if provider is not None and provider not in PROVIDER_HOSTS:
+            raise ValueError(f"rule '{name}' has unknown provider '{provider}'. Use one of: {', '.join(PROVIDER_HOSTS)}")
+        self.name = name
+        self.path_prefix = path_prefix.lower() if path_prefix is not None else None
+        try:
+            self.path_regex = re.compile(path_regex) if path_regex is not None else None
+            self.headers = [
+                (header.lower(), expected if isinstance(expected, bool) else re.compile(str(expected), re.IGNORECASE))
+                for header, expected in (headers or {}).items()
+            ]
+        except re.error as e:
+            raise ValueError(f"rule '{name}' has an invalid regex: {e}")
+        self.provider = provider
+        self.forward_only = forward_only
+        self.faults = tuple(faults)
+        self.builtin = builtin
 
-        # If no provider-specific real host and this is an always-forward path,
-        # check if ANY *_REAL_HOST is set (for auth endpoints where provider detection might fail)
-        if base_host is None and self.should_always_forward(request):
-            for provider_name in PROVIDER_HOSTS.keys():
-                env_var = f"{provider_name.upper()}_REAL_HOST"
-                if env_var in os.environ:
-                    base_host = os.environ[env_var]
-                    logger.info(f"Using {env_var} for always-forward path")
-                    break
+    @classmethod
+    def from_dict(cls, entry: dict, index: int, builtin: bool = False) -> 'RoutingRule':
+        """Build a rule from a rules file entry. Raises ValueError if it is invalid."""
+        if not isinstance(entry, dict):
+            raise ValueError(f"rule #{index + 1} must be a mapping")
+        name = str(entry.get('name') or f"rule-{index + 1}")
+        match = entry.get('match') or {}
+        unknown = set(entry) - {'name', 'match', 'provider', 'forward_only', 'fault'}
+        unknown |= set(match) - {'path_prefix', 'path_regex', 'headers'}
+        if unknown:
+            raise ValueError(f"rule '{name}' has unknown keys: {', '.join(sorted(unknown))}")
+        faults = entry.get('fault') or []
+        if isinstance(faults, str):
+            faults = [faults]
+        provider = entry.get('provider')
+        return cls(
+            name,
+            path_prefix=match.get('path_prefix'),
+            path_regex=match.get('path_regex'),
+            headers=match.get('headers'),
+            provider=provider.lower() if provider else None,
+            forward_only=entry.get('forward_only'),
+            faults=tuple(str(fault) for fault in faults),
+            builtin=builtin
+        )
 
-        # Fall back to default provider host
-        if base_host is None:
-            base_host = PROVIDER_HOSTS.get(provider, PROVIDER_HOSTS['openai'])
+    def headers_match(self, headers: dict[str, Optional[str]]) -> bool:
+        """Check the header predicates against the request headers (keyed by lowercase name)."""
+        for header, expected in self.headers:
+            value = headers.get(header)
+            if expected is True or expected is False:
+                if (value is not None) != expected:
+                    return False
+            elif value is None or not expected.search(value):
+                return False
+        return True
 
-        path = request.path
-        query = request.query_string
 
-        url = f"{base_host}{path}"
-        if query:
-            url = f"{url}?{query}"
+class RouteDecision:
+    """The outcome of routing one request."""
 
-        return url
-        
-    def _format_status_line(self) -> str:
-        """Format a one-line status indicator."""
-        mode, count, percentage = self.get_error_config()
-        mode_symbols = {
-            ErrorMode.NO_ERROR: "✅",
-            ErrorMode.CONTEXT_LENGTH: "📏",
-            ErrorMode.RATE_LIMIT: "⏱️",
-            ErrorMode.SERVER_ERROR: "💥"
-        }
+    __slots__ = ('provider', 'forward_only', 'rule')
 
-        symbol = mode_symbols.get(mode, "❓")
-        mode_name = mode.name.replace('_', ' ').title()
+    def __init__(self, provider: str, forward_only: bool, rule: Optional[str]):
+        self.provider = provider
+        self.forward_only = forward_only
+        self.rule = rule  # First matching rules-file rule, used for rule-targeted faults
 
-        if mode == ErrorMode.NO_ERROR:
-            return f"{symbol} {mode_name}"
-        elif percentage > 0.0:
-            return f"{symbol} {mode_name} ({percentage*100:.0f}%)"
-        elif count > 0:
-            return f"{symbol} {mode_name} ({count} remaining)"
-        else:
-            return f"{symbol} {mode_name}"
 
-    async def handle_request(self, request: Request) -> Response:
+class RoutingTable:
+    """
+    Routing rules compiled for a single pass per request.
+
+    Path prefixes go into a character trie, so one walk over the path finds every prefix
+    rule that matches; path regexes share a combined prefilter, so a request that matches
+    none of them costs one regex search. The remaining candidates are then checked in table
+    order, where each decision (provider, forward-only, rule) comes from the first matching
+    rule that sets it. Decisions only depend on the path and the headers the rules mention,
+    so they are memoized on those.
+    """
+
+    # Trie node key holding the rules whose prefix ends at the node (path characters are never empty)
+    RULES_KEY = ''
+
+    # Number of (path, header values) decisions to memoize
+    CACHE_SIZE = 4096
+
+    def __init__(self, rules: list[RoutingRule]):
+        self.rules = rules
+        self.rule_names = {rule.name for rule in rules if not rule.builtin}
+        self._header_names = tuple(sorted({header for rule in rules for header, _ in rule.headers}))
+        self._cached_route = functools.lru_cache(maxsize=self.CACHE_SIZE)(self._route)
+        self._trie: dict = {}
+        self._regex_rules: list[int] = []
+        self._unconditional_rules: list[int] = []
+        for index, rule in enumerate(rules):
+            if rule.path_prefix is not None:
+                node = self._trie
+                for char in rule.path_prefix:
+                    node = node.setdefault(char, {})
+                node.setdefault(self.RULES_KEY, []).append(index)
+            elif rule.path_regex is not None:
+                self._regex_rules.append(index)
+            else:
+                self._unconditional_rules.append(index)
+        try:
+            self._regex_prefilter = re.compile('|'.join(
+                f"(?:{rules[index].path_regex.pattern})" for index in self._regex_rules
+            ))
+        except re.error:
+            # Patterns with global inline flags can't be combined; check them one by one
+            self._regex_prefilter = None
+
+    def _prefix_matches(self, path: str) -> list[int]:
+        """Walk the trie along the path, collecting the rules of every matching prefix."""
+        matches = list(self._trie.get(self.RULES_KEY, ()))
+        node = self._trie
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            matches.extend(node.get(self.RULES_KEY, ()))
+        return matches
+
+    def route(self, path: str, headers) -> RouteDecision:
         """
-        Handle an incoming HTTP request.
+        Route a request.
 
         Args:
-            request: The incoming HTTP request
+            path: The request path
+            headers: The request headers (case-insensitive mapping)
 
         Returns:
-            HTTP response (either proxied or error)
+            The routing decision
         """
-        self.request_count += 1
-        provider = self.detect_provider(request)
+        return self._cached_route(path, tuple(headers.get(header) for header in self._header_names))
 
-        logger.info(f"📨 Request #{self.request_count}: {request.method} {request.path} -> {provider}")
+    def _route(self, path: str, header_values: tuple[Optional[str], ...]) -> RouteDecision:
+        """Route a request given the values of the headers the rules mention."""
+        headers = dict(zip(self._header_names, header_values))
+        path = path.lower()
+        candidates = self._prefix_matches(path)
+        if self._regex_rules and (self._regex_prefilter is None or self._regex_prefilter.search(path)):
+            candidates.extend(self._regex_rules)
+        candidates.extend(self._unconditional_rules)
+        candidates.sort()
 
-        # Check if this request should always be forwarded
-        if self.should_always_forward(request):
-            logger.info(f"🔄 Always forwarding: {request.path}")
-        else:
-            # Capture the error mode BEFORE checking if we should inject (since that modifies state)
-            mode_before_check = self.get_error_mode()
+        provider = forward_only = rule_name = None
+        for index in candidates:
+            rule = self.rules[index]
+            if rule.path_regex is not None and not rule.path_regex.search(path):
+                continue
+            if not rule.headers_match(headers):
+                continue
+            if provider is None:
+                provider = rule.provider
+            if forward_only is None:
+                forward_only = rule.forward_only
+            if rule_name is None and not rule.builtin:
+                rule_name = rule.name
+            if provider is not None and forward_only is not None and (rule_name is not None or not self.rule_names):
+                break
+        return RouteDecision(provider or DEFAULT_PROVIDER, bool(forward_only), rule_name)
 
-            # Check if we should inject an error
-            should_error = self.should_inject_error()
-            if should_error:
-                # Use the mode captured before the check, since should_inject_error may have changed it
-                error_config = ERROR_CONFIGS.get(provider, ERROR_CONFIGS['openai']).get(
-                    mode_before_check, ERROR_CONFIGS['openai'][ErrorMode.SERVER_ERROR]
-                )
-                logger.warning(f"💥 Injecting {mode_before_check.name} error (status {error_config['status']}) for {provider}")
-                # Show status after the injection to reflect the updated state
-                logger.info(f"Status: {self._format_status_line()}")
-                return web.json_response(
-                    error_config['body'],
-                    status=error_config['status']
-                )
-        
-        # Forward the request to the actual provider
-        target_url = self.get_target_url(request, provider)
+
+def load_routing_table(rules_path: Optional[str] = None) -> RoutingTable:
+    """
+    Build the routing table from an optional YAML (or JSON) rules file and the built-in rules.
+
+    The file holds a "rules" list, checked before the built-in rules, and an optional
+    "include_defaults" flag (default true). Raises ValueError if the file is invalid.
+    """
+    rules = []
+    include_defaults = True
+    if rules_path is not None:
+        with open(rules_path, 'r', encoding='utf-8') as f:
+            try:
+                config = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ValueError(f"invalid YAML: {e}")
+        if not isinstance(config, dict) or not isinstance(config.get('rules', []), list):
+            raise ValueError("expected a mapping with a 'rules' list")
+        include_defaults = config.get('include_defaults', True)
+        rules = [RoutingRule.from_dict(entry, index) for index, entry in enumerate(config.get('rules', []))]
+        names = [rule.name for rule in rules]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"duplicate rule names: {', '.join(duplicates)}")
+    if include_defaults:
+        rules += [RoutingRule.from_dict(entry, index, builtin=True) for index, entry in enumerate(DEFAULT_ROUTING_RULES)]
+    return RoutingTable(rules)
+
+
+class CassetteMode(Enum):
+    """Cassette operating modes."""
+    RECORD = 1
+    REPLAY = 2
+
+
+def encode_bytes(data: bytes) -> dict:
+    """Encode bytes for JSON storage, keeping UTF-8 payloads human-readable."""
+    try:
+        return {'text': data.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'base64': base64.b64encode(data).decode('ascii')}
+
+
+def decode_bytes(entry: dict) -> bytes:
+    """Decode bytes previously stored with encode_bytes."""
+    if 'base64' in entry:
+        return base64.b64decode(entry['base64'])
+    return entry.get('text', '').encode('utf-8')
+
+
+def canonicalize_body(body: bytes) -> bytes:
+    """
+    Canonicalize a request body for fingerprinting.
+
+    JSON bodies are re-serialized with sorted keys and compact separators so that
+    key order and whitespace do not affect matching. Other bodies are used as-is.
+    """
+    if not body:
+        return b''
+    try:
+        parsed = json.loads(body)
+    except (ValueError, UnicodeDecodeError):
+        return body
+    return json.dumps(parsed, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def request_fingerprint(method: str, path: str, query_string: str, body: bytes) -> str:
+    """
+    Compute a normalized fingerprint for a request.
+
+    Headers are deliberately excluded so API keys and client versions never affect matching.
+
+    Args:
+        method: HTTP method
+        path: Request path
+        query_string: Raw query string
+        body: Raw request body
+
+    Returns:
+        Hex SHA-256 digest of the normalized request
+    """
+    query = '&'.join(sorted(query_string.split('&'))) if query_string else ''
+    hasher = hashlib.sha256()
+    for part in (method.upper().encode('utf-8'), path.encode('utf-8'), query.encode('utf-8')):
+        hasher.update(part)
+        hasher.update(b'\n')
+    hasher.update(canonicalize_body(body))
+    return hasher.hexdigest()
+
+
+# Request headers carrying provider credentials (OpenAI-style, Anthropic, Google, Azure)
+CREDENTIAL_HEADERS = ('authorization', 'x-api-key', 'x-goog-api-key', 'api-key')
+
+
+def credential_fingerprint(headers) -> str:
+    """
+    Compute a short digest of the credentials a request carries, so cached responses aren't
+    shared between clients with different API keys. Requests without credentials share one digest.
+    """
+    hasher = hashlib.sha256()
+    for name in CREDENTIAL_HEADERS:
+        hasher.update(headers.get(name, '').encode('utf-8'))
+        hasher.update(b'\n')
+    return hasher.hexdigest()[:16]
+
+
+class Cassette:
+    """
+    On-disk store of upstream exchanges for offline record/replay.
+
+    A cassette is a JSONL file with one exchange per line. Streaming (SSE) responses
+    are stored as a list of chunks, each with its delay relative to the response
+    headers, so replay preserves chunk boundaries and (optionally) timing.
+    """
+
+    def __init__(self, path: str, mode: CassetteMode, timing_scale: float = 0.0):
+        """
+        Initialize the cassette.
+
+        Args:
+            path: Path to the JSONL cassette file
+            mode: Whether to record new exchanges or replay existing ones
+            timing_scale: Multiplier for recorded delays during replay (0.0 = no delays)
+        """
+        self.path = path
+        self.mode = mode
+        self.timing_scale = timing_scale
+        self.exchanges: dict[str, list[dict]] = {}
+        self.replay_positions: dict[str, int] = {}
+        if mode == CassetteMode.REPLAY:
+            self.load()
+
+    def load(self):
+        """Load all exchanges from the cassette file, grouped by fingerprint."""
+        count = 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                exchange = json.loads(line)
+                self.exchanges.setdefault(exchange['fingerprint'], []).append(exchange)
+                count += 1
+        logger.info(f"📼 Loaded {count} exchanges ({len(self.exchanges)} unique requests) from {self.path}")
+
+    def lookup(self, fingerprint: str) -> Optional[dict]:
+        """
+        Find the next recorded exchange for a fingerprint.
+
+        Repeated recordings of the same request are served in recorded order and
+        cycle once exhausted, so a cassette can back an arbitrarily long load test.
+        """
+        exchanges = self.exchanges.get(fingerprint)
+        if not exchanges:
+            return None
+        position = self.replay_positions.get(fingerprint, 0)
+        self.replay_positions[fingerprint] = position + 1
+        return exchanges[position % len(exchanges)]
+
+    def record(self, exchange: dict):
+        """Append an exchange to the cassette file."""
+        # One unbuffered write per line, so concurrent --workers processes never interleave lines
+        line = (json.dumps(exchange, ensure_ascii=False) + '\n').encode('utf-8')
+        with open(self.path, 'ab', buffering=0) as f:
+            f.write(line)
+        self.exchanges.setdefault(exchange['fingerprint'], []).append(exchange)
+
+
+class InflightExchange:
+    """An upstream exchange in progress that identical concurrent requests follow instead of repeating."""
+
+    def __init__(self):
+        self.exchange: Optional[dict] = None  # Status and headers, once the response has started
+        self.chunks: list[tuple[float, bytes]] = []  # (delay, bytes) as they arrive
+        self.done = False
+        self.failed = False  # The upstream broke off mid-response, so the chunks are truncated
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        """Wake up the followers after the exchange changed."""
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def complete(self):
+        """Mark the exchange finished (successfully or not) and release the followers."""
+        if not self.done:
+            self.done = True
+            self.notify()
+
+    async def changed(self):
+        """Wait for the next change."""
+        await self._changed.wait()
+
+
+class ResponseCache:
+    """
+    Disk-backed response cache with LRU and TTL eviction and singleflight coalescing.
+
+    Each entry is a file named after its key holding an exchange in the cassette format,
+    so cached SSE streams keep their chunk boundaries and timings. The LRU index lives in
+    memory and is rebuilt from file modification times on startup. Concurrent identical
+    requests share one upstream call through an InflightExchange.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 1000, ttl: float = 0.0, timing_scale: float = 0.0,
+                 shared: bool = False):
+        """
+        Initialize the cache.
+
+        Args:
+            directory: Directory holding the cache entries (created if needed)
+            max_entries: Entries to keep before evicting the least recently used
+            ttl: Seconds an entry stays valid, 0 for no expiry
+            timing_scale: Multiplier for recorded delays when serving a hit (0 = as fast as possible)
+            shared: Other processes write to the same directory (--workers), so check the disk on an index miss
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.timing_scale = timing_scale
+        self.shared = shared
+        self.index: collections.OrderedDict[str, float] = collections.OrderedDict()  # key -> stored at (epoch)
+        self.inflight: dict[str, InflightExchange] = {}
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """Rebuild the index from the entries on disk, oldest first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                entries.append((os.path.getmtime(os.path.join(self.directory, name)), name[:-5]))
+        for stored_at, key in sorted(entries):
+            self.index[key] = stored_at
+        self._evict()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _is_expired(self, stored_at: float) -> bool:
+        return self.ttl > 0.0 and time.time() - stored_at > self.ttl
+
+    def _evict(self):
+        """Drop the least recently used entries beyond the size limit."""
+        while len(self.index) > self.max_entries:
+            key, _ = self.index.popitem(last=False)
+            self._remove_file(key)
+
+    def _remove_file(self, key: str):
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    async def get(self, key: str) -> Optional[dict]:
+        """
+        Look up a cached exchange.
+
+        Returns:
+            The exchange, or None on a miss (including expired and unreadable entries)
+        """
+        stored_at = self.index.get(key)
+        if stored_at is None:
+            if not self.shared:
+                return None
+            # Another worker may have stored it since this process built its index
+            try:
+                stored_at = os.path.getmtime(self._entry_path(key))
+            except OSError:
+                return None
+            self.index[key] = stored_at
+        if self._is_expired(stored_at):
+            del self.index[key]
+            self._remove_file(key)
+            return None
+        try:
+            exchange = await asyncio.to_thread(self._read, key)
+        except (OSError, ValueError):
+            self.index.pop(key, None)
+            return None
+        if key in self.index:
+            self.index.move_to_end(key)
+        return exchange
+
+    def _read(self, key: str) -> dict:
+        with open(self._entry_path(key), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    async def put(self, key: str, exchange: dict):
+        """Store an exchange, evicting old entries if the cache is full."""
+        await asyncio.to_thread(self._write, key, exchange)
+        self.index[key] = time.time()
+        self.index.move_to_end(key)
+        self._evict()
+
+    def _write(self, key: str, exchange: dict):
+        # Write to a temporary file and rename, so readers never see a partial entry
+        temp_path = f"{self._entry_path(key)}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(exchange, f, ensure_ascii=False)
+        os.replace(temp_path, self._entry_path(key))
+
+    def lead(self, key: str) -> Optional[InflightExchange]:
+        """Register an upstream call for the key, unless one is already in flight."""
+        if key in self.inflight:
+            return None
+        inflight = self.inflight[key] = InflightExchange()
+        return inflight
+
+    def finish(self, key: str, inflight: InflightExchange):
+        """Mark an upstream call as finished, release its followers and unregister it."""
+        inflight.complete()
+        if self.inflight.get(key) is inflight:
+            del self.inflight[key]
+
+
+# Words the mock upstream generates its completions from, one word per token
+MOCK_WORDS = ("the model response proxy token stream provider request error retry context function "
+              "tool result message assistant user goose session compaction limit").split()
+
+# Placeholder for the token text in streaming event templates
+MOCK_TOKEN_SLOT = '\x00token\x00'
+
+
+class MockCompletion:
+    """
+    A synthetic completion as ready-to-send bytes.
+
+    Streaming completions are split into events so they can be paced: the head events go out
+    at the first token, then one event per token, then the tail events.
+    """
+
+    def __init__(self, content_type: str, head: list[bytes], tokens: list[bytes], tail: list[bytes],
+                 token_count: int):
+        self.content_type = content_type
+        self.head = head
+        self.tokens = tokens
+        self.tail = tail
+        self.token_count = token_count
+
+    @property
+    def streaming(self) -> bool:
+        return self.content_type == 'text/event-stream'
+
+
+class MockUpstream:
+    """
+    Synthetic LLM upstream that answers completion requests without any network access.
+
+    Produces OpenAI-style chat completions (also used for OpenRouter, Tetrate and Databricks),
+    Anthropic messages and Google generateContent responses, streaming or not, with a
+    configurable length, time to first token and generation rate.
+    """
+
+    def __init__(self, tokens: int = 200, tokens_per_second: float = 0.0,
+                 first_token_delay: Optional[DelaySpec] = None):
+        """
+        Initialize the mock upstream.
+
+        Args:
+            tokens: Completion length in tokens (capped by the request's max tokens)
+            tokens_per_second: Generation rate, 0 for as fast as possible
+            first_token_delay: Time to first token, default none
+        """
+        self.tokens = tokens
+        self.tokens_per_second = tokens_per_second
+        self.first_token_delay = first_token_delay
+        self.completion_count = 0
+        self._token_text = [f" {word}" for word in MOCK_WORDS]
+        # JSON-encoded token strings, spliced into prebuilt event templates
+        self._token_json = [json.dumps(text) for text in self._token_text]
+
+    def describe(self) -> str:
+        """Describe the configuration for startup output."""
+        rate = f"{self.tokens_per_second:g} tokens/s" if self.tokens_per_second > 0.0 else "unthrottled"
+        return f"{self.tokens} tokens, {rate}, first token {self.first_token_delay or 'no delay'}"
+
+    def generation_time(self, tokens: int) -> float:
+        """Time to generate the given number of tokens after the first one."""
+        if self.tokens_per_second <= 0.0:
+            return 0.0
+        return tokens / self.tokens_per_second
+
+    def complete(self, provider: str, path: str, body: bytes) -> MockCompletion:
+        """
+        Build the completion for a request.
+
+        Args:
+            provider: The detected provider, which decides the response format
+            path: The request path (Google puts the model and streaming flag there, Databricks the endpoint)
+            body: The request body
+
+        Returns:
+            The completion to send
+        """
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+
+        self.completion_count += 1
+        prompt_tokens = max(len(body) // 4, 1)
+        if provider == 'google':
+            model_match = re.search(r'models/([^/:]+)', path)
+            model = model_match.group(1) if model_match else 'mock-model'
+            limit = (payload.get('generationConfig') or {}).get('maxOutputTokens')
+            streaming = ':streamgeneratecontent' in path.lower()
+        else:
+            model = payload.get('model')
+            if not model:
+                # Databricks names the serving endpoint in the path instead of the body
+                endpoint_match = re.search(r'/serving-endpoints/([^/]+)', path)
+                model = endpoint_match.group(1) if endpoint_match else 'mock-model'
+            limit = payload.get('max_completion_tokens') or payload.get('max_tokens')
+            streaming = payload.get('stream') is True
+
+        tokens = self.tokens
+        truncated = isinstance(limit, int) and 0 < limit < tokens
+        if truncated:
+            tokens = limit
+
+        if provider == 'anthropic':
+            build = self._anthropic
+        elif provider == 'google':
+            build = self._google
+        else:
+            build = self._openai
+        return build(model, prompt_tokens, tokens, truncated, streaming, payload)
+
+    def _text(self, tokens: int) -> str:
+        """The completion text for a non-streaming response."""
+        words = self._token_text
+        return ''.join(words[index % len(words)] for index in range(tokens)).lstrip()
+
+    @staticmethod
+    def _json(body: dict, tokens: int) -> MockCompletion:
+        return MockCompletion('application/json', [json.dumps(body).encode('utf-8')], [], [], tokens)
+
+    def _sse(self, head: list[str], token_event: str, tokens: int, tail: list[str]) -> MockCompletion:
+        """Build a streaming completion, expanding the token event template once per token."""
+        prefix, _, suffix = token_event.partition(json.dumps(MOCK_TOKEN_SLOT))
+        prefix, suffix = prefix.encode('utf-8'), suffix.encode('utf-8')
+        token_json = [token.encode('utf-8') for token in self._token_json]
+        first = json.dumps(self._token_text[0].lstrip()).encode('utf-8')
+        return MockCompletion(
+            'text/event-stream',
+            [event.encode('utf-8') for event in head],
+            [prefix + (token_json[index % len(token_json)] if index else first) + suffix for index in range(tokens)],
+            [event.encode('utf-8') for event in tail],
+            tokens
+        )
+
+    def _openai(self, model: str, prompt_tokens: int, tokens: int, truncated: bool,
+                streaming: bool, payload: dict) -> MockCompletion:
+        """OpenAI chat completion format (also OpenRouter, Tetrate and Databricks)."""
+        completion_id = f"chatcmpl-mock{self.completion_count}"
+        created = int(time.time())
+        finish_reason = 'length' if truncated else 'stop'
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': tokens,
+                 'total_tokens': prompt_tokens + tokens}
+        if not streaming:
+            return self._json({
+                'id': completion_id,
+                'object': 'chat.completion',
+                'created': created,
+                'model': model,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': self._text(tokens)},
+                    'finish_reason': finish_reason,
+                }],
+                'usage': usage,
+            }, tokens)
+
+        base = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model}
+
+        def event(choices: list, **extra) -> str:
+            return f"data: {json.dumps({**base, 'choices': choices, **extra})}\n\n"
+
+        tail = [event([{'index': 0, 'delta': {}, 'finish_reason': finish_reason}])]
+        if (payload.get('stream_options') or {}).get('include_usage'):
+            tail.append(event([], usage=usage))
+        tail.append("data: [DONE]\n\n")
+        return self._sse(
+            [event([{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])],
+            event([{'index': 0, 'delta': {'content': MOCK_TOKEN_SLOT}, 'finish_reason': None}]),
+            tokens,
+            tail
+        )
+
+    def _anthropic(self, model: str, prompt_tokens: int, tokens: int, truncated: bool,
+                   streaming: bool, payload: dict) -> MockCompletion:
+        """Anthropic messages format."""
+        message_id = f"msg_mock{self.completion_count}"
+        stop_reason = 'max_tokens' if truncated else 'end_turn'
+        if not streaming:
+            return self._json({
+                'id': message_id,
+                'type': 'message',
+                'role': 'assistant',
+                'model': model,
+                'content': [{'type': 'text', 'text': self._text(tokens)}],
+                'stop_reason': stop_reason,
+                'stop_sequence': None,
+                'usage': {'input_tokens': prompt_tokens, 'output_tokens': tokens},
+            }, tokens)
+
+        def event(event_type: str, data: dict) -> str:
+            return f"event: {event_type}\ndata: {json.dumps({'type': event_type, **data})}\n\n"
+
+        return self._sse(
+            [
+                event('message_start', {'message': {
+                    'id': message_id, 'type': 'message', 'role': 'assistant', 'model': model, 'content': [],
+                    'stop_reason': None, 'stop_sequence': None,
+                    'usage': {'input_tokens': prompt_tokens, 'output_tokens': 1},
+                }}),
+                event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}}),
+                event('ping', {}),
+            ],
+            event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': MOCK_TOKEN_SLOT}}),
+            tokens,
+            [
+                event('content_block_stop', {'index': 0}),
+                event('message_delta', {'delta': {'stop_reason': stop_reason, 'stop_sequence': None},
+                                        'usage': {'output_tokens': tokens}}),
+                event('message_stop', {}),
+            ]
+        )
+
+    def _google(self, model: str, prompt_tokens: int, tokens: int, truncated: bool,
+                streaming: bool, payload: dict) -> MockCompletion:
+        """Google generateContent format."""
+        finish_reason = 'MAX_TOKENS' if truncated else 'STOP'
+        usage = {'promptTokenCount': prompt_tokens, 'candidatesTokenCount': tokens,
+                 'totalTokenCount': prompt_tokens + tokens}
+
+        def candidate(text, **extra) -> dict:
+            return {'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0, **extra}
+
+        if not streaming:
+            return self._json({
+                'candidates': [candidate(self._text(tokens), finishReason=finish_reason)],
+                'usageMetadata': usage,
+                'modelVersion': model,
+            }, tokens)
+
+        def event(data: dict) -> str:
+            return f"data: {json.dumps(data)}\n\n"
+
+        return self._sse(
+            [],
+            event({'candidates': [candidate(MOCK_TOKEN_SLOT)], 'modelVersion': model}),
+            tokens,
+            [event({'candidates': [candidate('', finishReason=finish_reason)],
+                    'usageMetadata': usage, 'modelVersion': model})]
+        )
+
+
+# Built-in context windows in tokens, as (model glob, limit); the first match wins. Globs
+# are matched against the lowercased model name, with * on both ends where the name can be
+# embedded (Databricks endpoints, OpenRouter vendor prefixes).
+DEFAULT_CONTEXT_LIMITS = [
+    ('*gpt-4.1*', 1047576),
+    ('*gpt-4o*', 128000),
+    ('*gpt-4-turbo*', 128000),
+    ('*gpt-5*', 400000),
+    ('*claude*', 200000),
+    ('*gemini*', 1048576),
+    ('o1*', 200000),
+    ('o3*', 200000),
+    ('o4*', 200000),
+    ('openai/o*', 200000),
+    ('*', 128000),
+]
+
+# Prompt fields that hold text the model reads, across the provider request formats
+PROMPT_FIELDS = ('messages', 'system', 'contents', 'systemInstruction', 'system_instruction', 'tools',
+                 'input', 'instructions', 'prompt')
+
+# Keys and part types that mark an image, whose (base64) data says nothing about its token cost
+IMAGE_KEYS = frozenset(('image_url', 'inlineData', 'inline_data', 'image'))
+IMAGE_PART_TYPES = frozenset(('image', 'image_url', 'input_image'))
+
+# Provider-specific context length error messages, with the estimated and allowed token counts
+CONTEXT_LENGTH_MESSAGES = {
+    'openai': ("This model's maximum context length is {limit} tokens. However, your messages resulted "
+               "in {tokens} tokens. Please reduce the length of the messages."),
+    'anthropic': "prompt is too long: {tokens} tokens > {limit} maximum",
+    'google': "The input token count ({tokens}) exceeds the maximum number of tokens allowed ({limit}).",
+    'openrouter': "This model maximum context length is {limit} tokens, however you requested {tokens} tokens",
+    'tetrate': "Request exceeds maximum context length of {limit} tokens ({tokens} tokens requested)",
+    'databricks': ("The total number of tokens in the request exceeds the maximum allowed "
+                   "({tokens} > {limit})"),
+}
+
+
+def context_length_error(provider: str, tokens: int, limit: int) -> dict:
+    """
+    Build the provider's context length error for a prompt of the given size.
+
+    Returns:
+        Error config with 'status' and 'body', like the entries of ERROR_CONFIGS
+    """
+    config = ERROR_CONFIGS.get(provider, ERROR_CONFIGS['openai'])[ErrorMode.CONTEXT_LENGTH]
+    body = json.loads(json.dumps(config['body']))
+    message = CONTEXT_LENGTH_MESSAGES.get(provider, CONTEXT_LENGTH_MESSAGES['openai']).format(
+        tokens=tokens, limit=limit
+    )
+    # Databricks puts the message at the top level, everyone else under "error"
+    if 'error' in body:
+        body['error']['message'] = message
+    else:
+        body['message'] = message
+    return {'status': config['status'], 'body': body}
+
+
+class ContextEmulator:
+    """
+    Emulates provider context windows from an estimate of each request's prompt size.
+
+    The estimate is a fast local approximation, not a tokenizer: the request body is parsed
+    once, the text in the prompt fields is counted at a fixed number of characters per
+    token, and each message and image adds a fixed overhead.
+    """
+
+    MESSAGE_OVERHEAD_TOKENS = 4
+    IMAGE_TOKENS = 765  # A 1024x1024 image at high detail in OpenAI's accounting
+
+    def __init__(self, limits: Optional[list[tuple[str, int]]] = None, chars_per_token: float = 4.0):
+        """
+        Initialize the emulator.
+
+        Args:
+            limits: (model glob, token limit) overrides, checked before DEFAULT_CONTEXT_LIMITS
+            chars_per_token: Average characters per token of the prompt text
+        """
+        self.limits = list(limits or []) + DEFAULT_CONTEXT_LIMITS
+        self.chars_per_token = chars_per_token
+        self._patterns = [(re.compile(fnmatch.translate(pattern.lower())), limit) for pattern, limit in self.limits]
+        self._limit_cache: dict[str, Optional[int]] = {}
+
+    @staticmethod
+    def parse_limit(value: str) -> tuple[str, int]:
+        """Parse a "MODEL_GLOB=TOKENS" option, e.g. "claude*=100000" or "gpt-4o=32k". Raises ValueError if invalid."""
+        pattern, separator, tokens_str = value.partition('=')
+        if not separator or not pattern.strip():
+            raise ValueError(f"expected MODEL=TOKENS, got '{value}'")
+        tokens_str = tokens_str.strip().lower()
+        multiplier = 1
+        if tokens_str.endswith('k'):
+            tokens_str, multiplier = tokens_str[:-1], 1000
+        elif tokens_str.endswith('m'):
+            tokens_str, multiplier = tokens_str[:-1], 1000000
+        tokens = int(float(tokens_str) * multiplier)
+        if tokens < 1:
+            raise ValueError(f"token limit must be positive, got '{value}'")
+        return (pattern.strip(), tokens)
+
+    def limit_for(self, model: str) -> Optional[int]:
+        """The context window of a model, or None if no limit matches."""
+        model = model.lower()
+        if model not in self._limit_cache:
+            self._limit_cache[model] = next(
+                (limit for pattern, limit in self._patterns if pattern.match(model)), None
+            )
+        return self._limit_cache[model]
+
+    def estimate_tokens(self, payload: dict) -> int:
+        """Estimate the prompt tokens of a parsed request body."""
+        chars = 0
+        images = 0
+        messages = 0
+        stack = []
+        for field in PROMPT_FIELDS:
+            value = payload.get(field)
+            if value is None:
+                continue
+            if field in ('messages', 'contents', 'input') and isinstance(value, list):
+                messages += len(value)
+            stack.append(value)
+
+        while stack:
+            value = stack.pop()
+            if isinstance(value, str):
+                chars += len(value)
+            elif isinstance(value, list):
+                stack.extend(value)
+            elif isinstance(value, dict):
+                if value.get('type') in IMAGE_PART_TYPES or not IMAGE_KEYS.isdisjoint(value):
+                    images += 1
+                    continue
+                stack.extend(value.values())
+
+        return (int(chars / self.chars_per_token) + messages * self.MESSAGE_OVERHEAD_TOKENS
+                + images * self.IMAGE_TOKENS)
+
+    def model_limit(self, path: str, payload: dict) -> Optional[tuple[str, int]]:
+        """
+        Look up the context window of the model a request is for.
+
+        Args:
+            path: The request path (Google and Databricks put the model there)
+            payload: The parsed request body
+
+        Returns:
+            Tuple of (model, limit), or None if the model is unknown or no limit applies
+        """
+        model = payload.get('model')
+        if not isinstance(model, str):
+            model_match = re.search(r'/models/([^/:]+)|/serving-endpoints/([^/]+)', path)
+            if model_match is None:
+                return None
+            model = model_match.group(1) or model_match.group(2)
+        limit = self.limit_for(model)
+        return (model, limit) if limit is not None else None
+
+
+def parse_json_object(body: bytes) -> Optional[dict]:
+    """Parse a JSON object request body, or return None if the body is not one."""
+    try:
+        payload = json.loads(body) if body else None
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def format_reset(seconds: float) -> str:
+    """Format a time until reset the way OpenAI's x-ratelimit-reset-* headers do, e.g. 120ms, 1.5s or 6m0s."""
+    if seconds < 1.0:
+        return f"{math.ceil(seconds * 1000)}ms"
+    if seconds < 60.0:
+        return f"{seconds:.3g}s"
+    minutes, seconds = divmod(seconds, 60.0)
+    return f"{int(minutes)}m{seconds:.0f}s"
+
+
+class TokenBucket:
+    """A bucket that holds up to a per-minute allowance and refills continuously."""
+
+    __slots__ = ('capacity', 'rate', 'level', 'updated')
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0  # Refill per second
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        """Add the allowance accrued since the last refill."""
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until the bucket holds the amount, infinite if it is more than the bucket ever holds."""
+        if amount > self.capacity:
+            return math.inf
+        return max(amount - self.level, 0.0) / self.rate
+
+    def reset_time(self) -> float:
+        """Seconds until the bucket is full again."""
+        return (self.capacity - self.level) / self.rate
+
+
+class RateLimitExceeded:
+    """Why a request was rate limited and the 429 to answer it with."""
+
+    __slots__ = ('resource', 'retry_after', 'headers', 'body')
+
+    def __init__(self, resource: str, retry_after: Optional[float], headers: dict[str, str], body: dict):
+        self.resource = resource  # 'requests' or 'tokens'
+        self.retry_after = retry_after  # None if the request is too large to ever be admitted
+        self.headers = headers
+        self.body = body
+
+
+class RateLimiter:
+    """
+    Emulates provider rate limits with requests-per-minute and tokens-per-minute buckets.
+
+    Buckets are kept per provider and API key (or per provider only), start full and refill
+    continuously. A request takes one request and its estimated prompt tokens; when either
+    bucket can't cover it, nothing is taken and the provider's 429 is returned with
+    retry-after and rate limit headers computed from the bucket levels. A request with more
+    tokens than the tokens per minute gets a 429 without retry-after, as retrying can't help.
+    """
+
+    def __init__(self, limits: dict[Optional[str], tuple[int, int]], key_by: str = 'api-key'):
+        """
+        Initialize the rate limiter.
+
+        Args:
+            limits: (requests per minute, tokens per minute) by provider, None for all
+                    other providers; 0 disables a bucket
+            key_by: 'api-key' for buckets per provider and API key, 'provider' for per provider
+        """
+        self.limits = limits
+        self.key_by = key_by
+        self.buckets: dict[tuple[str, Optional[str]], tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+
+    @staticmethod
+    def parse_limit(value: str) -> tuple[Optional[str], int, int]:
+        """
+        Parse a "[PROVIDER:]rpm=N[,tpm=N]" option, e.g. "anthropic:rpm=50,tpm=40k". Raises ValueError if invalid.
+
+        Returns:
+            Tuple of (provider or None for all providers, requests per minute, tokens per minute)
+        """
+        provider = None
+        if ':' in value:
+            provider, _, value = value.partition(':')
+            provider = provider.strip().lower()
+            if provider not in PROVIDER_HOSTS:
+                raise ValueError(f"unknown provider '{provider}'")
+        rpm = tpm = 0
+        for part in value.split(','):
+            name, separator, amount = part.strip().lower().partition('=')
+            if not separator or name not in ('rpm', 'tpm'):
+                raise ValueError(f"expected rpm=N or tpm=N, got '{part.strip()}'")
+            multiplier = 1
+            if amount.endswith('k'):
+                amount, multiplier = amount[:-1], 1000
+            elif amount.endswith('m'):
+                amount, multiplier = amount[:-1], 1000000
+            count = int(float(amount) * multiplier)
+            if count < 1:
+                raise ValueError(f"{name} must be positive")
+            if name == 'rpm':
+                rpm = count
+            else:
+                tpm = count
+        return (provider, rpm, tpm)
+
+    @property
+    def needs_tokens(self) -> bool:
+        """Whether any limit counts tokens, so request bodies must be inspected."""
+        return any(tpm > 0 for _, tpm in self.limits.values())
+
+    @staticmethod
+    def api_key(request: Request) -> Optional[str]:
+        """The credential a request was made with, whichever header or parameter the provider uses."""
+        return (request.headers.get('authorization') or request.headers.get('x-api-key')
+                or request.headers.get('x-goog-api-key') or request.query.get('key'))
+
+    def take(self, provider: str, request: Request, tokens: int) -> Optional[RateLimitExceeded]:
+        """
+        Take a request and its tokens from the buckets.
+
+        Args:
+            provider: The detected provider
+            request: The incoming request (for the API key)
+            tokens: Estimated prompt tokens of the request
+
+        Returns:
+            None if the request is within the limits, otherwise why it is limited
+        """
+        limit = self.limits.get(provider) or self.limits.get(None)
+        if limit is None:
+            return None
+        key = (provider, self.api_key(request) if self.key_by == 'api-key' else None)
+        buckets = self.buckets.get(key)
+        if buckets is None:
+            rpm, tpm = limit
+            buckets = self.buckets[key] = (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+        requests_bucket, tokens_bucket = buckets
+
+        now = time.monotonic()
+        requests_wait = tokens_wait = 0.0
+        if requests_bucket is not None:
+            requests_bucket.refill(now)
+            requests_wait = requests_bucket.wait_time(1)
+        if tokens_bucket is not None:
+            tokens_bucket.refill(now)
+            tokens_wait = tokens_bucket.wait_time(tokens)
+
+        if requests_wait == 0.0 and tokens_wait == 0.0:
+            if requests_bucket is not None:
+                requests_bucket.level -= 1
+            if tokens_bucket is not None:
+                tokens_bucket.level -= tokens
+            return None
+
+        resource = 'requests' if requests_wait >= tokens_wait else 'tokens'
+        retry_after = max(requests_wait, tokens_wait)
+        if math.isinf(retry_after):
+            retry_after = None
+        return RateLimitExceeded(
+            resource, retry_after,
+            self._headers(provider, requests_bucket, tokens_bucket, retry_after),
+            self._body(provider, resource, requests_bucket if resource == 'requests' else tokens_bucket,
+                       1 if resource == 'requests' else tokens, retry_after)
+        )
+
+    @staticmethod
+    def _headers(provider: str, requests_bucket: Optional[TokenBucket], tokens_bucket: Optional[TokenBucket],
+                 retry_after: Optional[float]) -> dict[str, str]:
+        """Rate limit headers in the provider's format."""
+        headers = {}
+        if retry_after is not None:
+            headers['retry-after'] = str(max(math.ceil(retry_after), 1))
+        for resource, bucket in (('requests', requests_bucket), ('tokens', tokens_bucket)):
+            if bucket is None:
+                continue
+            if provider == 'anthropic':
+                reset_at = time.gmtime(time.time() + bucket.reset_time())
+                headers[f'anthropic-ratelimit-{resource}-limit'] = str(int(bucket.capacity))
+                headers[f'anthropic-ratelimit-{resource}-remaining'] = str(int(bucket.level))
+                headers[f'anthropic-ratelimit-{resource}-reset'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', reset_at)
+            else:
+                headers[f'x-ratelimit-limit-{resource}'] = str(int(bucket.capacity))
+                headers[f'x-ratelimit-remaining-{resource}'] = str(int(bucket.level))
+                headers[f'x-ratelimit-reset-{resource}'] = format_reset(bucket.reset_time())
+        return headers
+
+    @staticmethod
+    def _body(provider: str, resource: str, bucket: TokenBucket, requested: int, retry_after: Optional[float]) -> dict:
+        """The provider's 429 body, with the numbers where the provider reports them."""
+        body = json.loads(json.dumps(ERROR_CONFIGS.get(provider, ERROR_CONFIGS['openai'])[ErrorMode.RATE_LIMIT]['body']))
+        if retry_after is None:
+            if provider == 'openai':
+                body['error']['message'] = (
+                    f"Request too large for {resource} per min: Limit {int(bucket.capacity)}, Requested {requested}. "
+                    f"The input or output tokens must be reduced in order to run successfully."
+                )
+        elif provider == 'openai':
+            body['error']['message'] = (
+                f"Rate limit reached for {resource} per min: Limit {int(bucket.capacity)}, "
+                f"Used {int(bucket.capacity) - int(bucket.level)}, Requested {requested}. "
+                f"Please try again in {format_reset(retry_after)}."
+            )
+        elif provider == 'google':
+            body['error']['details'] = [{
+                '@type': 'type.googleapis.com/google.rpc.RetryInfo',
+                'retryDelay': f"{math.ceil(retry_after)}s",
+            }]
+        return body
+
+
+class ConcurrencyLimiter:
+    """
+    Emulates a saturated provider: a fixed number of requests in flight and a bounded wait queue.
+
+    Requests beyond the limit wait in FIFO order for a free slot. When the queue is full, or a
+    request has waited longer than the timeout, it is turned away with the provider's
+    overload error instead.
+    """
+
+    def __init__(self, limit: int, queue_size: int = 0, timeout: float = 0.0):
+        """
+        Initialize the limiter.
+
+        Args:
+            limit: Requests allowed in flight at once
+            queue_size: Requests allowed to wait for a slot, 0 to turn away everything beyond the limit
+            timeout: Longest wait for a slot in seconds, 0 for no limit
+        """
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiters: collections.deque[asyncio.Future] = collections.deque()
+
+    @staticmethod
+    def parse_limit(value: str) -> tuple[Optional[str], int, int, float]:
+        """
+        Parse a "[PROVIDER:]N[,queue=M][,timeout=DURATION]" option, e.g. "anthropic:4,queue=16,timeout=30s".
+        Raises ValueError if invalid.
+
+        Returns:
+            Tuple of (provider or None for every provider, limit, queue size, timeout)
+        """
+        provider = None
+        if ':' in value:
+            provider, _, value = value.partition(':')
+            provider = provider.strip().lower()
+            if provider not in PROVIDER_HOSTS:
+                raise ValueError(f"unknown provider '{provider}'")
+        limit_str, *options = value.split(',')
+        limit = int(limit_str)
+        if limit < 1:
+            raise ValueError("the in-flight limit must be at least 1")
+        queue_size = 0
+        timeout = 0.0
+        for option in options:
+            name, separator, option_value = option.strip().lower().partition('=')
+            if name == 'queue' and separator:
+                queue_size = int(option_value)
+                if queue_size < 0:
+                    raise ValueError("queue must not be negative")
+            elif name == 'timeout' and separator:
+                timeout = parse_duration(option_value)
+            else:
+                raise ValueError(f"expected queue=N or timeout=DURATION, got '{option.strip()}'")
+        return (provider, limit, queue_size, timeout)
+
+    def describe(self) -> str:
+        """Describe the configuration for startup output."""
+        description = f"{self.limit} in flight, {self.queue_size} queued"
+        if self.timeout > 0.0:
+            description += f", {format_duration(self.timeout)} queue timeout"
+        return description
+
+    async def acquire(self) -> Optional[str]:
+        """
+        Take a slot, waiting in the queue if needed.
+
+        Returns:
+            None once the request holds a slot, or why it was turned away ('queue_full' or 'timeout')
+        """
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            return None
+        if len(self.waiters) >= self.queue_size:
+            return 'queue_full'
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.timeout or None)
+            return None
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self.release()
+            else:
+                try:
+                    self.waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return 'timeout'
+
+    def release(self):
+        """Free a slot, handing it straight to the longest waiting request if there is one."""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class BandwidthPacer:
+    """
+    Token bucket that paces response bytes to a bandwidth limit (--bandwidth).
+
+    Writes only wait when the bucket is empty, so a stream of small chunks below the limit goes
+    out untouched. Larger writes are split into burst-sized slices, so a big body trickles out at
+    the limit instead of arriving in one piece after a long pause. Responses sharing a pacer
+    share its bandwidth, like requests over one slow link.
+    """
+
+    # Default burst: this much time at the full rate, but at least MIN_BURST bytes
+    BURST_TIME = 0.05
+    MIN_BURST = 1024
+
+    def __init__(self, rate: float, burst: int = 0):
+        """
+        Initialize the pacer.
+
+        Args:
+            rate: Bandwidth in bytes per second
+            burst: Bucket size in bytes, default 50ms at the full rate (at least 1 KB)
+        """
+        self.rate = rate
+        self.burst = burst or max(int(rate * self.BURST_TIME), self.MIN_BURST)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    @staticmethod
+    def parse_limit(value: str) -> tuple[Optional[str], float, int, bool]:
+        """
+        Parse a "[PROVIDER:]RATE[,burst=SIZE][,per-connection]" option, e.g. "anthropic:1mbps,per-connection".
+        Raises ValueError if invalid.
+
+        Returns:
+            Tuple of (provider or None for all traffic, bytes per second, burst size or 0 for the
+            default, whether every connection gets its own bandwidth)
+        """
+        provider = None
+        if ':' in value:
+            provider, _, value = value.partition(':')
+            provider = provider.strip().lower()
+            if provider not in PROVIDER_HOSTS:
+                raise ValueError(f"unknown provider '{provider}'")
+        rate_str, *options = value.split(',')
+        rate = parse_rate(rate_str)
+        burst = 0
+        per_connection = False
+        for option in options:
+            name, separator, option_value = option.strip().lower().partition('=')
+            if name == 'burst' and separator:
+                multiplier = 1
+                for suffix, suffix_multiplier in (('kb', 1024), ('mb', 1024 * 1024), ('b', 1)):
+                    if option_value.endswith(suffix):
+                        multiplier = suffix_multiplier
+                        option_value = option_value[:-len(suffix)]
+                        break
+                burst = int(float(option_value) * multiplier)
+                if burst < 1:
+                    raise ValueError("burst must be at least 1 byte")
+            elif name == 'per-connection' and not separator:
+                per_connection = True
+            else:
+                raise ValueError(f"expected burst=SIZE or per-connection, got '{option.strip()}'")
+        return (provider, rate, burst, per_connection)
+
+    def _reserve(self, size: int) -> float:
+        """Take size bytes from the bucket, returning how long to wait until they are covered."""
+        now = time.monotonic()
+        self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= size
+        return -self.tokens / self.rate if self.tokens < 0.0 else 0.0
+
+    async def send(self, response: StreamResponse, data: bytes):
+        """Write data to the client no faster than the bandwidth allows."""
+        for start in range(0, len(data), self.burst):
+            piece = data[start:start + self.burst]
+            # Reserving before sleeping queues concurrent writers on a shared pacer in order
+            wait = self._reserve(len(piece))
+            if wait > 0.0:
+                await asyncio.sleep(wait)
+            await response.write(piece)
+
+
+class UpstreamPool:
+    """
+    Connection pool settings for the upstream requests to one provider (--pool).
+
+    Every provider gets its own client session and connector, so a burst of slow requests to one
+    provider can only use up that provider's connections and never starves the others.
+    """
+
+    # aiohttp's connector defaults, and the provider-matching 600s total timeout; 0 disables a timeout
+    DEFAULTS = {'limit': 100, 'keepalive': 15.0, 'dns-ttl': 10.0, 'connect': 0.0, 'read': 0.0, 'total': 600.0}
+
+    def __init__(self, options: Optional[dict] = None):
+        """
+        Initialize the pool settings.
+
+        Args:
+            options: Settings that differ from DEFAULTS (limit, keepalive, dns-ttl, connect, read, total)
+        """
+        self.settings = {**self.DEFAULTS, **(options or {})}
+
+    @staticmethod
+    def parse_limit(value: str) -> tuple[Optional[str], dict]:
+        """
+        Parse a "[PROVIDER:]limit=N,keepalive=DURATION,dns-ttl=DURATION,connect=DURATION,read=DURATION,
+        total=DURATION" option (any subset), e.g. "anthropic:limit=8,connect=5s,read=60s".
+        Raises ValueError if invalid.
+
+        Returns:
+            Tuple of (provider or None for every provider, settings given)
+        """
+        provider = None
+        if ':' in value:
+            provider, _, value = value.partition(':')
+            provider = provider.strip().lower()
+            if provider not in PROVIDER_HOSTS:
+                raise ValueError(f"unknown provider '{provider}'")
+        options = {}
+        for option in value.split(','):
+            name, separator, option_value = option.strip().lower().partition('=')
+            if name == 'limit' and separator:
+                options[name] = int(option_value)
+                if options[name] < 0:
+                    raise ValueError("limit must not be negative")
+            elif name in UpstreamPool.DEFAULTS and separator:
+                options[name] = parse_duration(option_value)
+            else:
+                raise ValueError("expected limit=N or keepalive, dns-ttl, connect, read or total=DURATION, "
+                                 f"got '{option.strip()}'")
+        return (provider, options)
+
+    def describe(self) -> str:
+        """Describe the configuration for startup output."""
+        settings = self.settings
+        limit = settings['limit']
+        parts = [f"{limit} connection{'s' if limit != 1 else ''}" if limit else "unlimited connections"]
+        parts.append(f"keep-alive {format_duration(settings['keepalive'])}" if settings['keepalive'] else "no keep-alive")
+        parts.append(f"DNS cache {format_duration(settings['dns-ttl'])}" if settings['dns-ttl'] else "no DNS cache")
+        for name in ('connect', 'read', 'total'):
+            if settings[name]:
+                parts.append(f"{name} timeout {format_duration(settings[name])}")
+        return ', '.join(parts)
+
+    def create_session(self, auto_decompress: bool, trace_configs: list[TraceConfig]) -> ClientSession:
+        """Create the client session for this pool (must be called on the event loop)."""
+        settings = self.settings
+        if settings['keepalive']:
+            connector_keepalive = {'keepalive_timeout': settings['keepalive']}
+        else:
+            connector_keepalive = {'force_close': True}
+        connector = TCPConnector(
+            limit=settings['limit'],
+            use_dns_cache=bool(settings['dns-ttl']),
+            ttl_dns_cache=settings['dns-ttl'] or None,
+            **connector_keepalive
+        )
+        # connect bounds the TCP (and TLS) handshake, read the silence between two chunks, so a
+        # stalled stream fails fast while a long, healthy one still gets the whole total
+        timeout = ClientTimeout(
+            total=settings['total'] or None,
+            sock_connect=settings['connect'] or None,
+            sock_read=settings['read'] or None
+        )
+        return ClientSession(
+            connector=connector,
+            timeout=timeout,
+            auto_decompress=auto_decompress,
+            trace_configs=trace_configs
+        )
+
+
+# Latency histogram buckets in seconds - LLM calls range from milliseconds to minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+TOKEN_BUCKETS = (1000, 4000, 8000, 16000, 32000, 64000, 100000, 128000, 200000, 400000, 1000000, 2000000)
+
+
+def escape_label_value(value) -> str:
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    """Format a Prometheus label set, e.g. {provider="openai",status="200"}."""
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """A labelled Prometheus-style histogram with fixed buckets."""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...], buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels: tuple, value: float):
+        """Record an observation."""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list[str]:
+        """Render the histogram in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            for index, bound in enumerate(self.buckets):
+                le = f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {series[index]}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {series[-1]}")
+        return lines
+
+
+class RequestStats:
+    """Timings and sizes collected while handling a single request."""
+
+    def __init__(self, route: RouteDecision, method: str, path: str):
+        self.route = route
+        self.provider = route.provider
+        self.method = method
+        self.path = path
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.connect: Optional[float] = None  # New upstream connection setup time
+        self.ttfb: Optional[float] = None  # Time until upstream response headers arrived
+        self.upstream_ttfb: Optional[float] = None  # Upstream request sent to its response headers
+        self.queued = 0.0  # Time spent waiting for an in-flight slot
+        self.delayed = 0.0  # Injected or simulated delay before the response headers
+        self.headers_sent: Optional[float] = None  # Time until our response headers went out
+        self.stream_duration: Optional[float] = None  # Headers to end of an SSE stream
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.injected: Optional[str] = None  # Name of the injected fault, if any
+        self.pacer: Optional[BandwidthPacer] = None  # Bandwidth limit for the response body, if any
+
+    def timings(self, total: float) -> dict[str, float]:
+        """
+        Break down where the time until the response headers went.
+
+        Args:
+            total: Time from receiving the request to sending the response headers
+
+        Returns:
+            Durations in seconds by name; proxy is whatever the other phases don't account for
+        """
+        timings = {}
+        if self.queued:
+            timings['queue'] = self.queued
+        if self.delayed:
+            timings['delay'] = self.delayed
+        if self.connect is not None:
+            timings['connect'] = self.connect
+        if self.upstream_ttfb is not None:
+            timings['upstream'] = self.upstream_ttfb
+        timings['proxy'] = max(total - self.queued - self.delayed - (self.upstream_ttfb or 0.0), 0.0)
+        timings['total'] = total
+        return timings
+
+    def server_timing(self) -> str:
+        """Format the Server-Timing header value for the response headers being sent now."""
+        self.headers_sent = time.monotonic() - self.started
+        return ', '.join(f"{name};dur={duration * 1000:.2f}"
+                         for name, duration in self.timings(self.headers_sent).items())
+
+    def trace_record(self, status: int, worker_id: Optional[int]) -> dict:
+        """Build the compact --trace record for the finished request, with durations in milliseconds."""
+        total = time.monotonic() - self.started
+        record = {
+            'ts': round(self.started_at, 3),
+            'method': self.method,
+            'path': self.path,
+            'provider': self.provider,
+            'status': status,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+        }
+        if self.route.rule:
+            record['rule'] = self.route.rule
+        if self.injected:
+            record['injected'] = self.injected
+        if worker_id is not None:
+            record['worker'] = worker_id
+        timings = self.timings(self.headers_sent if self.headers_sent is not None else total)
+        timings['headers'] = timings.pop('total')
+        if self.stream_duration is not None:
+            timings['stream'] = self.stream_duration
+        timings['total'] = total
+        record['ms'] = {name: round(duration * 1000, 2) for name, duration in timings.items()}
+        return record
+
+
+class TraceWriter:
+    """
+    Append JSON lines to a file: one per finished request (--trace) or provider response (--usage-log).
+
+    Records are queued in memory and written in batches from a worker thread, so request
+    handling never waits for the disk.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, max_pending: int = 1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending: list[dict] = []
+        self.written = 0
+        self._task: Optional[asyncio.Task] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def write(self, record: dict):
+        """Queue a record, starting a write early if many are waiting."""
+        self.pending.append(record)
+        if len(self.pending) >= self.max_pending and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Write all queued records."""
+        while self.pending:
+            records, self.pending = self.pending, []
+            await asyncio.to_thread(self._append, records)
+            self.written += len(records)
+
+    def _append(self, records: list[dict]):
+        # One unbuffered write per batch, so concurrent --workers processes never interleave lines
+        data = ''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n' for record in records)
+        with open(self.path, 'ab', buffering=0) as f:
+            f.write(data.encode('utf-8'))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Start writing queued records periodically."""
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """Stop the periodic writes and write whatever is still queued."""
+        if self._task is not None:
+            # Records a cancelled flush already took are still written by its thread
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+        await self.flush()
+
+
+# Non-streaming bodies: usage blocks sit near the end, the model name near the start
+USAGE_HEAD_SIZE = 4 * 1024
+USAGE_TAIL_SIZE = 64 * 1024
+# SSE events larger than this are not inspected (usage events are small)
+MAX_USAGE_EVENT_SIZE = 1024 * 1024
+USAGE_KEYS = ('usage', 'usageMetadata')
+MODEL_FIELD = re.compile(rb'"model(?:Version)?"\s*:\s*"([^"\\]+)"')
+
+
+def normalize_usage(usage: dict) -> tuple[int, int, int]:
+    """
+    Convert a provider usage block to (input tokens, output tokens, cached input tokens).
+
+    Input tokens include cached ones for every provider; Anthropic reports them separately.
+    """
+    def number(*keys) -> int:
+        total = 0
+        for key in keys:
+            value = usage.get(key)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                total += int(value)
+        return total
+
+    if 'promptTokenCount' in usage or 'candidatesTokenCount' in usage:
+        # Google
+        return (number('promptTokenCount'), number('candidatesTokenCount', 'thoughtsTokenCount'),
+                number('cachedContentTokenCount'))
+    if 'prompt_tokens' in usage or 'completion_tokens' in usage:
+        # OpenAI chat completions and compatible APIs
+        details = usage.get('prompt_tokens_details')
+        cached = details.get('cached_tokens', 0) if isinstance(details, dict) else 0
+        return (number('prompt_tokens'), number('completion_tokens'), int(cached or 0))
+    details = usage.get('input_tokens_details')
+    if isinstance(details, dict):
+        # OpenAI responses API
+        return (number('input_tokens'), number('output_tokens'), int(details.get('cached_tokens') or 0))
+    # Anthropic
+    return (number('input_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens'),
+            number('output_tokens'), number('cache_read_input_tokens'))
+
+
+class UsageTap:
+    """
+    Picks the model and token usage out of a provider response while it is relayed.
+
+    SSE streams are inspected one event at a time, parsing only events that mention usage
+    (or the model, until it is known), and later usage values override earlier ones, since
+    Anthropic's message_delta and Google's chunks carry running totals. Other bodies keep only
+    their first and last few KB, where the model and the usage block are.
+    """
+
+    def __init__(self, streaming: bool, started: float):
+        """
+        Initialize the tap.
+
+        Args:
+            streaming: Whether the response is an SSE stream
+            started: When the upstream request was sent (time.monotonic())
+        """
+        self.streaming = streaming
+        self.started = started
+        self.first_chunk_at: Optional[float] = None
+        self.last_chunk_at: Optional[float] = None
+        self.model: Optional[str] = None
+        self.usage: dict = {}
+        self.pending = b''  # Start of the current, incomplete SSE event
+        self.head = b''
+        self.tail = b''
+        self.size = 0
+
+    def feed(self, chunk: bytes):
+        """Inspect the next chunk of the response body."""
+        now = time.monotonic()
+        if self.first_chunk_at is None:
+            self.first_chunk_at = now
+        self.last_chunk_at = now
+        self.size += len(chunk)
+        if not self.streaming:
+            if len(self.head) < USAGE_HEAD_SIZE:
+                self.head += chunk[:USAGE_HEAD_SIZE - len(self.head)]
+            self.tail = (self.tail + chunk)[-USAGE_TAIL_SIZE:]
+            return
+
+        buffer = self.pending + chunk
+        start = 0
+        for match in SSE_EVENT_BOUNDARY.finditer(buffer):
+            self._event(buffer[start:match.start()])
+            start = match.end()
+        self.pending = buffer[start:] if len(buffer) - start <= MAX_USAGE_EVENT_SIZE else b''
+
+    def _event(self, event: bytes):
+        """Take the model and usage from one SSE event, if it has them."""
+        if b'"usage' not in event and (self.model is not None or b'"model' not in event):
+            return
+        for line in event.splitlines():
+            if line.startswith(b'data:'):
+                try:
+                    self._take(json.loads(line[5:]))
+                except ValueError:
+                    continue
+
+    def _take(self, data):
+        """Take the model and usage from a parsed response, event or Google stream array."""
+        if isinstance(data, list):
+            for item in data:
+                self._take(item)
+            return
+        if not isinstance(data, dict):
+            return
+        # Anthropic's message_start and the OpenAI responses API nest the message
+        for container in (data, data.get('message'), data.get('response')):
+            if not isinstance(container, dict):
+                continue
+            model = container.get('model') or container.get('modelVersion')
+            if isinstance(model, str) and self.model is None:
+                self.model = model
+            for key in USAGE_KEYS:
+                usage = container.get(key)
+                if isinstance(usage, dict):
+                    self.usage.update(usage)
+
+    def _scan_body(self):
+        """Find the model and usage block in a non-streaming body's head and tail."""
+        if self.size <= USAGE_TAIL_SIZE:
+            try:
+                self._take(json.loads(self.tail))
+                return
+            except ValueError:
+                pass
+        text = self.tail.decode('utf-8', errors='replace')
+        decoder = json.JSONDecoder()
+        for key in USAGE_KEYS:
+            position = text.rfind(f'"{key}"')
+            if position < 0:
+                continue
+            value_start = text.find('{', position)
+            if value_start < 0:
+                continue
+            try:
+                usage, _ = decoder.raw_decode(text, value_start)
+            except ValueError:
+                continue
+            if isinstance(usage, dict):
+                self.usage.update(usage)
+                break
+        match = MODEL_FIELD.search(self.head) or MODEL_FIELD.search(self.tail)
+        if match is not None and self.model is None:
+            self.model = match.group(1).decode('utf-8', errors='replace')
+
+    def finish(self) -> Optional[tuple[str, int, int, int, float]]:
+        """
+        Finish inspecting the response.
+
+        Returns:
+            Tuple of (model, input tokens, output tokens, cached input tokens, generation seconds),
+            or None if the response had no usage block. Generation time runs from the first to
+            the last chunk of a stream, or from the request to the end of any other body.
+        """
+        if not self.streaming and self.size:
+            self._scan_body()
+        if not self.usage or self.last_chunk_at is None:
+            return None
+        started = self.first_chunk_at if self.streaming else self.started
+        return (self.model or 'unknown', *normalize_usage(self.usage), self.last_chunk_at - started)
+
+
+class UsageTotals:
+    """Token totals for one provider or model."""
+
+    def __init__(self):
+        self.responses = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.seconds = 0.0
+
+    def add(self, input_tokens: int, output_tokens: int, cached_tokens: int, seconds: float):
+        self.responses += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.cached_tokens += cached_tokens
+        self.seconds += seconds
+
+    def to_dict(self) -> dict:
+        return {
+            'responses': self.responses,
+            'input_tokens': self.input_tokens,
+            'output_tokens': self.output_tokens,
+            'cached_tokens': self.cached_tokens,
+            'output_tokens_per_second': round(self.output_tokens / self.seconds, 2) if self.seconds > 0.0 else None,
+        }
+
+
+class UsageLedger:
+    """Per-provider and per-model token usage, served on /__proxy/usage and optionally logged (--usage-log)."""
+
+    def __init__(self, log: Optional[TraceWriter] = None):
+        self.log = log
+        self.providers: dict[str, UsageTotals] = {}
+        self.models: dict[tuple[str, str], UsageTotals] = {}
+
+    def record(self, stats: 'RequestStats', model: str, input_tokens: int, output_tokens: int,
+               cached_tokens: int, seconds: float, worker_id: Optional[int] = None):
+        """Add the usage of one provider response."""
+        provider = stats.provider
+        for totals in (self.providers.setdefault(provider, UsageTotals()),
+                       self.models.setdefault((provider, model), UsageTotals())):
+            totals.add(input_tokens, output_tokens, cached_tokens, seconds)
+        if self.log is not None:
+            record = {
+                'ts': round(time.time(), 3),
+                'provider': provider,
+                'model': model,
+                'path': stats.path,
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'cached_tokens': cached_tokens,
+                'seconds': round(seconds, 3),
+            }
+            if seconds > 0.0:
+                record['output_tokens_per_second'] = round(output_tokens / seconds, 2)
+            if worker_id is not None:
+                record['worker'] = worker_id
+            self.log.write(record)
+
+    def to_dict(self) -> dict:
+        """Serialize the totals for the usage endpoint."""
+        return {
+            'providers': {provider: totals.to_dict() for provider, totals in sorted(self.providers.items())},
+            'models': [{'provider': provider, 'model': model, **totals.to_dict()}
+                       for (provider, model), totals in sorted(self.models.items())],
+        }
+
+
+# Where handle_request keeps the request's RequestStats for the response prepare hook
+# (typed request keys need aiohttp 3.12+; older versions take a plain string)
+REQUEST_STATS_KEY = web.RequestKey('stats', RequestStats) if hasattr(web, 'RequestKey') else 'proxy_stats'
+
+
+class ProxyMetrics:
+    """In-memory metrics exposed in the Prometheus text format on /__proxy/metrics."""
+
+    def __init__(self):
+        self.requests: dict[tuple[str, int], int] = {}
+        self.injected_errors: dict[ErrorMode, int] = {}
+        self.injected_latency: dict[LatencyMode, int] = {}
+        self.stream_faults: dict[StreamFaultMode, int] = {}
+        self.rate_limits: dict[tuple[str, str], int] = {}
+        self.overloads: dict[tuple[str, str], int] = {}
+        self.limiters: dict[str, ConcurrencyLimiter] = {}  # Set by the proxy, read when rendering
+        self.usage: Optional[UsageLedger] = None  # Set by the proxy, read when rendering
+        self.cache_results: dict[str, int] = {}
+        self.bytes_in: dict[str, int] = {}
+        self.bytes_out: dict[str, int] = {}
+        self.in_flight: dict[str, int] = {}
+        self.connections: dict[tuple[str, str], int] = {}
+        self.connect_time = Histogram('proxy_upstream_connect_seconds',
+                                      'Time to open a new upstream connection.', ('provider',))
+        self.ttfb = Histogram('proxy_upstream_ttfb_seconds',
+                              'Time from receiving the request to upstream response headers.', ('provider',))
+        self.total_time = Histogram('proxy_request_duration_seconds',
+                                    'Total time to handle a request, including injected faults.', ('provider',))
+        self.stream_time = Histogram('proxy_stream_duration_seconds',
+                                     'Time from SSE response headers to the end of the stream.', ('provider',))
+        self.queue_wait = Histogram('proxy_queue_wait_seconds',
+                                    'Time requests waited for an in-flight slot (--max-in-flight).', ('provider',))
+        self.pool_wait = Histogram('proxy_upstream_pool_wait_seconds',
+                                   'Time requests waited for a free connection in a full upstream pool.', ('provider',))
+        self.prompt_tokens = Histogram('proxy_prompt_tokens_estimated',
+                                       'Estimated prompt tokens per request (--context-limit emulation).',
+                                       ('provider',), TOKEN_BUCKETS)
+        self.stream_fault_recovery = Histogram('proxy_stream_fault_recovery_seconds',
+                                               'Time from a mid-stream fault to the next request to the same provider.',
+                                               ('provider', 'mode'))
+
+    def trace_config(self) -> TraceConfig:
+        """Build an aiohttp trace config that records upstream connection setup, reuse and pool waits."""
+        trace_config = TraceConfig()
+
+        def count_connection(stats: RequestStats, result: str):
+            key = (stats.provider, result)
+            self.connections[key] = self.connections.get(key, 0) + 1
+
+        async def on_connection_queued_start(session, context, params):
+            context.queued_at = time.monotonic()
+
+        async def on_connection_queued_end(session, context, params):
+            stats = context.trace_request_ctx
+            if isinstance(stats, RequestStats):
+                self.pool_wait.observe((stats.provider,), time.monotonic() - context.queued_at)
+
+        async def on_connection_create_start(session, context, params):
+            context.connect_started = time.monotonic()
+
+        async def on_connection_create_end(session, context, params):
+            stats = context.trace_request_ctx
+            if isinstance(stats, RequestStats):
+                stats.connect = time.monotonic() - context.connect_started
+                count_connection(stats, 'new')
+
+        async def on_connection_reuseconn(session, context, params):
+            stats = context.trace_request_ctx
+            if isinstance(stats, RequestStats):
+                count_connection(stats, 'reused')
+
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def request_started(self, provider: str):
+        """Track a request entering the proxy."""
+        self.in_flight[provider] = self.in_flight.get(provider, 0) + 1
+
+    def request_finished(self, stats: RequestStats, status: int):
+        """Track a request leaving the proxy and record its measurements."""
+        provider = stats.provider
+        self.in_flight[provider] -= 1
+        self.requests[(provider, status)] = self.requests.get((provider, status), 0) + 1
+        self.bytes_in[provider] = self.bytes_in.get(provider, 0) + stats.bytes_in
+        self.bytes_out[provider] = self.bytes_out.get(provider, 0) + stats.bytes_out
+        self.total_time.observe((provider,), time.monotonic() - stats.started)
+        if stats.connect is not None:
+            self.connect_time.observe((provider,), stats.connect)
+        if stats.ttfb is not None:
+            self.ttfb.observe((provider,), stats.ttfb)
+        if stats.stream_duration is not None:
+            self.stream_time.observe((provider,), stats.stream_duration)
+
+    def error_injected(self, mode: ErrorMode):
+        """Count an injected error."""
+        self.injected_errors[mode] = self.injected_errors.get(mode, 0) + 1
+
+    def latency_injected(self, mode: LatencyMode):
+        """Count an injected delay."""
+        self.injected_latency[mode] = self.injected_latency.get(mode, 0) + 1
+
+    def stream_fault_injected(self, mode: StreamFaultMode):
+        """Count an injected mid-stream fault."""
+        self.stream_faults[mode] = self.stream_faults.get(mode, 0) + 1
+
+    def rate_limited(self, provider: str, resource: str):
+        """Count a request refused by the rate limit emulation."""
+        key = (provider, resource)
+        self.rate_limits[key] = self.rate_limits.get(key, 0) + 1
+
+    def overloaded(self, provider: str, reason: str):
+        """Count a request turned away by the concurrency limit emulation."""
+        key = (provider, reason)
+        self.overloads[key] = self.overloads.get(key, 0) + 1
+
+    def cache_result(self, result: str):
+        """Count a response cache lookup (hit, miss or coalesced)."""
+        self.cache_results[result] = self.cache_results.get(result, 0) + 1
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def simple_metric(name: str, help_text: str, metric_type: str, label_names: tuple[str, ...], values: dict):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in sorted(values.items(), key=lambda item: str(item[0])):
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+
+        simple_metric('proxy_requests_total', 'Requests handled, by provider and response status.', 'counter',
+                      ('provider', 'status'), self.requests)
+        simple_metric('proxy_injected_errors_total', 'Errors injected, by error mode.', 'counter',
+                      ('mode',), {mode.name: count for mode, count in self.injected_errors.items()})
+        simple_metric('proxy_injected_latency_total', 'Requests delayed, by latency mode.', 'counter',
+                      ('mode',), {mode.name: count for mode, count in self.injected_latency.items()})
+        simple_metric('proxy_injected_stream_faults_total', 'Mid-stream faults injected, by mode.', 'counter',
+                      ('mode',), {mode.name: count for mode, count in self.stream_faults.items()})
+        simple_metric('proxy_rate_limited_total', 'Requests refused by rate limit emulation, by bucket.', 'counter',
+                      ('provider', 'resource'), self.rate_limits)
+        simple_metric('proxy_overloaded_total', 'Requests turned away by --max-in-flight, by reason.', 'counter',
+                      ('provider', 'reason'), self.overloads)
+        simple_metric('proxy_provider_in_flight', 'In-flight slots held, per --max-in-flight limiter.', 'gauge',
+                      ('provider',), {provider: limiter.in_flight for provider, limiter in self.limiters.items()})
+        simple_metric('proxy_queue_depth', 'Requests waiting for an in-flight slot.', 'gauge',
+                      ('provider',), {provider: len(limiter.waiters) for provider, limiter in self.limiters.items()})
+        simple_metric('proxy_cache_requests_total', 'Response cache lookups, by result.', 'counter',
+                      ('result',), self.cache_results)
+        simple_metric('proxy_request_bytes_total', 'Request body bytes received from clients.', 'counter',
+                      ('provider',), self.bytes_in)
+        simple_metric('proxy_response_bytes_total', 'Response body bytes sent to clients.', 'counter',
+                      ('provider',), self.bytes_out)
+        simple_metric('proxy_in_flight_requests', 'Requests currently being handled.', 'gauge',
+                      ('provider',), self.in_flight)
+        simple_metric('proxy_upstream_connections_total', 'Upstream connections used, opened new or reused from the pool.',
+                      'counter', ('provider', 'result'), self.connections)
+        if self.usage is not None:
+            tokens = {}
+            for (provider, model), totals in self.usage.models.items():
+                tokens[(provider, model, 'input')] = totals.input_tokens
+                tokens[(provider, model, 'output')] = totals.output_tokens
+                tokens[(provider, model, 'cached')] = totals.cached_tokens
+            simple_metric('proxy_usage_tokens_total', 'Tokens reported in provider usage blocks, by model and type.',
+                          'counter', ('provider', 'model', 'type'), tokens)
+        for histogram in (self.connect_time, self.ttfb, self.total_time, self.stream_time, self.stream_fault_recovery,
+                          self.prompt_tokens, self.queue_wait, self.pool_wait):
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+class ErrorProxy:
+    """HTTP proxy that can inject errors into provider responses."""
+    
+    def __init__(self, cassette: Optional[Cassette] = None, preserve_encoding: bool = False,
+                 router: Optional[RoutingTable] = None, mock: Optional[MockUpstream] = None,
+                 cache: Optional[ResponseCache] = None, context: Optional[ContextEmulator] = None,
+                 rate_limiter: Optional[RateLimiter] = None, estimator: Optional[ContextEmulator] = None,
+                 concurrency_limits: Optional[dict[Optional[str], tuple[int, int, float]]] = None,
+                 bandwidth_limits: Optional[dict[Optional[str], tuple[float, int, bool]]] = None,
+                 pool_options: Optional[dict[Optional[str], dict]] = None,
+                 trace: Optional[TraceWriter] = None, usage_log: Optional[TraceWriter] = None,
+                 scenario: Optional['Scenario'] = None,
+                 seed: Optional[int] = None,
+                 shared: Optional[SharedFaultState] = None, worker_id: Optional[int] = None):
+        """
+        Initialize the error proxy.
+
+        Args:
+            cassette: Optional cassette for recording or replaying upstream exchanges
+            preserve_encoding: Forward compressed upstream responses byte for byte instead of decompressing
+            router: Compiled routing rules, default the built-in rules
+            mock: Optional synthetic upstream that answers requests instead of the real providers
+            cache: Optional response cache for repeated identical requests
+            context: Optional context window emulation, failing prompts over their model's limit
+            rate_limiter: Optional rate limit emulation with per-minute request and token buckets
+            estimator: Prompt token estimator for rate limits, default the context emulator's
+            concurrency_limits: (in-flight limit, queue size, queue timeout) by provider, None for
+                                every other provider (each gets its own limiter)
+            bandwidth_limits: (bytes per second, burst size, per connection) by provider, None for
+                              all other traffic (one shared link unless per connection)
+            pool_options: Upstream connection pool settings by provider, None for every provider
+                          (provider settings override these one by one)
+            trace: Optional writer for one JSONL timing record per request
+            usage_log: Optional writer for one JSONL token usage record per provider response
+            scenario: Optional timeline of fault phases to run through
+            seed: Seed for percentage triggers and sampled delays, default unseeded
+            shared: Fault state shared with other worker processes (--workers)
+            worker_id: Index of this worker process, None for the parent process
+        """
+        self.router = router if router is not None else load_routing_table()
+        self.cassette = cassette
+        self.mock = mock
+        self.cache = cache
+        self.context = context
+        self.rate_limiter = rate_limiter
+        self.estimator = estimator or context or ContextEmulator()
+        self.concurrency_limits = concurrency_limits or {}
+        self.limiters: dict[str, ConcurrencyLimiter] = {}
+        self.bandwidth_limits = bandwidth_limits or {}
+        self.pacers: dict[Optional[str], BandwidthPacer] = {}  # Shared links by provider, None for the rest
+        self.trace = trace
+        self.usage = UsageLedger(usage_log)
+        self.scenario = scenario
+        if seed is None:
+            self.rng = random.Random()
+        else:
+            # Every worker draws its own reproducible sequence
+            self.rng = random.Random(seed if worker_id is None else f"{seed}/{worker_id}")
+        self.preserve_encoding = preserve_encoding
+        # Fault profiles by target. All state is owned by the event loop thread, so request
+        # handling never blocks on a lock; other threads go through run_in_loop().
+        # With --workers, this is a local copy of the shared snapshot (see sync()).
+        self.profiles: dict[FaultTarget, FaultProfile] = {GLOBAL_TARGET: FaultProfile()}
+        self.shared = shared
+        self.worker_id = worker_id
+        self._shared_version: Optional[int] = 0
+        self.metrics = ProxyMetrics()
+        self.metrics.limiters = self.limiters
+        self.metrics.usage = self.usage
+        # Last mid-stream fault per provider that no request has followed yet: (mode, injected at)
+        self.unrecovered_stream_faults: dict[str, tuple[StreamFaultMode, float]] = {}
+        self.request_count = 0
+        self.pool_options = pool_options or {}
+        self.sessions: dict[str, ClientSession] = {}  # One connection pool per provider
+
+    def _profile(self, target: FaultTarget) -> FaultProfile:
+        """Get or create the profile for a target."""
+        profile = self.profiles.get(target)
+        if profile is None:
+            profile = self.profiles[target] = FaultProfile()
+        return profile
+
+    def _prune(self, target: FaultTarget):
+        """Drop a targeted profile once it has no rules left."""
+        if target != GLOBAL_TARGET and self.profiles[target].is_empty():
+            del self.profiles[target]
+
+    def _new_rule(self, fault, count: int, percentage: float) -> FaultRule:
+        """Create a fault rule; with --workers, count-mode rules get a shared counter."""
+        if self.shared is None or percentage > 0.0:
+            return FaultRule(fault, count, percentage)
+        slot, generation = self.shared.allocate(count, self._live_slots())
+        return SharedFaultRule(fault, self.shared, slot, generation)
+
+    def _live_slots(self) -> set[int]:
+        """Shared counter slots used by the current rules."""
+        return {
+            rule.slot
+            for profile in self.profiles.values()
+            for rule in profile.rules()
+            if isinstance(rule, SharedFaultRule)
+        }
+
+    def apply(self, appliers: list[Callable[['ErrorProxy'], None]]):
+        """
+        Apply prepared commands (see prepare_command) to the fault state.
+
+        With --workers the commands are applied to the latest shared snapshot under the
+        shared lock and the result is published to the other workers.
+        """
+        if self.shared is None:
+            for apply in appliers:
+                apply(self)
+            return
+        with self.shared.lock:
+            try:
+                if self.shared.version.value != self._shared_version:
+                    self._load_snapshot()
+                for apply in appliers:
+                    apply(self)
+                self.shared.publish(self._dump_snapshot())
+                self._shared_version = self.shared.version.value
+            except Exception:
+                # Local state may no longer match the shared state; reload on next sync
+                self._shared_version = None
+                raise
+
+    def total_request_count(self) -> int:
+        """Requests handled by this process, or by all workers with --workers."""
+        if self.shared is None:
+            return self.request_count
+        return sum(self.shared.request_counts)
+
+    def sync(self):
+        """Pick up fault changes published by other workers (a no-op without --workers)."""
+        if self.shared is not None and self.shared.version.value != self._shared_version:
+            with self.shared.lock:
+                self._load_snapshot()
+
+    def _dump_snapshot(self) -> bytes:
+        """Serialize the fault profiles for SharedFaultState."""
+        def dump_rule(rule: FaultRule) -> dict:
+            fault = rule.fault
+            if isinstance(fault, ErrorMode):
+                fault_state = fault.name
+            elif isinstance(fault, StreamFaultSpec):
+                fault_state = [fault.mode.name, fault.after, fault.unit]
+            else:
+                fault_state = [fault.kind, fault.first, fault.second]
+            state = {'fault': fault_state, 'percentage': rule.percentage}
+            if isinstance(rule, SharedFaultRule):
+                state.update(slot=rule.slot, generation=rule.generation)
+            return state
+
+        return json.dumps([
+            {
+                'target': list(target),
+                'error': dump_rule(profile.error) if profile.error is not None else None,
+                'latency': {mode.name: dump_rule(rule) for mode, rule in profile.latency.items()},
+                'stream': dump_rule(profile.stream) if profile.stream is not None else None,
+            }
+            for target, profile in self.profiles.items()
+        ]).encode('utf-8')
+
+    def _load_snapshot(self):
+        """Replace the fault profiles with the shared snapshot. Must be called with the lock held."""
+        def load_rule(state: dict, fault) -> Optional[FaultRule]:
+            if 'slot' in state:
+                rule = SharedFaultRule(fault, self.shared, state['slot'], state['generation'])
+            else:
+                rule = FaultRule(fault, 0, state['percentage'])
+            return None if rule.is_exhausted() else rule
+
+        version, data = self.shared.read()
+        profiles = {GLOBAL_TARGET: FaultProfile()}
+        for entry in json.loads(data) if data else []:
+            profile = FaultProfile()
+            if entry['error'] is not None:
+                profile.error = load_rule(entry['error'], ErrorMode[entry['error']['fault']])
+            for mode_name, state in entry['latency'].items():
+                rule = load_rule(state, DelaySpec(*state['fault']))
+                if rule is not None:
+                    profile.latency[LatencyMode[mode_name]] = rule
+            if entry['stream'] is not None:
+                mode_name, after, unit = entry['stream']['fault']
+                profile.stream = load_rule(entry['stream'], StreamFaultSpec(StreamFaultMode[mode_name], after, unit))
+            target = tuple(entry['target'])
+            if target == GLOBAL_TARGET or not profile.is_empty():
+                profiles[target] = profile
+        self.profiles = profiles
+        self._shared_version = version
+
+    def _matching_targets(self, provider: str, path: str, rule: Optional[str] = None) -> list[FaultTarget]:
+        """
+        Find the targets that apply to a request, most specific first.
+
+        A routing rule beats any provider or path target. Provider and path together
+        beat path alone, which beats provider alone, which beats the global target.
+        Longer path prefixes beat shorter ones.
+        """
+        matches = [
+            target for target in self.profiles
+            if (target[0] is None or target[0] == provider)
+            and (target[1] is None or path.startswith(target[1]))
+            and (target[2] is None or target[2] == rule)
+        ]
+        return sorted(
+            matches,
+            key=lambda target: (target[2] is not None, target[1] is not None, len(target[1] or ''),
+                                target[0] is not None),
+            reverse=True
+        )
+
+    def set_error_mode(self, mode: ErrorMode, count: int = 1, percentage: float = 0.0,
+                       target: FaultTarget = GLOBAL_TARGET):
+        """
+        Set the error injection mode.
+        
+        Args:
+            mode: The error mode to use
+            count: Number of errors to inject (default 1, 0 for unlimited)
+            percentage: Percentage of requests to error (0.0-1.0, 0.0 for count mode)
+            target: (provider, path prefix, rule) the mode applies to, default all requests
+        """
+        rule = None
+        if mode != ErrorMode.NO_ERROR and (count > 0 or percentage > 0.0):
+            rule = self._new_rule(mode, count, percentage)
+        self._profile(target).error = rule
+        self._prune(target)
+
+    def clear_target(self, target: FaultTarget):
+        """Remove all rules for a target (the global target is reset instead)."""
+        if target == GLOBAL_TARGET:
+            self.profiles[GLOBAL_TARGET] = FaultProfile()
+        else:
+            self.profiles.pop(target, None)
+            
+    def take_error(self, provider: str, path: str, rule: Optional[str] = None) -> Optional[ErrorMode]:
+        """
+        Determine if we should inject an error for this request.
+
+        The most specific target with an active error rule decides.
+
+        Args:
+            provider: The detected provider name
+            path: The request path
+            rule: The routing rule the request matched, if any
+
+        Returns:
+            The error mode to inject, or None to forward the request
+        """
+        for target in self._matching_targets(provider, path, rule):
+            fault_rule = self.profiles[target].error
+            if fault_rule is None:
+                continue
+            fired = fault_rule.fire(self.rng)
+            # Count reached zero, switch back to NO_ERROR for this target
+            if fault_rule.is_exhausted():
+                self.profiles[target].error = None
+                self._prune(target)
+            return fault_rule.fault if fired else None
+        return None
+            
+    def get_error_mode(self) -> ErrorMode:
+        """Get the current global error injection mode."""
+        return self.get_error_config()[0]
+    
+    def get_error_config(self) -> tuple[ErrorMode, int, float]:
+        """Get the current global error configuration."""
+        rule = self.profiles[GLOBAL_TARGET].error
+        if rule is None:
+            return (ErrorMode.NO_ERROR, 0, 0.0)
+        return (rule.fault, rule.count, rule.percentage)
+        
+    def set_latency(self, mode: LatencyMode, spec: DelaySpec, count: int = 1, percentage: float = 0.0,
+                    target: FaultTarget = GLOBAL_TARGET):
+        """
+        Set a latency injection rule, replacing any existing rule for the same mode and target.
+
+        Args:
+            mode: The latency mode to use
+            spec: The delay to inject
+            count: Number of requests to delay (default 1)
+            percentage: Percentage of requests to delay (0.0-1.0, 0.0 for count mode)
+            target: (provider, path prefix, rule) the rule applies to, default all requests
+        """
+        if count == 0 and percentage == 0.0:
+            self._profile(target).latency.pop(mode, None)
+        else:
+            self._profile(target).latency[mode] = self._new_rule(spec, count, percentage)
+        self._prune(target)
+
+    def clear_latency(self, mode: Optional[LatencyMode] = None, target: FaultTarget = GLOBAL_TARGET):
+        """Clear one latency rule, or all of them if mode is None."""
+        profile = self.profiles.get(target)
+        if profile is None:
+            return
+        if mode is None:
+            profile.latency.clear()
+        else:
+            profile.latency.pop(mode, None)
+        self._prune(target)
+
+    def take_latency(self, mode: LatencyMode, provider: str, path: str,
+                     rule: Optional[str] = None) -> Optional[DelaySpec]:
+        """
+        Determine if this request should be delayed for the given latency mode.
+
+        The most specific target with an active rule for the mode decides.
+
+        Returns:
+            The delay spec to apply, or None if the request is not delayed
+        """
+        for target in self._matching_targets(provider, path, rule):
+            latency_rule = self.profiles[target].latency.get(mode)
+            if latency_rule is None:
+                continue
+            fired = latency_rule.fire(self.rng)
+            # Count reached zero, drop the rule
+            if latency_rule.is_exhausted():
+                del self.profiles[target].latency[mode]
+                self._prune(target)
+            if not fired:
+                return None
+            self.metrics.latency_injected(mode)
+            return latency_rule.fault
+        return None
+
+    def set_stream_fault(self, spec: StreamFaultSpec, count: int = 1, percentage: float = 0.0,
+                         target: FaultTarget = GLOBAL_TARGET):
+        """
+        Set the mid-stream fault rule, replacing any existing one for the target.
+
+        Args:
+            spec: The stream fault to inject
+            count: Number of streams to affect (default 1)
+            percentage: Percentage of streams to affect (0.0-1.0, 0.0 for count mode)
+            target: (provider, path prefix, rule) the rule applies to, default all requests
+        """
+        rule = None
+        if count > 0 or percentage > 0.0:
+            rule = self._new_rule(spec, count, percentage)
+        self._profile(target).stream = rule
+        self._prune(target)
+
+    def clear_stream_fault(self, target: FaultTarget = GLOBAL_TARGET):
+        """Clear the mid-stream fault rule of a target."""
+        profile = self.profiles.get(target)
+        if profile is None:
+            return
+        profile.stream = None
+        self._prune(target)
+
+    def take_stream_fault(self, provider: str, path: str, rule: Optional[str] = None) -> Optional[StreamFaultSpec]:
+        """
+        Determine if this SSE stream should get a mid-stream fault.
+
+        The most specific target with an active stream fault rule decides.
+
+        Returns:
+            The stream fault to inject, or None to relay the stream untouched
+        """
+        for target in self._matching_targets(provider, path, rule):
+            stream_rule = self.profiles[target].stream
+            if stream_rule is None:
+                continue
+            fired = stream_rule.fire(self.rng)
+            # Count reached zero, drop the rule
+            if stream_rule.is_exhausted():
+                self.profiles[target].stream = None
+                self._prune(target)
+            return stream_rule.fault if fired else None
+        return None
+
+    def get_stream_fault_config(self) -> Optional[str]:
+        """Get a description of the active global stream fault rule."""
+        rule = self.profiles[GLOBAL_TARGET].stream
+        return rule.describe() if rule is not None else None
+
+    def get_latency_config(self) -> dict[LatencyMode, str]:
+        """Get a description of the active global latency rules."""
+        return {mode: rule.describe() for mode, rule in self.profiles[GLOBAL_TARGET].latency.items()}
+
+    def get_targeted_config(self) -> dict[FaultTarget, list[str]]:
+        """Get a description of the rules of every targeted (non-global) profile."""
+        config = {}
+        for target, profile in self.profiles.items():
+            if target == GLOBAL_TARGET:
+                continue
+            descriptions = []
+            if profile.error is not None:
+                descriptions.append(profile.error.describe())
+            for mode, rule in profile.latency.items():
+                descriptions.append(f"{mode.name} {rule.describe()}")
+            if profile.stream is not None:
+                descriptions.append(f"STREAM {profile.stream.describe()}")
+            config[target] = descriptions
+        return config
+
+    def get_state(self) -> dict:
+        """Get the full fault state for the control API."""
+        return {
+            'request_count': self.total_request_count(),
+            'rules': sorted(self.router.rule_names),
+            'profiles': [profile.to_dict(target) for target, profile in self.profiles.items()],
+            **({'scenario': self.scenario.to_dict()} if self.scenario is not None else {}),
+        }
+
+    def upstream_pool(self, provider: str) -> UpstreamPool:
+        """Get the connection pool settings for a provider."""
+        return UpstreamPool({**self.pool_options.get(None, {}), **self.pool_options.get(provider, {})})
+
+    async def start_session(self):
+        """Start an aiohttp client session, with its own connection pool, for every provider."""
+        trace_configs = [self.metrics.trace_config()]
+        for provider in PROVIDER_HOSTS:
+            self.sessions[provider] = self.upstream_pool(provider).create_session(
+                auto_decompress=not self.preserve_encoding,
+                trace_configs=trace_configs
+            )
+
+    async def close_session(self):
+        """Close the aiohttp client sessions."""
+        await asyncio.gather(*(session.close() for session in self.sessions.values()))
+        self.sessions.clear()
+            
+    def route(self, request: Request) -> RouteDecision:
+        """
+        Route a request through the compiled routing table.
+
+        Args:
+            request: The incoming HTTP request
+
+        Returns:
+            The provider, forward-only flag and matching rule for the request
+        """
+        return self.router.route(request.path, request.headers)
+
+    def detect_provider(self, request: Request) -> str:
+        """
+        Detect which provider this request is for based on headers and path.
+
+        Args:
+            request: The incoming HTTP request
+
+        Returns:
+            Provider name
+        """
+        return self.route(request).provider
+
+    def should_always_forward(self, request: Request) -> bool:
+        """
+        Check if this request should always be forwarded (never injected with errors).
+
+        Args:
+            request: The incoming HTTP request
+
+        Returns:
+            True if request should always be forwarded
+        """
+        return self.route(request).forward_only
+
+    def get_target_url(self, request: Request, provider: str, always_forward: bool = False) -> str:
+        """
+        Construct the target URL for the provider.
+
+        Args:
+            request: The incoming HTTP request
+            provider: The detected provider name
+            always_forward: Whether the request was routed as forward-only
+
+        Returns:
+            Full target URL
+        """
+        # Check for provider-specific real host in environment
+        real_host_env = f"{provider.upper()}_REAL_HOST"
+        base_host = os.environ.get(real_host_env)
+
+        # If no provider-specific real host and this is an always-forward path,
+        # check if ANY *_REAL_HOST is set (for auth endpoints where provider detection might fail)
+        if base_host is None and always_forward:
+            for provider_name in PROVIDER_HOSTS.keys():
+                env_var = f"{provider_name.upper()}_REAL_HOST"
+                if env_var in os.environ:
+                    base_host = os.environ[env_var]
+                    logger.info(f"Using {env_var} for always-forward path")
+                    break
+
+        # Fall back to default provider host
+        if base_host is None:
+            base_host = PROVIDER_HOSTS.get(provider, PROVIDER_HOSTS['openai'])
+
+        path = request.path
+        query = request.query_string
+
+        url = f"{base_host}{path}"
+        if query:
+            url = f"{url}?{query}"
+
+        return url
+        
+    def _format_status_line(self) -> str:
+        """Format a one-line status indicator."""
+        mode, count, percentage = self.get_error_config()
+        mode_symbols = {
+            ErrorMode.NO_ERROR: "✅",
+            ErrorMode.CONTEXT_LENGTH: "📏",
+            ErrorMode.RATE_LIMIT: "⏱️",
+            ErrorMode.SERVER_ERROR: "💥"
+        }
+
+        symbol = mode_symbols.get(mode, "❓")
+        mode_name = mode.name.replace('_', ' ').title()
+
+        if mode == ErrorMode.NO_ERROR:
+            line = f"{symbol} {mode_name}"
+        elif percentage > 0.0:
+            line = f"{symbol} {mode_name} ({percentage*100:.0f}%)"
+        elif count > 0:
+            line = f"{symbol} {mode_name} ({count} remaining)"
+        else:
+            line = f"{symbol} {mode_name}"
+
+        for latency_mode, description in self.get_latency_config().items():
+            line += f" | 🐢 {latency_mode.name.replace('_', ' ').title()} {description}"
+        stream_fault = self.get_stream_fault_config()
+        if stream_fault is not None:
+            line += f" | ✂️  Stream {stream_fault}"
+        targeted = self.get_targeted_config()
+        if targeted:
+            line += f" | 🎯 {len(targeted)} targeted"
+        if self.scenario is not None:
+            line += f" | 🎬 {self.scenario.describe()}"
+        return line
+
+    async def handle_request(self, request: Request) -> StreamResponse:
+        """
+        Handle an incoming HTTP request, tracking it in the proxy metrics.
+
+        Args:
+            request: The incoming HTTP request
+
+        Returns:
+            HTTP response (either proxied or error)
+        """
+        # Reserved proxy routes are registered separately; never forward an unknown one
+        if request.path.startswith(CONTROL_PATH_PREFIX):
+            return web.json_response(
+                {'error': {'message': f'Unknown proxy endpoint: {request.path}'}},
+                status=404
+            )
+
+        self.sync()
+        # Route once; everything downstream reuses this decision
+        stats = RequestStats(self.route(request), request.method, request.path)
+        request[REQUEST_STATS_KEY] = stats
+        self.metrics.request_started(stats.provider)
+        status = 500
+        try:
+            response = await self._handle_request(request, stats)
+            status = response.status
+            return response
+        except asyncio.CancelledError:
+            # Client went away before we responded
+            status = 499
+            raise
+        finally:
+            stats.bytes_in = request.content.total_bytes
+            self.metrics.request_finished(stats, status)
+            if self.trace is not None:
+                self.trace.write(stats.trace_record(status, self.worker_id))
+
+    async def on_response_prepare(self, request: Request, response: StreamResponse):
+        """Add the Server-Timing header to a proxied response just before its headers are sent."""
+        stats = request.get(REQUEST_STATS_KEY)
+        if stats is not None:
+            # Added next to any Server-Timing header the provider sent
+            response.headers.add('Server-Timing', stats.server_timing())
+
+    async def handle_metrics(self, request: Request) -> Response:
+        """Serve the proxy metrics in the Prometheus text exposition format."""
+        return Response(
+            body=self.metrics.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    async def handle_mode(self, request: Request) -> Response:
+        """
+        Change fault modes over HTTP (POST /__proxy/mode).
+
+        The body is either a plain-text command with the stdin syntax (e.g. "r 30% @anthropic",
+        with optional ?provider=, ?path= and ?rule= query parameters), or JSON such as
+        {"command": "c 3", "provider": "anthropic", "path": "/v1/messages"}, where "commands"
+        may list several commands and "rule" targets a routing rule. All commands are
+        validated before any is applied.
+
+        Returns:
+            The resulting fault state, or a 400 error if a command is invalid
+        """
+        if request.content_type == 'application/json':
+            try:
+                payload = await request.json()
+            except ValueError:
+                return web.json_response({'error': {'message': 'Invalid JSON body'}}, status=400)
+            if not isinstance(payload, dict):
+                return web.json_response({'error': {'message': 'JSON body must be an object'}}, status=400)
+            commands = payload.get('commands') or [payload.get('command', '')]
+            provider = payload.get('provider')
+            path = payload.get('path')
+            rule = payload.get('rule')
+            if not isinstance(commands, list) or not all(isinstance(command, str) for command in commands):
+                return web.json_response({'error': {'message': '"command" must be a string and "commands" '
+                                                           'a list of strings'}}, status=400)
+            if not all(isinstance(value, (str, type(None))) for value in (provider, path, rule)):
+                return web.json_response({'error': {'message': '"provider", "path" and "rule" must be strings'}},
+                                         status=400)
+        else:
+            commands = [await request.text()]
+            provider = request.query.get('provider')
+            path = request.query.get('path')
+            rule = request.query.get('rule')
+
+        appliers = []
+        for command in commands:
+            apply, error_msg = prepare_command(command, provider, path, rule, self.router.rule_names)
+            if error_msg:
+                return web.json_response({'error': {'message': error_msg}}, status=400)
+            appliers.append(apply)
+        try:
+            self.apply(appliers)
+        except ValueError as e:
+            return web.json_response({'error': {'message': str(e)}}, status=400)
+
+        logger.info(f"🎛️  Control API applied {commands}. Status: {self._format_status_line()}")
+        return web.json_response(self.get_state())
+
+    async def handle_usage(self, request: Request) -> Response:
+        """Report token usage totals per provider and model (GET /__proxy/usage)."""
+        return web.json_response(self.usage.to_dict())
+
+    async def handle_state(self, request: Request) -> Response:
+        """Report the current fault state (GET /__proxy/state)."""
+        self.sync()
+        return web.json_response(self.get_state())
+
+    async def _handle_request(self, request: Request, stats: RequestStats) -> StreamResponse:
+        """
+        Handle an incoming HTTP request.
+
+        Args:
+            request: The incoming HTTP request
+            stats: Measurements for this request, filled in as it is handled
+
+        Returns:
+            HTTP response (either proxied or error)
+        """
+        self.request_count += 1
+        if self.worker_id is not None:
+            self.shared.request_counts[self.worker_id] = self.request_count
+        if self.scenario is not None:
+            # Switch phases as the request arrives, so phase boundaries are exact
+            self.scenario.advance(self, arriving=True)
+        provider = stats.provider
+        rule = stats.route.rule
+        if self.bandwidth_limits:
+            stats.pacer = self._pacer(provider)
+
+        logger.info(f"📨 Request #{self.request_count}: {request.method} {request.path} -> {provider}"
+                    + (f" (rule {rule})" if rule else ""))
+
+        # Check if this request should always be forwarded
+        always_forward = stats.route.forward_only
+        if always_forward:
+            logger.info(f"🔄 Always forwarding: {request.path}")
+        else:
+            if self.unrecovered_stream_faults:
+                self._observe_stream_recovery(provider)
+            # Decide all faults up front, so a control call during the delay can't change them
+            error_mode = self.take_error(provider, request.path, rule)
+            header_delay = self.take_latency(LatencyMode.HEADER_DELAY, provider, request.path, rule)
+
+            # Delay before headers applies to injected errors too - slow failures are realistic
+            if header_delay is not None:
+                delay = header_delay.sample(self.rng)
+                logger.info(f"🐢 Delaying headers by {format_duration(delay)}")
+                await asyncio.sleep(delay)
+                stats.delayed += delay
+
+            if error_mode is not None:
+                error_config = ERROR_CONFIGS.get(provider, ERROR_CONFIGS['openai']).get(
+                    error_mode, ERROR_CONFIGS['openai'][ErrorMode.SERVER_ERROR]
+                )
+                logger.warning(f"💥 Injecting {error_mode.name} error (status {error_config['status']}) for {provider}")
+                # Show status after the injection to reflect the updated state
+                logger.info(f"Status: {self._format_status_line()}")
+                self.metrics.error_injected(error_mode)
+                stats.injected = error_mode.name
+                response = web.json_response(
+                    error_config['body'],
+                    status=error_config['status']
+                )
+                stats.bytes_out += len(response.body)
+                return response
+        
+        # Forward the request to the actual provider
+        target_url = self.get_target_url(request, provider, always_forward)
         
+        fingerprint = None
+        cache_key = None
+        inflight = None
+        limiter = None
         try:
-            # Read request body
-            body = await request.read()
+            if self._needs_request_body():
+                # Features that inspect the body need it buffered
+                body = await request.read()
+                if (self.context is not None or self.rate_limiter is not None) and not always_forward:
+                    response = self._emulate_limits(request, body, stats)
+                    if response is not None:
+                        return response
+                if self.concurrency_limits and not always_forward:
+                    limiter, response = await self._admit(stats)
+                    if response is not None:
+                        return response
+                if self.mock is not None:
+                    return await self._mock_exchange(request, body, stats, inject_latency=not always_forward)
+                fingerprint = request_fingerprint(request.method, request.path, request.query_string, body)
+                if self.cassette and self.cassette.mode == CassetteMode.REPLAY:
+                    return await self._replay_exchange(request, fingerprint, stats, inject_latency=not always_forward)
+                if self.cache is not None and not always_forward:
+                    # The same path and body can mean different things to different providers, and
+                    # clients with different API keys must not see each other's responses
+                    cache_key = f"{provider}-{credential_fingerprint(request.headers)}-{fingerprint}"
+                    cached = await self.cache.get(cache_key)
+                    if cached is not None:
+                        self.metrics.cache_result('hit')
+                        return await self._send_exchange(request, cached, stats, self.cache.timing_scale,
+                                                         True, "🗄️  Serving cached")
+                    leader = self.cache.inflight.get(cache_key)
+                    if leader is not None:
+                        self.metrics.cache_result('coalesced')
+                        response = await self._follow_exchange(request, leader, stats)
+                        if response is not None:
+                            return response
+                        # The leading request failed before responding; go upstream ourselves
+                    else:
+                        self.metrics.cache_result('miss')
+                    inflight = self.cache.lead(cache_key)
+            else:
+                if self.rate_limiter is not None and not always_forward:
+                    response = self._emulate_limits(request, None, stats)
+                    if response is not None:
+                        return response
+                if self.concurrency_limits and not always_forward:
+                    limiter, response = await self._admit(stats)
+                    if response is not None:
+                        return response
+                # Stream the request body upstream as it arrives
+                body = request.content if request.body_exists else None
             
             # Copy headers, excluding hop-by-hop headers
             headers = {k: v for k, v in request.headers.items() 
@@ -496,132 +3627,1062 @@ class ErrorProxy:
                                            'te', 'trailers', 'transfer-encoding', 'upgrade')}
             
             # Make the proxied request
-            async with self.session.request(
+            started_at = time.monotonic()
+            async with self.sessions[provider].request(
                 method=request.method,
                 url=target_url,
                 headers=headers,
                 data=body,
-                allow_redirects=False
+                allow_redirects=False,
+                trace_request_ctx=stats
             ) as resp:
+                headers_at = time.monotonic()
+                stats.ttfb = headers_at - stats.started
+                stats.upstream_ttfb = headers_at - started_at
+
                 # Copy response headers
-                # For non-streaming responses, we need to exclude content-encoding and content-length
-                # because aiohttp.Response.read() automatically decompresses the body
+                # Unless we preserve the encoding, we need to exclude content-encoding and
+                # content-length because aiohttp automatically decompresses the body as we read it
+                excluded_headers = HOP_BY_HOP_RESPONSE_HEADERS
+                if not self.preserve_encoding:
+                    excluded_headers = excluded_headers + ('content-encoding', 'content-length')
                 response_headers = {k: v for k, v in resp.headers.items()
-                                   if k.lower() not in ('connection', 'keep-alive',
-                                                        'transfer-encoding', 'content-encoding',
-                                                        'content-length')}
+                                   if k.lower() not in excluded_headers}
                 
                 # Check if this is a streaming response (SSE)
                 content_type = resp.headers.get('content-type', '').lower()
                 is_streaming = 'text/event-stream' in content_type
-                
+
+                exchange = None
+                if self.cassette is not None or inflight is not None:
+                    exchange = {
+                        'fingerprint': fingerprint,
+                        'method': request.method,
+                        'path': request.path,
+                        'query': request.query_string,
+                        'status': resp.status,
+                        'headers': response_headers,
+                        'streaming': is_streaming,
+                        'header_delay': round(headers_at - started_at, 6),
+                    }
+
+                if inflight is not None:
+                    # Followers share the chunk list and are woken as it grows
+                    inflight.exchange = exchange
+                    inflight.notify()
+
+                tap = None
+                # Compressed bodies passed through untouched can't be inspected
+                if resp.status == 200 and not (self.preserve_encoding and 'content-encoding' in resp.headers):
+                    tap = UsageTap(is_streaming, started_at)
+
+                first_token_delay, chunk_delay, injector = None, None, None
                 if is_streaming:
-                    # Stream the response (Server-Sent Events)
                     logger.info(f"🌊 Streaming response: {resp.status}")
-                    response = StreamResponse(
-                        status=resp.status,
-                        headers=response_headers
-                    )
-                    await response.prepare(request)
+                    if not always_forward:
+                        first_token_delay, chunk_delay = self._take_stream_latency(stats)
+                        injector = self._take_stream_fault(request, stats)
 
-                    # Stream chunks from provider to client
+                # Both SSE and regular responses are relayed chunk by chunk, so proxy memory
+                # stays flat and the first byte goes out as soon as it arrives
+                response = StreamResponse(
+                    status=resp.status,
+                    headers=response_headers
+                )
+                await response.prepare(request)
+
+                chunks = inflight.chunks if inflight is not None else []
+                first_chunk = True
+                relaying = True
+                client_gone = False
+                upstream_failed = False
+                try:
+                    async for chunk in resp.content.iter_any():
+                        if tap is not None:
+                            tap.feed(chunk)
+                        if exchange is not None:
+                            chunks.append((round(time.monotonic() - headers_at, 6), chunk))
+                            if inflight is not None:
+                                inflight.notify()
+                        if not relaying:
+                            # A stream fault ended the client's stream or the client went away; keep
+                            # reading for the cassette, cache and coalesced requests, which get the real stream
+                            continue
+                        try:
+                            await self._delay_chunk(first_chunk, first_token_delay, chunk_delay)
+                            first_chunk = False
+                            relaying = await self._write_chunk(response, chunk, stats, injector)
+                        except ConnectionError as write_error:
+                            logger.warning(f"Stream write error (client disconnected): {write_error}")
+                            relaying = False
+                            client_gone = True
+                        if not relaying and exchange is None:
+                            break
+                except Exception as upstream_error:
+                    logger.warning(f"Upstream stream error: {upstream_error}")
+                    # Don't record or serve a truncated response, and don't end it as if it were complete
+                    upstream_failed = True
+                    exchange = None
+                    if inflight is not None:
+                        inflight.failed = True
+                    if request.transport is not None:
+                        request.transport.close()
+                if not client_gone and not upstream_failed:
                     try:
-                        async for chunk in resp.content.iter_any():
-                            await response.write(chunk)
-                        await response.write_eof()
-                    except Exception as stream_error:
-                        logger.warning(f"Stream write error (client may have disconnected): {stream_error}")
-                    logger.info(f"Status: {self._format_status_line()}")
-                    return response
-                else:
-                    # Non-streaming response - read entire body
-                    response_body = await resp.read()
-                    logger.info(f"✅ Proxied response: {resp.status}")
-                    logger.info(f"Status: {self._format_status_line()}")
+                        await self._end_stream(response, injector)
+                    except ConnectionError as write_error:
+                        logger.warning(f"Stream write error (client disconnected): {write_error}")
+                if is_streaming:
+                    stats.stream_duration = time.monotonic() - headers_at
+                if tap is not None:
+                    self._record_usage(tap, stats)
 
-                    return Response(
-                        body=response_body,
-                        status=resp.status,
-                        headers=response_headers
-                    )
+                if not is_streaming:
+                    logger.info(f"✅ Proxied response: {resp.status}")
+                if exchange is not None:
+                    if inflight is not None:
+                        # Followers have everything they need, so release them before storing. The
+                        # call stays registered until stored, so new arrivals follow it instead of missing
+                        inflight.complete()
+                    if is_streaming:
+                        exchange['chunks'] = [{'delay': delay, **encode_bytes(chunk)} for delay, chunk in chunks]
+                    else:
+                        exchange['body'] = encode_bytes(b''.join(chunk for _, chunk in chunks))
+                    if self.cassette:
+                        self.cassette.record(exchange)
+                        logger.info(f"📼 Recorded {'streaming ' if is_streaming else ''}exchange ({len(chunks)} chunks)")
+                    # Only successful responses are worth serving again
+                    if inflight is not None and resp.status == 200:
+                        await self.cache.put(cache_key, exchange)
+                        logger.info(f"🗄️  Cached {'streaming ' if is_streaming else ''}response")
+                logger.info(f"Status: {self._format_status_line()}")
+                return response
                 
+        except asyncio.TimeoutError:
+            # Connect, read or total timeout of the provider's pool (--pool)
+            logger.warning(f"⏰ Upstream timeout for {provider}: {request.method} {request.path}")
+            return web.json_response(
+                {'error': {'message': f'Proxy error: upstream {provider} timed out'}},
+                status=504
+            )
         except Exception as e:
             logger.error(f"❌ Error proxying request: {e}", exc_info=True)
             return web.json_response(
                 {'error': {'message': f'Proxy error: {str(e)}'}},
                 status=500
             )
+        finally:
+            if inflight is not None:
+                self.cache.finish(cache_key, inflight)
+            if limiter is not None:
+                limiter.release()
+
+    def _needs_request_body(self) -> bool:
+        """Whether the request body must be buffered instead of streamed upstream."""
+        return (self.cassette is not None or self.mock is not None or self.cache is not None
+                or self.context is not None or (self.rate_limiter is not None and self.rate_limiter.needs_tokens))
+
+    def _emulate_limits(self, request: Request, body: Optional[bytes], stats: RequestStats) -> Optional[Response]:
+        """
+        Apply the emulated rate limits and context windows to a request.
+
+        The body is parsed once and its prompt tokens estimated once for both. Rate limits
+        are checked first, as providers do.
+
+        Args:
+            request: The incoming HTTP request
+            body: The buffered request body, or None when it is streamed (rate limits by request only)
+            stats: Measurements for this request
+
+        Returns:
+            The provider's 429 or context length error, or None to go on
+        """
+        payload = parse_json_object(body) if body is not None else None
+        tokens = 0
+        if payload is not None and (self.context is not None or self.rate_limiter.needs_tokens):
+            tokens = self.estimator.estimate_tokens(payload)
+            if self.context is not None:
+                self.metrics.prompt_tokens.observe((stats.provider,), tokens)
+
+        if self.rate_limiter is not None:
+            exceeded = self.rate_limiter.take(stats.provider, request, tokens)
+            if exceeded is not None:
+                if exceeded.retry_after is None:
+                    logger.warning(f"⏱️  Request of ~{tokens} tokens exceeds the {stats.provider} tokens per minute")
+                else:
+                    logger.warning(f"⏱️  Rate limit on {exceeded.resource} reached for {stats.provider}, "
+                                   f"retry after {format_duration(exceeded.retry_after)}")
+                self.metrics.rate_limited(stats.provider, exceeded.resource)
+                self.metrics.error_injected(ErrorMode.RATE_LIMIT)
+                stats.injected = ErrorMode.RATE_LIMIT.name
+                response = web.json_response(exceeded.body, status=429, headers=exceeded.headers)
+                stats.bytes_out += len(response.body)
+                return response
+
+        if self.context is None or payload is None:
+            return None
+        model_limit = self.context.model_limit(stats.path, payload)
+        if model_limit is None or tokens <= model_limit[1]:
+            return None
+        model, limit = model_limit
+        error_config = context_length_error(stats.provider, tokens, limit)
+        logger.warning(f"📏 Prompt of ~{tokens} tokens exceeds the {limit} token context of {model}, "
+                       f"returning the {stats.provider} context length error")
+        self.metrics.error_injected(ErrorMode.CONTEXT_LENGTH)
+        stats.injected = ErrorMode.CONTEXT_LENGTH.name
+        response = web.json_response(error_config['body'], status=error_config['status'])
+        stats.bytes_out += len(response.body)
+        return response
+
+    async def _admit(self, stats: RequestStats) -> tuple[Optional[ConcurrencyLimiter], Optional[Response]]:
+        """
+        Wait for an in-flight slot of the request's provider (--max-in-flight).
+
+        Returns:
+            Tuple of (limiter whose slot the request now holds, or None if no limit applies,
+            overload error response if the request was turned away)
+        """
+        provider = stats.provider
+        limiter = self.limiters.get(provider)
+        if limiter is None:
+            config = self.concurrency_limits.get(provider) or self.concurrency_limits.get(None)
+            if config is None:
+                return (None, None)
+            limiter = self.limiters[provider] = ConcurrencyLimiter(*config)
+
+        waited_from = time.monotonic()
+        reason = await limiter.acquire()
+        stats.queued = time.monotonic() - waited_from
+        if reason is None:
+            self.metrics.queue_wait.observe((provider,), stats.queued)
+            return (limiter, None)
+
+        error_config = ERROR_CONFIGS.get(provider, ERROR_CONFIGS['openai'])[ErrorMode.SERVER_ERROR]
+        logger.warning(f"🚦 {provider} overloaded ({reason.replace('_', ' ')}, {limiter.in_flight} in flight, "
+                       f"{len(limiter.waiters)} queued), returning {error_config['status']}")
+        self.metrics.overloaded(provider, reason)
+        stats.injected = 'OVERLOADED'
+        response = web.json_response(error_config['body'], status=error_config['status'])
+        stats.bytes_out += len(response.body)
+        return (None, response)
+
+    def _record_usage(self, tap: UsageTap, stats: RequestStats):
+        """Add the usage a tap found in a provider response to the usage totals."""
+        usage = tap.finish()
+        if usage is not None:
+            self.usage.record(stats, *usage, worker_id=self.worker_id)
+
+    def _pacer(self, provider: str) -> Optional[BandwidthPacer]:
+        """Get the bandwidth pacer for a response to the provider, None if its bandwidth is unlimited."""
+        key = provider if provider in self.bandwidth_limits else None
+        config = self.bandwidth_limits.get(key)
+        if config is None:
+            return None
+        rate, burst, per_connection = config
+        if per_connection:
+            # Requests on one connection never overlap, so a pacer per request is a pacer per connection
+            return BandwidthPacer(rate, burst)
+        pacer = self.pacers.get(key)
+        if pacer is None:
+            pacer = self.pacers[key] = BandwidthPacer(rate, burst)
+        return pacer
+
+    async def _send_body(self, request: Request, body: bytes, stats: RequestStats, status: int = 200,
+                         headers: Optional[dict] = None, content_type: Optional[str] = None) -> StreamResponse:
+        """Send a complete response body, streamed out at the bandwidth limit if there is one."""
+        if stats.pacer is None:
+            stats.bytes_out += len(body)
+            return Response(body=body, status=status, headers=headers, content_type=content_type)
+        response = StreamResponse(status=status, headers=headers)
+        if content_type is not None:
+            response.content_type = content_type
+        response.content_length = len(body)
+        await response.prepare(request)
+        await send_chunk(response, body, stats)
+        await response.write_eof()
+        return response
+
+    def _take_stream_latency(self, stats: RequestStats) -> tuple[Optional[DelaySpec], Optional[DelaySpec]]:
+        """Decide the time-to-first-token and per-chunk delays for a streaming response."""
+        first_token_delay = self.take_latency(LatencyMode.FIRST_TOKEN_DELAY, stats.provider, stats.path, stats.route.rule)
+        chunk_delay = self.take_latency(LatencyMode.CHUNK_DELAY, stats.provider, stats.path, stats.route.rule)
+        if first_token_delay is not None or chunk_delay is not None:
+            logger.info(f"🐢 Slow stream: first token {first_token_delay or 'no delay'}, per chunk {chunk_delay or 'no delay'}")
+        return first_token_delay, chunk_delay
+
+    def _take_stream_fault(self, request: Request, stats: RequestStats) -> Optional[StreamFaultInjector]:
+        """Decide the mid-stream fault for a streaming response."""
+        spec = self.take_stream_fault(stats.provider, stats.path, stats.route.rule)
+        if spec is None:
+            return None
+        stats.injected = f"STREAM_{spec.mode.name}"
+
+        def on_fire():
+            logger.warning(f"✂️  Injected stream fault: {spec} ({stats.provider})")
+            self.metrics.stream_fault_injected(spec.mode)
+            self.unrecovered_stream_faults[stats.provider] = (spec.mode, time.monotonic())
+
+        return StreamFaultInjector(spec, request, stats.provider, on_fire)
+
+    def _observe_stream_recovery(self, provider: str):
+        """Treat the first request after a mid-stream fault as the client's recovery from it."""
+        fault = self.unrecovered_stream_faults.pop(provider, None)
+        if fault is None:
+            return
+        mode, injected_at = fault
+        recovery_time = time.monotonic() - injected_at
+        self.metrics.stream_fault_recovery.observe((provider, mode.name), recovery_time)
+        logger.info(f"🩹 Next {provider} request {format_duration(recovery_time)} after the {mode.name} stream fault")
+
+    async def _write_chunk(self, response: StreamResponse, chunk: bytes, stats: RequestStats,
+                           injector: Optional[StreamFaultInjector]) -> bool:
+        """
+        Write a response chunk to the client, through the stream fault injector if there is one.
+
+        Returns:
+            False once a stream fault has ended the stream
+        """
+        if injector is not None:
+            return await injector.write(response, chunk, stats)
+        await send_chunk(response, chunk, stats)
+        return True
+
+    async def _end_stream(self, response: StreamResponse, injector: Optional[StreamFaultInjector]):
+        """Finish a relayed response, letting a stream fault decide how it ends."""
+        if injector is not None:
+            await injector.finish(response)
+        else:
+            await response.write_eof()
+
+    async def _delay_chunk(self, first_chunk: bool, first_token_delay: Optional[DelaySpec],
+                           chunk_delay: Optional[DelaySpec]):
+        """Sleep before writing a stream chunk according to the active latency rules."""
+        delay = 0.0
+        if first_chunk and first_token_delay is not None:
+            delay += first_token_delay.sample(self.rng)
+        if chunk_delay is not None:
+            delay += chunk_delay.sample(self.rng)
+        if delay > 0.0:
+            await asyncio.sleep(delay)
+
+    async def _replay_exchange(self, request: Request, fingerprint: str, stats: RequestStats,
+                               inject_latency: bool = True) -> StreamResponse:
+        """
+        Serve a request from the cassette instead of the upstream provider.
+
+        Args:
+            request: The incoming HTTP request
+            fingerprint: Normalized request fingerprint
+            stats: Measurements for this request
+            inject_latency: Whether streaming latency rules apply to this request
+
+        Returns:
+            The recorded response, or a 404 if the cassette has no matching exchange
+        """
+        exchange = self.cassette.lookup(fingerprint)
+        if exchange is None:
+            logger.warning(f"📼 Replay miss: {request.method} {request.path} ({fingerprint[:12]})")
+            return web.json_response(
+                {'error': {'message': f'Proxy error: no cassette entry for {request.method} {request.path}'}},
+                status=404
+            )
+
+        return await self._send_exchange(request, exchange, stats, self.cassette.timing_scale,
+                                         inject_latency, "📼 Replaying")
+
+    async def _send_exchange(self, request: Request, exchange: dict, stats: RequestStats, scale: float,
+                             inject_latency: bool, label: str) -> StreamResponse:
+        """
+        Send a recorded exchange (from the cassette or the response cache) to the client.
+
+        Args:
+            request: The incoming HTTP request
+            exchange: The recorded exchange
+            stats: Measurements for this request
+            scale: Multiplier for the recorded delays (0 = as fast as possible)
+            inject_latency: Whether streaming latency rules apply to this request
+            label: Log prefix naming where the exchange came from
+
+        Returns:
+            The recorded response
+        """
+        if scale > 0.0:
+            header_delay = exchange.get('header_delay', 0.0) * scale
+            await asyncio.sleep(header_delay)
+            stats.delayed += header_delay
+        headers_at = time.monotonic()
+        stats.ttfb = headers_at - stats.started
+
+        if not exchange.get('streaming'):
+            logger.info(f"{label} response: {exchange['status']}")
+            logger.info(f"Status: {self._format_status_line()}")
+            body = decode_bytes(exchange.get('body', {}))
+            return await self._send_body(request, body, stats, exchange['status'], exchange['headers'])
+
+        logger.info(f"{label} streaming response: {exchange['status']}")
+        response = StreamResponse(status=exchange['status'], headers=exchange['headers'])
+        await response.prepare(request)
+
+        first_token_delay, chunk_delay, injector = None, None, None
+        if inject_latency:
+            first_token_delay, chunk_delay = self._take_stream_latency(stats)
+            injector = self._take_stream_fault(request, stats)
+
+        # Schedule chunks against the replay start so sleep overhead doesn't accumulate
+        try:
+            for index, chunk in enumerate(exchange.get('chunks', [])):
+                if scale > 0.0:
+                    remaining = headers_at + chunk['delay'] * scale - time.monotonic()
+                    if remaining > 0:
+                        await asyncio.sleep(remaining)
+                await self._delay_chunk(index == 0, first_token_delay, chunk_delay)
+                if not await self._write_chunk(response, decode_bytes(chunk), stats, injector):
+                    break
+            await self._end_stream(response, injector)
+        except Exception as stream_error:
+            logger.warning(f"Stream write error (client may have disconnected): {stream_error}")
+        stats.stream_duration = time.monotonic() - headers_at
+        logger.info(f"Status: {self._format_status_line()}")
+        return response
+
+    async def _follow_exchange(self, request: Request, inflight: InflightExchange,
+                               stats: RequestStats) -> Optional[StreamResponse]:
+        """
+        Serve a request by following an identical request that is already in flight upstream.
+
+        Chunks are relayed as the leading request receives them, so followers see the same
+        stream with the same timing instead of waiting for the whole response.
+
+        Args:
+            request: The incoming HTTP request
+            inflight: The exchange being received by the leading request
+            stats: Measurements for this request
+
+        Returns:
+            The shared response, or None if the leading request failed before its response started
+        """
+        waited_from = time.monotonic()
+        while inflight.exchange is None:
+            if inflight.done:
+                return None
+            await inflight.changed()
+        # Waiting for the leading request's response headers is waiting for the upstream
+        stats.upstream_ttfb = time.monotonic() - waited_from
+
+        exchange = inflight.exchange
+        logger.info(f"🔗 Coalesced with an identical in-flight request: {exchange['status']}")
+        response = StreamResponse(status=exchange['status'], headers=exchange['headers'])
+        await response.prepare(request)
+        headers_at = time.monotonic()
+        stats.ttfb = headers_at - stats.started
+
+        first_token_delay, chunk_delay, injector = None, None, None
+        if exchange['streaming']:
+            first_token_delay, chunk_delay = self._take_stream_latency(stats)
+            injector = self._take_stream_fault(request, stats)
+
+        index = 0
+        try:
+            relaying = True
+            while True:
+                while relaying and index < len(inflight.chunks):
+                    _, chunk = inflight.chunks[index]
+                    await self._delay_chunk(index == 0, first_token_delay, chunk_delay)
+                    index += 1
+                    relaying = await self._write_chunk(response, chunk, stats, injector)
+                if not relaying or inflight.done:
+                    break
+                await inflight.changed()
+            if relaying and inflight.failed:
+                logger.warning("Leading request's upstream broke off mid-response, closing the connection")
+                if request.transport is not None:
+                    request.transport.close()
+            else:
+                await self._end_stream(response, injector)
+        except Exception as stream_error:
+            logger.warning(f"Stream write error (client may have disconnected): {stream_error}")
+        if exchange['streaming']:
+            stats.stream_duration = time.monotonic() - headers_at
+        return response
+
+    async def _mock_exchange(self, request: Request, body: bytes, stats: RequestStats,
+                             inject_latency: bool = True) -> StreamResponse:
+        """
+        Answer a request with a synthetic completion instead of the upstream provider.
+
+        Args:
+            request: The incoming HTTP request
+            body: The request body
+            stats: Measurements for this request
+            inject_latency: Whether streaming latency rules apply to this request
+
+        Returns:
+            The synthetic completion
+        """
+        mock = self.mock
+        started = time.monotonic()
+        completion = mock.complete(stats.provider, request.path, body)
+        first_token = mock.first_token_delay.sample(self.rng) if mock.first_token_delay is not None else 0.0
+
+        if not completion.streaming:
+            # A non-streaming response arrives once the whole completion is generated
+            delay = first_token + mock.generation_time(completion.token_count)
+            if delay > 0.0:
+                await asyncio.sleep(delay)
+                stats.delayed += delay
+            stats.ttfb = time.monotonic() - stats.started
+            logger.info(f"🤖 Mock {stats.provider} response: {completion.token_count} tokens")
+            # The mock stands in for the provider, so its usage is accounted like the provider's
+            tap = UsageTap(False, started)
+            tap.feed(completion.head[0])
+            self._record_usage(tap, stats)
+            return await self._send_body(request, completion.head[0], stats, content_type=completion.content_type)
+
+        logger.info(f"🤖 Mock {stats.provider} stream: {completion.token_count} tokens")
+        response = StreamResponse(status=200, headers={'Content-Type': completion.content_type,
+                                                       'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        headers_at = time.monotonic()
+        stats.ttfb = headers_at - stats.started
+
+        first_token_delay, chunk_delay, injector = None, None, None
+        if inject_latency:
+            first_token_delay, chunk_delay = self._take_stream_latency(stats)
+            injector = self._take_stream_fault(request, stats)
+
+        # Head events go out with the first token, the tail with the last one
+        events = completion.head + completion.tokens + completion.tail
+        head_count = len(completion.head)
+        last_token = max(len(completion.tokens) - 1, 0)
+        interval = 1.0 / mock.tokens_per_second if mock.tokens_per_second > 0.0 else 0.0
+        tap = UsageTap(True, started)
+
+        def due(index: int) -> float:
+            return first_token + min(max(index - head_count, 0), last_token) * interval
+
+        # Everything due by the time we wake up goes out in one write, so high token
+        # rates don't cost a write per token and sleep overhead doesn't accumulate
+        try:
+            index = 0
+            while index < len(events):
+                remaining = started + due(index) - time.monotonic()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                elapsed = time.monotonic() - started
+                end = index + 1
+                while end < len(events) and due(end) <= elapsed:
+                    end += 1
+                await self._delay_chunk(index == 0, first_token_delay, chunk_delay)
+                chunk = b''.join(events[index:end])
+                tap.feed(chunk)
+                if not await self._write_chunk(response, chunk, stats, injector):
+                    break
+                index = end
+            await self._end_stream(response, injector)
+        except Exception as stream_error:
+            logger.warning(f"Stream write error (client may have disconnected): {stream_error}")
+        stats.stream_duration = time.monotonic() - headers_at
+        self._record_usage(tap, stats)
+        return response
+
+
+def parse_trigger(value_str: str) -> tuple[int, float, Optional[str]]:
+    """
+    Parse a count or percentage trigger (e.g., "4", "0.3", "30%", "*").
+
+    Args:
+        value_str: Trigger string with whitespace removed
+
+    Returns:
+        Tuple of (count, percentage, error_message)
+        If error_message is not None, parsing failed
+    """
+    count = 1
+    percentage = 0.0
+
+    try:
+        # Check for * (100%)
+        if value_str == '*':
+            percentage = 1.0
+            count = 0  # Percentage mode
+        # Check for percentage with % sign (e.g., "30%")
+        elif value_str.endswith('%'):
+            percentage = float(value_str[:-1]) / 100.0
+            if percentage < 0.0 or percentage > 1.0:
+                return (0, 0.0, f"Invalid percentage: {percentage*100:.0f}%. Must be between 0% and 100%")
+            count = 0  # Percentage mode
+        # Check if it's a decimal (percentage as 0.0-1.0)
+        elif '.' in value_str:
+            percentage = float(value_str)
+            if percentage < 0.0 or percentage > 1.0:
+                return (0, 0.0, f"Invalid percentage: {percentage}. Must be between 0.0 and 1.0")
+            count = 0  # Percentage mode
+        else:
+            # It's an integer count
+            count = int(value_str)
+            if count < 0:
+                return (0, 0.0, f"Invalid count: {count}. Must be >= 0")
+    except ValueError:
+        return (0, 0.0, f"Invalid value: '{value_str}'. Must be an integer, decimal, percentage (30%), or * (100%)")
+
+    return (count, percentage, None)
+
+
+def parse_command(command: str) -> tuple[Optional[ErrorMode], int, float, Optional[str]]:
+    """
+    Parse a command string and return the error mode, count, and percentage.
+
+    Args:
+        command: Command string (e.g., "c", "c 3", "r 30%", "u *")
+
+    Returns:
+        Tuple of (mode, count, percentage, error_message)
+        If error_message is not None, parsing failed
+    """
+    # Parse command - remove all whitespace and parse
+    command_no_space = command.strip().replace(" ", "")
+    if not command_no_space:
+        return (None, 0, 0.0, "Empty command")
+
+    # Get the first character (error type letter)
+    error_letter = command_no_space[0].lower()
+
+    # Map letter to ErrorMode
+    mode_map = {
+        'n': ErrorMode.NO_ERROR,
+        'c': ErrorMode.CONTEXT_LENGTH,
+        'r': ErrorMode.RATE_LIMIT,
+        'u': ErrorMode.SERVER_ERROR
+    }
+
+    if error_letter not in mode_map:
+        return (None, 0, 0.0, f"Invalid command: '{error_letter}'. Use n, c, r, or u")
+
+    mode = mode_map[error_letter]
+
+    # Parse the rest as count or percentage
+    count = 1
+    percentage = 0.0
+
+    if len(command_no_space) > 1:
+        count, percentage, error_msg = parse_trigger(command_no_space[1:])
+        if error_msg:
+            return (None, 0, 0.0, error_msg)
+
+    return (mode, count, percentage, None)
+
+
+def parse_latency_command(command: str) -> tuple[Optional[LatencyMode], Optional[DelaySpec], int, float, Optional[str]]:
+    """
+    Parse a latency command string.
+
+    The delay comes first and the optional trigger second, using the same count/percentage
+    semantics as parse_command. A delay of "off" clears the latency mode.
+
+    Args:
+        command: Command string (e.g., "l 2s", "t 500ms-3s 30%", "k exp:50ms *", "l off")
+
+    Returns:
+        Tuple of (mode, delay_spec, count, percentage, error_message)
+        delay_spec is None when the mode should be cleared.
+        If error_message is not None, parsing failed
+    """
+    parts = command.strip().split(None, 2)
+    if not parts or parts[0].lower() not in LATENCY_COMMANDS:
+        return (None, None, 0, 0.0, f"Invalid latency command: '{command}'. Use l, t, or k")
+
+    mode = LATENCY_COMMANDS[parts[0].lower()]
+    if len(parts) < 2:
+        return (None, None, 0, 0.0, f"Missing delay. Example: '{parts[0]} 2s' or '{parts[0]} 500ms-3s 30%'")
+
+    if parts[1].lower() == 'off':
+        return (mode, None, 0, 0.0, None)
+
+    try:
+        spec = DelaySpec.parse(parts[1])
+    except ValueError as e:
+        return (None, None, 0, 0.0, f"Invalid delay: '{parts[1]}' ({e})")
+
+    count = 1
+    percentage = 0.0
+    if len(parts) > 2:
+        count, percentage, error_msg = parse_trigger(parts[2].replace(" ", ""))
+        if error_msg:
+            return (None, None, 0, 0.0, error_msg)
+
+    return (mode, spec, count, percentage, None)
+
+
+def parse_stream_command(command: str) -> tuple[Optional[StreamFaultSpec], int, float, Optional[str]]:
+    """
+    Parse a stream fault command string.
+
+    The fault comes first and the optional trigger second, using the same count/percentage
+    semantics as parse_command. A fault of "off" clears the stream fault.
+
+    Args:
+        command: Command string (e.g., "s abort:5", "s stall:10kb 30%", "s error *", "s off")
+
+    Returns:
+        Tuple of (spec, count, percentage, error_message)
+        spec is None when the stream fault should be cleared.
+        If error_message is not None, parsing failed
+    """
+    parts = command.strip().split(None, 2)
+    if not parts or parts[0].lower() != 's':
+        return (None, 0, 0.0, f"Invalid stream fault command: '{command}'. Use s")
+    if len(parts) < 2:
+        return (None, 0, 0.0, "Missing stream fault. Example: 's abort:5' or 's stall:10kb 30%'")
+
+    if parts[1].lower() == 'off':
+        return (None, 0, 0.0, None)
+
+    try:
+        spec = StreamFaultSpec.parse(parts[1])
+    except ValueError as e:
+        return (None, 0, 0.0, f"Invalid stream fault: '{parts[1]}' ({e})")
+
+    count = 1
+    percentage = 0.0
+    if len(parts) > 2:
+        count, percentage, error_msg = parse_trigger(parts[2].replace(" ", ""))
+        if error_msg:
+            return (None, 0, 0.0, error_msg)
+
+    return (spec, count, percentage, None)
+
+
+def split_target(command: str) -> tuple[str, Optional[str], Optional[str], Optional[str]]:
+    """
+    Split an optional "@provider", "@/path", "@provider/path" or "@rule:NAME" target off a command.
+
+    Returns:
+        Tuple of (command, provider, path, rule)
+    """
+    command, separator, target = command.partition('@')
+    if not separator:
+        return (command.strip(), None, None, None)
+    target = target.strip()
+    if target.startswith('rule:'):
+        return (command.strip(), None, None, target[5:] or None)
+    provider, slash, path = target.partition('/')
+    return (command.strip(), provider or None, slash + path if slash else None, None)
+
+
+def make_target(provider: Optional[str], path: Optional[str], rule: Optional[str] = None,
+                rule_names: Optional[set[str]] = None) -> tuple[Optional[FaultTarget], Optional[str]]:
+    """
+    Validate a provider, path prefix and routing rule and build a fault target.
+
+    Args:
+        provider: Provider to target
+        path: Path prefix to target
+        rule: Routing rule to target
+        rule_names: Names of the loaded routing rules, checked when targeting a rule
+
+    Returns:
+        Tuple of (target, error_message)
+        If error_message is not None, validation failed
+    """
+    if provider:
+        provider = provider.lower()
+        if provider not in PROVIDER_HOSTS:
+            return (None, f"Unknown provider: '{provider}'. Use one of: {', '.join(PROVIDER_HOSTS)}")
+    if path and not path.startswith('/'):
+        return (None, f"Invalid path: '{path}'. Must start with /")
+    if rule and rule_names is not None and rule not in rule_names:
+        known = ', '.join(sorted(rule_names)) or 'none loaded, see --rules'
+        return (None, f"Unknown routing rule: '{rule}'. Rules: {known}")
+    return ((provider or None, path or None, rule or None), None)
+
+
+def prepare_command(command: str, provider: Optional[str] = None, path: Optional[str] = None,
+                    rule: Optional[str] = None, rule_names: Optional[set[str]] = None
+                    ) -> tuple[Optional[Callable[[ErrorProxy], None]], Optional[str]]:
+    """
+    Parse a command without applying it.
+
+    Args:
+        command: Error command (n, c, r, u), latency command (l, t, k) or stream fault
+                 command (s), optionally followed by a target such as "@anthropic", "@openai/v1/chat" or "@rule:staging"
+        provider: Provider to target (overrides a target in the command)
+        path: Path prefix to target (overrides a target in the command)
+        rule: Routing rule to target (overrides a target in the command)
+        rule_names: Names of the loaded routing rules, checked when targeting a rule
+
+    Returns:
+        Tuple of (apply_function, error_message)
+        If error_message is not None, parsing failed
+    """
+    command, command_provider, command_path, command_rule = split_target(command)
+    target, error_msg = make_target(provider or command_provider, path or command_path,
+                                    rule or command_rule, rule_names)
+    if error_msg:
+        return (None, error_msg)
+
+    letter = command[:1].lower()
+
+    if letter in LATENCY_COMMANDS:
+        mode, spec, count, percentage, error_msg = parse_latency_command(command)
+        if error_msg:
+            return (None, error_msg)
+        if spec is None:
+            return (lambda proxy: proxy.clear_latency(mode, target), None)
+        return (lambda proxy: proxy.set_latency(mode, spec, count, percentage, target), None)
+
+    if letter == 's':
+        spec, count, percentage, error_msg = parse_stream_command(command)
+        if error_msg:
+            return (None, error_msg)
+        if spec is None:
+            return (lambda proxy: proxy.clear_stream_fault(target), None)
+        return (lambda proxy: proxy.set_stream_fault(spec, count, percentage, target), None)
 
+    mode, count, percentage, error_msg = parse_command(command)
+    if error_msg:
+        return (None, error_msg)
+    # "n" means pass through untouched, so it clears the target's latency too;
+    # for a provider or path target that means falling back to the global profile
+    if mode == ErrorMode.NO_ERROR:
+        return (lambda proxy: proxy.clear_target(target), None)
+    return (lambda proxy: proxy.set_error_mode(mode, count, percentage, target), None)
 
-def parse_command(command: str) -> tuple[Optional[ErrorMode], int, float, Optional[str]]:
+
+def apply_command(proxy: ErrorProxy, command: str, provider: Optional[str] = None,
+                  path: Optional[str] = None, rule: Optional[str] = None) -> Optional[str]:
     """
-    Parse a command string and return the error mode, count, and percentage.
+    Parse a command and apply it to the proxy.
+
+    Must be called on the event loop thread (or before the loop starts).
 
     Args:
-        command: Command string (e.g., "c", "c 3", "r 30%", "u *")
+        proxy: The ErrorProxy instance
+        command: Error command (n, c, r, u), latency (l, t, k) or stream fault (s) command, optionally with a target
+        provider: Provider to target
+        path: Path prefix to target
+        rule: Routing rule to target
 
     Returns:
-        Tuple of (mode, count, percentage, error_message)
-        If error_message is not None, parsing failed
+        Error message if the command was invalid, None otherwise
     """
-    # Parse command - remove all whitespace and parse
-    command_no_space = command.strip().replace(" ", "")
-    if not command_no_space:
-        return (None, 0, 0.0, "Empty command")
+    apply, error_msg = prepare_command(command, provider, path, rule, proxy.router.rule_names)
+    if error_msg:
+        return error_msg
+    try:
+        proxy.apply([apply])
+    except ValueError as e:
+        return str(e)
+    return None
 
-    # Get the first character (error type letter)
-    error_letter = command_no_space[0].lower()
 
-    # Map letter to ErrorMode
-    mode_map = {
-        'n': ErrorMode.NO_ERROR,
-        'c': ErrorMode.CONTEXT_LENGTH,
-        'r': ErrorMode.RATE_LIMIT,
-        'u': ErrorMode.SERVER_ERROR
-    }
+class ScenarioPhase:
+    """One phase of a fault scenario: commands that stay active for a time or a number of requests."""
 
-    if error_letter not in mode_map:
-        return (None, 0, 0.0, f"Invalid command: '{error_letter}'. Use n, c, r, or u")
+    def __init__(self, name: str, commands: list[str], appliers: list[Callable[[ErrorProxy], None]],
+                 targets: list[FaultTarget], duration: Optional[float] = None, requests: Optional[int] = None):
+        """
+        Initialize the phase.
 
-    mode = mode_map[error_letter]
+        Args:
+            name: Name for logs and status output
+            commands: The phase's commands, as written in the scenario file
+            appliers: The parsed commands
+            targets: Targets the commands change, cleared when the phase ends
+            duration: How long the phase lasts, None for no time limit
+            requests: How many requests the phase lasts, None for no request limit
+        """
+        self.name = name
+        self.commands = commands
+        self.appliers = appliers
+        self.targets = targets
+        self.duration = duration
+        self.requests = requests
 
-    # Parse the rest as count or percentage
-    count = 1
-    percentage = 0.0
+    def describe(self) -> str:
+        """Describe the phase's commands and length."""
+        limits = []
+        if self.duration is not None:
+            limits.append(format_duration(self.duration))
+        if self.requests is not None:
+            limits.append(f"{self.requests} requests")
+        commands = ', '.join(self.commands) or 'pass through'
+        return f"{commands} ({' or '.join(limits) or 'until the end'})"
 
-    if len(command_no_space) > 1:
-        value_str = command_no_space[1:]
 
-        try:
-            # Check for * (100%)
-            if value_str == '*':
-                percentage = 1.0
-                count = 0  # Percentage mode
-            # Check for percentage with % sign (e.g., "30%")
-            elif value_str.endswith('%'):
-                percentage = float(value_str[:-1]) / 100.0
-                if percentage < 0.0 or percentage > 1.0:
-                    return (None, 0, 0.0, f"Invalid percentage: {percentage*100:.0f}%. Must be between 0% and 100%")
-                count = 0  # Percentage mode
-            # Check if it's a decimal (percentage as 0.0-1.0)
-            elif '.' in value_str:
-                percentage = float(value_str)
-                if percentage < 0.0 or percentage > 1.0:
-                    return (None, 0, 0.0, f"Invalid percentage: {percentage}. Must be between 0.0 and 1.0")
-                count = 0  # Percentage mode
-            else:
-                # It's an integer count
-                count = int(value_str)
-                if count < 0:
-                    return (None, 0, 0.0, f"Invalid count: {count}. Must be >= 0")
-        except ValueError:
-            return (None, 0, 0.0, f"Invalid value: '{value_str}'. Must be an integer, decimal, percentage (30%), or * (100%)")
+class Scenario:
+    """
+    A timeline of fault phases loaded from a YAML file (--scenario).
 
-    return (mode, count, percentage, None)
+    Phases run in order, each ending after its duration or number of requests, whichever comes
+    first. Each phase starts from a clean slate: the faults the previous phase set are cleared
+    before its own commands are applied. The timeline starts with the first request, and the
+    scenario's seed makes percentage triggers and sampled delays repeatable.
+    """
+
+    def __init__(self, path: str, phases: list[ScenarioPhase], seed: Optional[int] = None):
+        self.path = path
+        self.phases = phases
+        self.seed = seed
+        self.index = -1  # Current phase, -1 before the first request
+        self.phase_started = 0.0
+        self.phase_start_count = 0  # Requests handled before the current phase
+        self.finished = False
+
+    @classmethod
+    def load(cls, path: str, rule_names: Optional[set[str]] = None) -> 'Scenario':
+        """
+        Load and validate a scenario file. Raises ValueError if it is invalid.
+
+        The file holds an optional "seed" and a "phases" list, e.g.:
+
+            seed: 42
+            phases:
+              - duration: 30s               # pass through
+              - duration: 30s
+                commands: ["r 20%"]
+              - commands: ["c 3"]           # until the end
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                config = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ValueError(f"invalid YAML: {e}")
+        if not isinstance(config, dict) or not isinstance(config.get('phases'), list) or not config['phases']:
+            raise ValueError("expected a mapping with a non-empty 'phases' list")
+        seed = config.get('seed')
+        if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+            raise ValueError(f"seed must be an integer, got {seed!r}")
+
+        phases = []
+        for index, entry in enumerate(config['phases']):
+            if not isinstance(entry, dict):
+                raise ValueError(f"phase {index + 1}: expected a mapping")
+            name = str(entry.get('name', f"phase {index + 1}"))
+            commands = entry.get('commands', [])
+            if isinstance(commands, str):
+                commands = [commands]
+            if not isinstance(commands, list):
+                raise ValueError(f"{name}: 'commands' must be a command or a list of commands")
+
+            appliers, targets = [], []
+            for command in commands:
+                command = str(command)
+                apply, error_msg = prepare_command(command, rule_names=rule_names)
+                if error_msg:
+                    raise ValueError(f"{name}: invalid command '{command}': {error_msg}")
+                target, _ = make_target(*split_target(command)[1:], rule_names)
+                appliers.append(apply)
+                if target not in targets:
+                    targets.append(target)
+
+            duration = None
+            if 'duration' in entry:
+                try:
+                    duration = parse_duration(str(entry['duration']))
+                except ValueError as e:
+                    raise ValueError(f"{name}: invalid duration: {e}")
+            requests = entry.get('requests')
+            if requests is not None and (not isinstance(requests, int) or isinstance(requests, bool) or requests < 1):
+                raise ValueError(f"{name}: 'requests' must be a positive integer")
+            if duration is None and requests is None and index < len(config['phases']) - 1:
+                raise ValueError(f"{name}: only the last phase may run until the end (set duration or requests)")
+            phases.append(ScenarioPhase(name, [str(command) for command in commands], appliers, targets,
+                                        duration, requests))
+        return cls(path, phases, seed)
+
+    @property
+    def phase(self) -> Optional[ScenarioPhase]:
+        """The current phase, None before the first request and after the last phase."""
+        if self.index < 0 or self.finished:
+            return None
+        return self.phases[self.index]
+
+    def advance(self, proxy: ErrorProxy, arriving: bool = False):
+        """
+        Move to the phase that is due now, applying its commands.
+
+        Must be called on the event loop thread.
+
+        Args:
+            proxy: The proxy whose faults the scenario controls
+            arriving: Whether a request just arrived (and is counted, but not yet handled)
+        """
+        if self.finished:
+            return
+        now = time.monotonic()
+        handled = proxy.total_request_count() - (1 if arriving else 0)
+        if self.index < 0:
+            if handled == 0 and not arriving:
+                return
+            # With --workers the parent notices the first requests late; the first phase still counts them
+            self._enter(proxy, 0, now, 0)
+        while True:
+            phase = self.phases[self.index]
+            ended_at = None
+            if phase.duration is not None and now - self.phase_started >= phase.duration:
+                # Keep the timeline exact even if nothing checked it at the boundary
+                ended_at = self.phase_started + phase.duration
+            elif phase.requests is not None and handled - self.phase_start_count >= phase.requests:
+                ended_at = now
+            if ended_at is None:
+                return
+            if self.index + 1 == len(self.phases):
+                self.finished = True
+                proxy.apply([functools.partial(ErrorProxy.clear_target, target=target) for target in phase.targets])
+                logger.info(f"🎬 Scenario finished. Status: {proxy._format_status_line()}")
+                return
+            self._enter(proxy, self.index + 1, ended_at, handled)
+
+    def _enter(self, proxy: ErrorProxy, index: int, started: float, handled: int):
+        """Clear the previous phase's faults and apply the commands of a phase."""
+        appliers = []
+        if self.index >= 0:
+            appliers += [functools.partial(ErrorProxy.clear_target, target=target)
+                         for target in self.phases[self.index].targets]
+        phase = self.phases[index]
+        self.index = index
+        self.phase_started = started
+        self.phase_start_count = handled
+        proxy.apply(appliers + phase.appliers)
+        logger.info(f"🎬 Scenario {phase.name} ({index + 1}/{len(self.phases)}): {phase.describe()}")
+
+    async def run(self, proxy: ErrorProxy, interval: float = 0.05):
+        """Advance through timed phases even while no requests arrive."""
+        while not self.finished:
+            self.advance(proxy)
+            await asyncio.sleep(interval)
+
+    def describe(self) -> str:
+        """Describe the scenario's progress for status output."""
+        if self.finished:
+            return "scenario finished"
+        if self.index < 0:
+            return "scenario waiting for the first request"
+        return f"{self.phases[self.index].name} ({self.index + 1}/{len(self.phases)})"
+
+    def to_dict(self) -> dict:
+        """Serialize the scenario's progress for the control API."""
+        phase = self.phase
+        return {
+            'path': self.path,
+            'seed': self.seed,
+            'phase': phase.name if phase is not None else None,
+            'phase_index': self.index if phase is not None else None,
+            'phases': len(self.phases),
+            'finished': self.finished,
+        }
+
+
+def run_in_loop(loop: asyncio.AbstractEventLoop, func: Callable, *args):
+    """Run a function on the event loop thread from another thread and wait for its result."""
+    async def call():
+        return func(*args)
+    return asyncio.run_coroutine_threadsafe(call(), loop).result()
 
 
 def print_status(proxy: ErrorProxy):
     """Print the current proxy status."""
+    proxy.sync()
     mode, count, percentage = proxy.get_error_config()
     mode_names = {
         ErrorMode.NO_ERROR: "✅ No error (pass through)",
@@ -638,7 +4699,16 @@ def print_status(proxy: ErrorProxy):
         elif count > 0:
             mode_str += f" ({count} remaining)"
     print(f"Current mode: {mode_str}")
-    print(f"Requests handled: {proxy.request_count}")
+    for latency_mode, description in proxy.get_latency_config().items():
+        print(f"Latency: 🐢 {latency_mode.name.replace('_', ' ').title()} {description}")
+    stream_fault = proxy.get_stream_fault_config()
+    if stream_fault is not None:
+        print(f"Stream: ✂️  {stream_fault}")
+    for target, descriptions in proxy.get_targeted_config().items():
+        print(f"Target {format_target(target)}: 🎯 {', '.join(descriptions)}")
+    if proxy.scenario is not None:
+        print(f"Scenario: 🎬 {proxy.scenario.describe()}")
+    print(f"Requests handled: {proxy.total_request_count()}")
     print("=" * 60)
     print("\nCommands:")
     print("  n      - No error (pass through) - permanent")
@@ -649,13 +4719,24 @@ def print_status(proxy: ErrorProxy):
     print("  c *    - Context length exceeded (100% of requests)")
     print("  r      - Rate limit error (1 time)")
     print("  u      - Unknown server error (1 time)")
+    print("  l 2s   - Delay response headers by 2s (1 time)")
+    print("  l 500ms-3s 30%  - Uniform header delay (30% of requests)")
+    print("  t lognormal:1s,8s *  - Time-to-first-token delay on SSE streams (all)")
+    print("  k exp:50ms *  - Delay before every SSE chunk (all streams)")
+    print("  l off  - Clear a latency mode (n clears everything)")
+    print("  s abort:5  - Close the connection after 5 SSE events (1 stream)")
+    print("  s stall:10kb 30%  - Stop sending after 10 KB, keep the connection open (30% of streams)")
+    print("  s malformed:3 *  - Invalid data: line after 3 events; also duplicate:N, error:N, s off")
+    print("  r 3 @anthropic  - Target a provider, path prefix (@/v1/messages) or both")
+    print("  r * @rule:NAME  - Target a routing rule from --rules")
     print("  q      - Quit")
     print()
 
 
 def stdin_reader(proxy: ErrorProxy, loop):
     """Read commands from stdin in a separate thread."""
-    print_status(proxy)
+    # Fault state belongs to the event loop thread, so hand every command over to it
+    run_in_loop(loop, print_status, proxy)
 
     while True:
         try:
@@ -667,16 +4748,14 @@ def stdin_reader(proxy: ErrorProxy, loop):
                 asyncio.run_coroutine_threadsafe(shutdown_server(loop), loop)
                 break
 
-            # Parse the command using the shared parser
-            mode, count, percentage, error_msg = parse_command(command)
+            # Parse and apply the command using the shared parser
+            error_msg = run_in_loop(loop, apply_command, proxy, command)
 
             if error_msg:
                 print(f"❌ {error_msg}")
                 continue
 
-            # Set the error mode
-            proxy.set_error_mode(mode, count, percentage)
-            print_status(proxy)
+            run_in_loop(loop, print_status, proxy)
 
         except EOFError:
             # Handle Ctrl+D
@@ -703,26 +4782,389 @@ async def create_app(proxy: ErrorProxy) -> web.Application:
     Returns:
         Configured aiohttp application
     """
-    app = web.Application()
+    # Request bodies are normally streamed, but record/replay and the mock upstream buffer them,
+    # so lift aiohttp's 1MB default to fit very large contexts
+    app = web.Application(client_max_size=MAX_BUFFERED_BODY_SIZE)
     
     # Setup and teardown
+    background_tasks = []
+
     async def on_startup(app):
         await proxy.start_session()
+        for writer in (proxy.trace, proxy.usage.log):
+            if writer is not None:
+                writer.start()
+        if proxy.scenario is not None:
+            background_tasks.append(asyncio.create_task(proxy.scenario.run(proxy)))
         logger.info("🚀 Proxy session started")
         
     async def on_cleanup(app):
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
         await proxy.close_session()
+        for writer in (proxy.trace, proxy.usage.log):
+            if writer is not None:
+                await writer.close()
         logger.info("🛑 Proxy session closed")
         
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
+    app.on_response_prepare.append(proxy.on_response_prepare)
     
+    # Reserved proxy endpoints, registered before the catch-all so they are never forwarded
+    app.router.add_get(f'{CONTROL_PATH_PREFIX}metrics', proxy.handle_metrics)
+    app.router.add_post(f'{CONTROL_PATH_PREFIX}mode', proxy.handle_mode)
+    app.router.add_get(f'{CONTROL_PATH_PREFIX}state', proxy.handle_state)
+    app.router.add_get(f'{CONTROL_PATH_PREFIX}usage', proxy.handle_usage)
+
     # Route all requests through the proxy
     app.router.add_route('*', '/{path:.*}', proxy.handle_request)
     
     return app
 
 
+def build_proxy(args, shared: Optional[SharedFaultState] = None,
+                worker_id: Optional[int] = None) -> Optional[ErrorProxy]:
+    """
+    Set up the cassette, response cache, mock upstream and routing rules and create the proxy.
+
+    Args:
+        args: Parsed command-line arguments
+        shared: Fault state shared with the other processes (--workers)
+        worker_id: Index of the worker process, None for the parent process
+
+    Returns:
+        The proxy, or None if the configuration is invalid (the error has been printed)
+    """
+    # Set up record/replay cassette
+    cassette = None
+    if args.record:
+        cassette = Cassette(args.record, CassetteMode.RECORD)
+        print(f"📼 Recording upstream exchanges to {args.record}")
+    elif args.replay:
+        if not os.path.exists(args.replay):
+            print(f"❌ Cassette not found: {args.replay}")
+            return None
+        cassette = Cassette(args.replay, CassetteMode.REPLAY, timing_scale=args.replay_timing)
+        print(f"📼 Replaying exchanges from {args.replay} (no network access)")
+
+    # Set up the response cache
+    cache = None
+    if args.cache:
+        if args.replay or args.mock_upstream:
+            print("❌ --cache only applies to real upstream calls, not --replay or --mock-upstream")
+            return None
+        try:
+            cache_ttl = parse_duration(args.cache_ttl)
+        except ValueError as e:
+            print(f"❌ Invalid --cache-ttl: {e}")
+            return None
+        if args.cache_size < 1:
+            print("❌ --cache-size must be at least 1")
+            return None
+        cache = ResponseCache(args.cache, args.cache_size, cache_ttl, timing_scale=args.replay_timing,
+                              shared=shared is not None)
+        ttl_description = format_duration(cache_ttl) if cache_ttl > 0.0 else 'no expiry'
+        print(f"🗄️  Caching responses in {args.cache} ({len(cache.index)} cached, "
+              f"up to {args.cache_size}, {ttl_description})")
+
+    # Set up the synthetic upstream
+    mock = None
+    if args.mock_upstream:
+        try:
+            first_token_delay = DelaySpec.parse(args.mock_ttft) if args.mock_ttft else None
+        except ValueError as e:
+            print(f"❌ Invalid --mock-ttft: {e}")
+            return None
+        if args.mock_tokens < 1 or args.mock_tps < 0.0:
+            print("❌ --mock-tokens must be at least 1 and --mock-tps must not be negative")
+            return None
+        mock = MockUpstream(args.mock_tokens, args.mock_tps, first_token_delay)
+        print(f"🤖 Mock upstream: {mock.describe()} (no network access)")
+
+    # Set up context window emulation
+    context = None
+    if args.emulate_context or args.context_limit:
+        try:
+            limits = [ContextEmulator.parse_limit(value) for value in args.context_limit or []]
+        except ValueError as e:
+            print(f"❌ Invalid --context-limit: {e}")
+            return None
+        if args.chars_per_token <= 0.0:
+            print("❌ --chars-per-token must be positive")
+            return None
+        context = ContextEmulator(limits, args.chars_per_token)
+        overrides = ', '.join(f"{pattern}={limit}" for pattern, limit in limits) or 'built-in limits only'
+        print(f"📏 Emulating context windows ({overrides}, {args.chars_per_token:g} chars/token)")
+
+    # Set up rate limit emulation
+    rate_limiter = None
+    if args.rate_limit:
+        limits = {}
+        try:
+            for value in args.rate_limit:
+                provider, rpm, tpm = RateLimiter.parse_limit(value)
+                limits[provider] = (rpm, tpm)
+        except ValueError as e:
+            print(f"❌ Invalid --rate-limit: {e}")
+            return None
+        rate_limiter = RateLimiter(limits, args.rate_limit_key)
+        for provider, (rpm, tpm) in limits.items():
+            buckets = ', '.join(f"{count} {unit}/min" for count, unit in ((rpm, 'requests'), (tpm, 'tokens')) if count)
+            print(f"⏱️  Rate limiting {provider or 'all providers'}: {buckets} per {args.rate_limit_key}")
+
+    # Set up concurrency limit emulation
+    concurrency_limits = {}
+    try:
+        for value in args.max_in_flight or []:
+            provider, limit, queue_size, timeout = ConcurrencyLimiter.parse_limit(value)
+            concurrency_limits[provider] = (limit, queue_size, timeout)
+    except ValueError as e:
+        print(f"❌ Invalid --max-in-flight: {e}")
+        return None
+    for provider, config in concurrency_limits.items():
+        print(f"🚦 Limiting {provider or 'each provider'} to {ConcurrencyLimiter(*config).describe()}")
+
+    # Set up bandwidth throttling
+    bandwidth_limits = {}
+    try:
+        for value in args.bandwidth or []:
+            provider, rate, burst, per_connection = BandwidthPacer.parse_limit(value)
+            bandwidth_limits[provider] = (rate, burst, per_connection)
+    except ValueError as e:
+        print(f"❌ Invalid --bandwidth: {e}")
+        return None
+    for provider, (rate, burst, per_connection) in bandwidth_limits.items():
+        scope = 'per connection' if per_connection else 'shared'
+        print(f"📶 Throttling {provider or 'all'} responses to {format_rate(rate)} ({scope}, "
+              f"{BandwidthPacer(rate, burst).burst} byte bursts)")
+
+    # Set up the upstream connection pools
+    pool_options = {}
+    try:
+        for value in args.pool or []:
+            provider, options = UpstreamPool.parse_limit(value)
+            pool_options.setdefault(provider, {}).update(options)
+    except ValueError as e:
+        print(f"❌ Invalid --pool: {e}")
+        return None
+    for provider in sorted(pool_options, key=lambda provider: provider or ''):
+        options = {**pool_options.get(None, {}), **pool_options[provider]}
+        print(f"🔌 Upstream pool for {provider or 'each provider'}: {UpstreamPool(options).describe()}")
+
+    trace = None
+    if args.trace:
+        trace = TraceWriter(args.trace)
+        print(f"🧾 Writing request traces to {args.trace}")
+    usage_log = None
+    if args.usage_log:
+        usage_log = TraceWriter(args.usage_log)
+        print(f"🪙 Writing token usage to {args.usage_log}")
+
+    # Compile the routing rules
+    try:
+        router = load_routing_table(args.rules)
+    except (OSError, ValueError) as e:
+        print(f"❌ Error loading routing rules from {args.rules}: {e}")
+        return None
+    if args.rules:
+        print(f"🧭 Loaded {len(router.rule_names)} routing rules from {args.rules}")
+
+    # Load the fault scenario; workers only need its seed, the parent runs the timeline
+    scenario = None
+    if args.scenario:
+        try:
+            scenario = Scenario.load(args.scenario, router.rule_names)
+        except (OSError, ValueError) as e:
+            print(f"❌ Error loading scenario from {args.scenario}: {e}")
+            return None
+        print(f"🎬 Loaded scenario {args.scenario} with {len(scenario.phases)} phases:")
+        for index, phase in enumerate(scenario.phases):
+            print(f"   {index + 1}. {phase.name}: {phase.describe()}")
+    seed = args.seed if args.seed is not None else (scenario.seed if scenario is not None else None)
+    if seed is not None:
+        print(f"🎲 Random seed {seed}")
+
+    # Create proxy instance
+    proxy = ErrorProxy(cassette=cassette, preserve_encoding=args.preserve_encoding, router=router, mock=mock,
+                       cache=cache, context=context, rate_limiter=rate_limiter,
+                       estimator=context or ContextEmulator(chars_per_token=args.chars_per_token),
+                       concurrency_limits=concurrency_limits, bandwidth_limits=bandwidth_limits,
+                       pool_options=pool_options, trace=trace, usage_log=usage_log,
+                       scenario=scenario if worker_id is None else None, seed=seed,
+                       shared=shared, worker_id=worker_id)
+    if args.preserve_encoding:
+        print("🗜️  Preserving upstream content-encoding (no decompression in the proxy)")
+
+    return proxy
+
+
+def apply_startup_modes(proxy: ErrorProxy, args) -> bool:
+    """
+    Install the faults declared in the routing rules and the --mode commands.
+
+    Returns:
+        True on success, False if a command is invalid (the error has been printed)
+    """
+    # Install the faults declared in the rules file
+    for rule in proxy.router.rules:
+        for command in rule.faults:
+            error_msg = apply_command(proxy, command, rule=rule.name)
+            if error_msg:
+                print(f"❌ Error in fault '{command}' of routing rule '{rule.name}': {error_msg}")
+                return False
+
+    # Set initial error mode from command-line arguments
+    if args.mode:
+        for command in args.mode:
+            error_msg = apply_command(proxy, command)
+
+            if error_msg:
+                print(f"❌ Error parsing --mode argument: {error_msg}")
+                print(f"   Example usage: --mode \"c 3\" or --mode \"r 30%\" --mode \"l 2s *\"")
+                return False
+
+        mode, count, percentage = proxy.get_error_config()
+        print()
+        print(f"Initial mode set from command-line arguments:")
+        print(f"  Mode: {mode.name}")
+        if percentage > 0.0:
+            print(f"  Percentage: {percentage*100:.0f}%")
+        elif count > 0:
+            print(f"  Count: {count}")
+        for latency_mode, description in proxy.get_latency_config().items():
+            print(f"  Latency: {latency_mode.name} {description}")
+        stream_fault = proxy.get_stream_fault_config()
+        if stream_fault is not None:
+            print(f"  Stream: {stream_fault}")
+        print()
+
+    return True
+
+
+def start_log_listener(log_format: str) -> logging.handlers.QueueListener:
+    """
+    Move log output to a background thread, so request handling never blocks on a slow terminal or pipe.
+
+    Args:
+        log_format: Format for the log lines
+
+    Returns:
+        The running listener; stop it before exiting to flush the remaining lines
+    """
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(log_format))
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def run_worker(args, shared: SharedFaultState, worker_id: int):
+    """
+    Serve the port as one of the --workers processes.
+
+    Every worker binds the same port with SO_REUSEPORT, so the kernel spreads incoming
+    connections across them. Fault state comes from the parent through shared memory.
+    """
+    # The parent handles Ctrl+C and stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_listener = start_log_listener(
+        f'%(asctime)s - %(name)s - worker {worker_id} - %(levelname)s - %(message)s'
+    )
+
+    # The parent already printed the configuration, don't repeat it once per worker
+    with contextlib.redirect_stdout(io.StringIO()):
+        proxy = build_proxy(args, shared, worker_id)
+    if proxy is None:
+        log_listener.stop()
+        return
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    app = loop.run_until_complete(create_app(proxy))
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, 'localhost', args.port, reuse_port=True)
+    try:
+        loop.run_until_complete(site.start())
+    except OSError as e:
+        logger.error(f"❌ Could not listen on port {args.port}: {e}")
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+        log_listener.stop()
+        return
+
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+        log_listener.stop()
+
+
+def run_workers(proxy: ErrorProxy, args):
+    """
+    Run the --workers processes and keep the interactive commands in the parent.
+
+    The parent does not serve requests itself. Commands from stdin and the workers' control
+    API all go through the shared fault state, so every worker sees the same faults.
+    """
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(args, proxy.shared, worker_id),
+                                name=f'proxy-worker-{worker_id}')
+        for worker_id in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    if not args.no_stdin:
+        stdin_thread = threading.Thread(target=stdin_reader, args=(proxy, loop), daemon=True)
+        stdin_thread.start()
+    else:
+        print("Running in no-stdin mode (background/automated)")
+        print("Use SIGINT (Ctrl+C) or SIGTERM to stop the proxy")
+        print()
+
+    async def watch_workers():
+        # A worker that dies (e.g. the port is taken) would silently shrink capacity, so stop everything
+        while all(worker.is_alive() for worker in workers):
+            await asyncio.sleep(1.0)
+        logger.error("❌ A worker process exited, shutting down")
+        loop.stop()
+
+    tasks = [loop.create_task(watch_workers())]
+    if proxy.scenario is not None:
+        # Phases switch in the parent and reach the workers through the shared fault state
+        tasks.append(loop.create_task(proxy.scenario.run(proxy)))
+    logger.info(f"Proxy running on http://localhost:{args.port} with {args.workers} workers")
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Shutting down proxy...")
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        loop.close()
+
+
 def main():
     """Main entry point."""
     parser = ArgumentParser(description='Provider Error Proxy for Goose testing')
@@ -735,13 +5177,168 @@ def main():
     parser.add_argument(
         '--mode',
         type=str,
-        help='Error mode command (e.g., "c 3", "r 30%%", "u *", "n")'
+        action='append',
+        help='Error, latency or stream fault command (e.g., "c 3", "r 30%%", "u *", "n", "l 2s *", "s abort:5"); repeatable'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Worker processes sharing the port via SO_REUSEPORT, with shared fault state (default: 1)'
+    )
+    parser.add_argument(
+        '--scenario',
+        type=str,
+        metavar='SCENARIO',
+        help='YAML timeline of fault phases to run through, starting with the first request'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        help='Seed for percentage triggers and sampled delays, for repeatable runs (default: the scenario seed, else random)'
     )
     parser.add_argument(
         '--no-stdin',
         action='store_true',
         help='Disable stdin reader (for background/automated mode)'
     )
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        '--record',
+        type=str,
+        metavar='CASSETTE',
+        help='Record every upstream exchange to a JSONL cassette file'
+    )
+    cassette_group.add_argument(
+        '--replay',
+        type=str,
+        metavar='CASSETTE',
+        help='Serve requests from a recorded cassette instead of the real provider (offline)'
+    )
+    cassette_group.add_argument(
+        '--mock-upstream',
+        action='store_true',
+        help='Answer requests with synthetic completions instead of the real provider (offline load testing)'
+    )
+    parser.add_argument(
+        '--mock-tokens',
+        type=int,
+        default=200,
+        help='Mock completion length in tokens (default: 200)'
+    )
+    parser.add_argument(
+        '--mock-tps',
+        type=float,
+        default=0.0,
+        help='Mock generation rate in tokens per second, 0 = as fast as possible (default: 0)'
+    )
+    parser.add_argument(
+        '--mock-ttft',
+        type=str,
+        metavar='DELAY',
+        help='Mock time to first token, e.g. "300ms" or "lognormal:300ms,2s" (default: none)'
+    )
+    parser.add_argument(
+        '--rules',
+        type=str,
+        metavar='RULES',
+        help='YAML routing rules file (provider routing, forward-only paths and per-rule faults)'
+    )
+    parser.add_argument(
+        '--emulate-context',
+        action='store_true',
+        help='Return the provider context length error only when the estimated prompt exceeds the model limit'
+    )
+    parser.add_argument(
+        '--context-limit',
+        type=str,
+        action='append',
+        metavar='MODEL=TOKENS',
+        help='Context window for models matching a glob, e.g. "claude*=100k"; repeatable, implies --emulate-context'
+    )
+    parser.add_argument(
+        '--chars-per-token',
+        type=float,
+        default=4.0,
+        help='Characters per token for the prompt size estimate (default: 4.0)'
+    )
+    parser.add_argument(
+        '--rate-limit',
+        type=str,
+        action='append',
+        metavar='[PROVIDER:]rpm=N,tpm=N',
+        help='Emulate rate limits, e.g. "rpm=60" or "anthropic:rpm=50,tpm=40k"; repeatable'
+    )
+    parser.add_argument(
+        '--rate-limit-key',
+        choices=('api-key', 'provider'),
+        default='api-key',
+        help='Keep separate rate limit buckets per API key or only per provider (default: api-key)'
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        type=str,
+        action='append',
+        metavar='[PROVIDER:]N[,queue=M][,timeout=DURATION]',
+        help='Emulate provider saturation: N requests in flight, M queued, overload errors beyond; repeatable'
+    )
+    parser.add_argument(
+        '--bandwidth',
+        type=str,
+        action='append',
+        metavar='[PROVIDER:]RATE[,burst=SIZE][,per-connection]',
+        help='Throttle response bodies, e.g. "64kbps" or "anthropic:1mbps,per-connection"; repeatable'
+    )
+    parser.add_argument(
+        '--pool',
+        type=str,
+        action='append',
+        metavar='[PROVIDER:]limit=N,keepalive=D,dns-ttl=D,connect=D,read=D,total=D',
+        help='Tune the upstream connection pool (every provider has its own), e.g. "anthropic:limit=8,read=60s"; repeatable'
+    )
+    parser.add_argument(
+        '--trace',
+        type=str,
+        metavar='FILE',
+        help='Append one JSON line per request (provider, status, bytes, timings, injected fault) to FILE'
+    )
+    parser.add_argument(
+        '--usage-log',
+        type=str,
+        metavar='FILE',
+        help='Append the model and token usage of every provider response to FILE as JSON lines'
+    )
+    parser.add_argument(
+        '--preserve-encoding',
+        action='store_true',
+        help='Forward compressed upstream responses byte for byte instead of decompressing them'
+    )
+    parser.add_argument(
+        '--replay-timing',
+        type=float,
+        default=0.0,
+        help='Scale recorded delays during replay and cache hits: 0 = as fast as possible, 1.0 = original timing (default: 0)'
+    )
+    parser.add_argument(
+        '--cache',
+        type=str,
+        metavar='DIR',
+        help='Cache successful upstream responses in DIR and coalesce identical concurrent requests '
+             '(per API key)'
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=1000,
+        help='Cached responses to keep before evicting the least recently used (default: 1000)'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        type=str,
+        default='0',
+        metavar='DURATION',
+        help='How long cached responses stay valid, e.g. "10m" or "24h", 0 = forever (default: 0)'
+    )
 
     args = parser.parse_args()
     
@@ -759,31 +5356,32 @@ def main():
     print(f"  export DATABRICKS_HOST=http://localhost:{args.port}")
     print("=" * 60)
     
-    # Create proxy instance
-    proxy = ErrorProxy()
-
-    # Set initial error mode from command-line arguments
-    if args.mode:
-        mode, count, percentage, error_msg = parse_command(args.mode)
+    if args.workers < 1:
+        print("❌ --workers must be at least 1")
+        return
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        print("❌ --workers needs SO_REUSEPORT, which this platform does not support")
+        return
+    shared = SharedFaultState(args.workers) if args.workers > 1 else None
+    if shared is not None:
+        print(f"👷 Running {args.workers} worker processes with shared fault state")
 
-        if error_msg:
-            print(f"❌ Error parsing --mode argument: {error_msg}")
-            print(f"   Example usage: --mode \"c 3\" or --mode \"r 30%\"")
-            return
+    proxy = build_proxy(args, shared)
+    if proxy is None:
+        return
+    if not apply_startup_modes(proxy, args):
+        return
 
-        proxy.set_error_mode(mode, count, percentage)
-        print()
-        print(f"Initial mode set from command-line arguments:")
-        print(f"  Mode: {mode.name}")
-        if percentage > 0.0:
-            print(f"  Percentage: {percentage*100:.0f}%")
-        elif count > 0:
-            print(f"  Count: {count}")
-        print()
+    if shared is not None:
+        run_workers(proxy, args)
+        return
 
     # Create event loop
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    # Stop cleanly on SIGTERM too, so queued trace records and log lines are written
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    log_listener = start_log_listener(LOG_FORMAT)
 
     # Start stdin reader thread only if not disabled
     if not args.no_stdin:
@@ -812,6 +5410,7 @@ def main():
     finally:
         loop.run_until_complete(runner.cleanup())
         loop.close()
+        log_listener.stop()
 
 
 if __name__ == '__main__':
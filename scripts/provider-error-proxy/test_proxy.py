@@ -0,0 +1,1048 @@
+"""
+Unit tests for the Provider Error Proxy.
+
+Run with:
+    uv run --with pytest pytest test_proxy.py
+"""
+
+import asyncio
+import contextlib
+import itertools
+import json
+import multiprocessing
+import random
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from multidict import CIMultiDict
+
+from proxy import (
+    ALWAYS_FORWARD_PATHS, MALFORMED_SSE_EVENT, BandwidthPacer, Cassette, CassetteMode, ConcurrencyLimiter,
+    ContextEmulator, DelaySpec, ErrorMode, ErrorProxy, FaultRule, MockUpstream, RateLimiter, RequestStats,
+    ResponseCache, RouteDecision, Scenario, SharedFaultState, StreamFaultInjector, StreamFaultSpec, TokenBucket,
+    UsageTap, apply_command, canonicalize_body, context_length_error, create_app, credential_fingerprint,
+    load_routing_table, normalize_usage, parse_command, parse_duration, parse_trigger, request_fingerprint,
+    stream_error_event,
+)
+
+
+# --- Cassette fingerprints ---
+
+def test_fingerprint_ignores_json_formatting_and_key_order():
+    compact = b'{"model":"gpt-4o","messages":[{"role":"user","content":"hi"}]}'
+    spaced = json.dumps({'messages': [{'content': 'hi', 'role': 'user'}], 'model': 'gpt-4o'}, indent=2).encode()
+    assert request_fingerprint('POST', '/v1/chat/completions', '', compact) == \
+        request_fingerprint('post', '/v1/chat/completions', '', spaced)
+
+
+def test_fingerprint_sorts_the_query_string():
+    assert request_fingerprint('GET', '/v1/models', 'b=2&a=1', b'') == \
+        request_fingerprint('GET', '/v1/models', 'a=1&b=2', b'')
+
+
+def test_fingerprint_separates_path_and_body():
+    body = b'{"model": "gpt-4o"}'
+    fingerprint = request_fingerprint('POST', '/v1/chat/completions', '', body)
+    assert fingerprint != request_fingerprint('POST', '/v1/completions', '', body)
+    assert fingerprint != request_fingerprint('POST', '/v1/chat/completions', '', b'{"model": "gpt-4"}')
+
+
+def test_canonicalize_body_keeps_non_json_bodies():
+    assert canonicalize_body(b'not json') == b'not json'
+
+
+def test_cassette_replays_in_order_and_cycles(tmp_path):
+    path = tmp_path / 'cassette.jsonl'
+    recorder = Cassette(str(path), CassetteMode.RECORD)
+    for status in (200, 429):
+        recorder.record({'fingerprint': 'abc', 'status': status})
+
+    player = Cassette(str(path), CassetteMode.REPLAY)
+    assert [player.lookup('abc')['status'] for _ in range(3)] == [200, 429, 200]
+    assert player.lookup('missing') is None
+
+
+# --- Delays ---
+
+@pytest.mark.parametrize('value,seconds', [
+    ('250ms', 0.25), ('1.5s', 1.5), ('10m', 600.0), ('24h', 86400.0), ('2', 2.0), (' 3S ', 3.0),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize('value', ['-1s', 'soon', '', '5d'])
+def test_parse_duration_rejects_invalid_values(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
+
+
+@pytest.mark.parametrize('spec,kind,first,second,text', [
+    ('2s', 'fixed', 2.0, 0.0, '2s'),
+    ('500ms-3s', 'uniform', 0.5, 3.0, '500ms-3s'),
+    ('exp:2s', 'exp', 2.0, 0.0, 'exp(mean 2s)'),
+    ('lognormal:500ms,8s', 'lognormal', 0.5, 8.0, 'lognormal(median 500ms, p99 8s)'),
+])
+def test_delay_spec_forms(spec, kind, first, second, text):
+    delay = DelaySpec.parse(spec)
+    assert (delay.kind, delay.first, delay.second, str(delay)) == (kind, first, second, text)
+
+
+@pytest.mark.parametrize('spec', ['3s-1s', 'lognormal:2s,1s', 'lognormal:0,1s', 'exp:', '1s-'])
+def test_delay_spec_rejects_invalid_forms(spec):
+    with pytest.raises(ValueError):
+        DelaySpec.parse(spec)
+
+
+def test_delay_samples_follow_their_distribution():
+    rng = random.Random(0)
+    assert DelaySpec.parse('2s').sample(rng) == 2.0
+    uniform = [DelaySpec.parse('1s-2s').sample(rng) for _ in range(1000)]
+    assert 1.0 <= min(uniform) and max(uniform) <= 2.0
+    exponential = [DelaySpec.parse('exp:2s').sample(rng) for _ in range(5000)]
+    assert 1.8 < sum(exponential) / len(exponential) < 2.2
+    lognormal = sorted(DelaySpec.parse('lognormal:500ms,8s').sample(rng) for _ in range(5000))
+    assert 0.45 < lognormal[2500] < 0.55 and 6.0 < lognormal[4950] < 10.0
+    assert DelaySpec.parse('exp:0').sample(rng) == 0.0
+
+
+def test_delay_samples_repeat_with_the_seed():
+    delay = DelaySpec.parse('lognormal:500ms,8s')
+    first, second = random.Random(7), random.Random(7)
+    assert [delay.sample(first) for _ in range(10)] == [delay.sample(second) for _ in range(10)]
+
+
+# --- Fault triggers and counting ---
+
+def test_parse_trigger_counts_and_percentages():
+    assert parse_trigger('4') == (4, 0.0, None)
+    assert parse_trigger('30%') == (0, 0.3, None)
+    assert parse_trigger('0.25') == (0, 0.25, None)
+    assert parse_trigger('*') == (0, 1.0, None)
+    for invalid in ('-1', '150%', '1.5', 'x'):
+        assert parse_trigger(invalid)[2] is not None
+
+
+def test_parse_command_defaults_to_one_error():
+    assert parse_command('c') == (ErrorMode.CONTEXT_LENGTH, 1, 0.0, None)
+    assert parse_command('r 3') == (ErrorMode.RATE_LIMIT, 3, 0.0, None)
+    assert parse_command('q')[3] is not None
+
+
+def test_count_rule_fires_exactly_count_times():
+    rule = FaultRule(ErrorMode.SERVER_ERROR, count=3)
+    rng = random.Random(0)
+    assert [rule.fire(rng) for _ in range(5)] == [True, True, True, False, False]
+    assert rule.is_exhausted()
+
+
+def test_percentage_rule_never_exhausts():
+    rule = FaultRule(ErrorMode.SERVER_ERROR, count=0, percentage=0.5)
+    rng = random.Random(0)
+    fired = sum(rule.fire(rng) for _ in range(1000))
+    assert 400 < fired < 600
+    assert not rule.is_exhausted()
+
+
+def test_take_error_consumes_the_count_then_forwards():
+    proxy = ErrorProxy(seed=0)
+    proxy.set_error_mode(ErrorMode.RATE_LIMIT, count=2)
+    results = [proxy.take_error('openai', '/v1/chat/completions') for _ in range(3)]
+    assert results == [ErrorMode.RATE_LIMIT, ErrorMode.RATE_LIMIT, None]
+    assert proxy.get_error_mode() == ErrorMode.NO_ERROR
+
+
+def test_take_error_prefers_the_most_specific_target():
+    proxy = ErrorProxy(seed=0)
+    proxy.set_error_mode(ErrorMode.SERVER_ERROR, count=0, percentage=1.0)
+    proxy.set_error_mode(ErrorMode.CONTEXT_LENGTH, count=1, target=('anthropic', None, None))
+    proxy.set_error_mode(ErrorMode.RATE_LIMIT, count=1, target=('anthropic', '/v1/messages', None))
+
+    assert proxy.take_error('anthropic', '/v1/messages') == ErrorMode.RATE_LIMIT
+    assert proxy.take_error('anthropic', '/v1/messages') == ErrorMode.CONTEXT_LENGTH
+    assert proxy.take_error('anthropic', '/v1/messages') == ErrorMode.SERVER_ERROR
+    assert proxy.take_error('openai', '/v1/chat/completions') == ErrorMode.SERVER_ERROR
+
+
+def test_take_error_applies_rule_targets_only_to_that_rule():
+    proxy = ErrorProxy(seed=0)
+    proxy.set_error_mode(ErrorMode.RATE_LIMIT, count=1, target=(None, None, 'batch'))
+    assert proxy.take_error('openai', '/v1/chat/completions') is None
+    assert proxy.take_error('openai', '/v1/chat/completions', rule='batch') == ErrorMode.RATE_LIMIT
+    assert proxy.take_error('openai', '/v1/chat/completions', rule='batch') is None
+
+
+# --- Control API ---
+
+@contextlib.asynccontextmanager
+async def serve(app: web.Application):
+    """Serve an app on a free local port the way main() does, so handlers outlive their clients."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    try:
+        yield f"http://127.0.0.1:{runner.addresses[0][1]}"
+    finally:
+        await runner.cleanup()
+
+
+async def post_mode(body: bytes, content_type: str = 'application/json') -> tuple[int, dict]:
+    """POST a body to a proxy's mode endpoint."""
+    async with serve(await create_app(ErrorProxy(seed=0))) as proxy, aiohttp.ClientSession() as session:
+        async with session.post(f'{proxy}/__proxy/mode', data=body, headers={'Content-Type': content_type}) as response:
+            return response.status, await response.json()
+
+
+@pytest.mark.parametrize('body', [
+    b'[]', b'"r 30%"', b'5', b'null', b'{"commands": "r 30%"}', b'{"commands": ["r", 3]}', b'{"command": 5}',
+    b'{"command": "r", "provider": ["openai"]}', b'not json',
+])
+def test_mode_rejects_malformed_json_with_a_400(body):
+    status, payload = asyncio.run(post_mode(body))
+    assert status == 400 and 'message' in payload['error']
+
+
+def test_mode_applies_json_and_plain_text_commands():
+    status, state = asyncio.run(post_mode(b'{"command": "c 30%", "provider": "anthropic"}'))
+    assert status == 200
+    assert state['profiles'][1]['provider'] == 'anthropic'
+    assert state['profiles'][1]['error'] == {'mode': 'CONTEXT_LENGTH', 'count': 0, 'percentage': 0.3}
+    status, state = asyncio.run(post_mode(b'r 2 @anthropic', 'text/plain'))
+    assert status == 200
+    assert state['profiles'][1]['error'] == {'mode': 'RATE_LIMIT', 'count': 2, 'percentage': 0.0}
+
+
+# --- Routing ---
+
+def legacy_detect_provider(path: str, headers) -> str:
+    """The provider detection the built-in routing rules replace, kept as the reference."""
+    path = path.lower()
+    if '/serving-endpoints/' in path or '/api/2.0/' in path or '/oidc/' in path:
+        return 'databricks'
+    if 'x-api-key' in headers:
+        return 'anthropic'
+    if 'x-goog-api-key' in headers:
+        return 'google'
+    if 'authorization' in headers and 'bearer' in headers['authorization'].lower():
+        for hints, provider in ((('anthropic', 'messages'), 'anthropic'),
+                                (('google', 'generativelanguage'), 'google'),
+                                (('openrouter',), 'openrouter'), (('tetrate',), 'tetrate'),
+                                (('databricks',), 'databricks')):
+            if any(hint in path for hint in hints):
+                return provider
+    return 'openai'
+
+
+ROUTING_PATHS = [
+    '/v1/chat/completions', '/v1/messages', '/v1beta/models/gemini-pro:generateContent',
+    '/serving-endpoints/claude/invocations', '/api/2.0/clusters/list', '/oidc/v1/token',
+    '/.well-known/openid-configuration', '/oauth/token', '/api/v1/openrouter/chat', '/tetrate/v1/chat',
+    '/databricks/v1/chat', '/google/v1/chat', '/',
+]
+ROUTING_HEADERS = [
+    {}, {'x-api-key': 'k'}, {'x-goog-api-key': 'k'}, {'Authorization': 'Bearer k'},
+    {'Authorization': 'Basic k'}, {'X-Api-Key': 'k', 'Authorization': 'Bearer k'},
+]
+
+
+@pytest.mark.parametrize('path,headers', list(itertools.product(ROUTING_PATHS, ROUTING_HEADERS)))
+def test_builtin_rules_match_the_legacy_detection(path, headers):
+    headers = CIMultiDict(headers)
+    decision = load_routing_table().route(path, headers)
+    assert decision.provider == legacy_detect_provider(path, headers)
+    assert decision.forward_only == any(forward in path for forward in ALWAYS_FORWARD_PATHS)
+    assert decision.rule is None
+
+
+def test_rules_file_is_checked_before_the_builtin_rules(tmp_path):
+    rules = tmp_path / 'rules.yaml'
+    rules.write_text(
+        "rules:\n"
+        "  - name: proxy-gateway\n"
+        "    match: {path_prefix: /gateway/, headers: {x-team: '^ml'}}\n"
+        "    provider: anthropic\n"
+        "  - name: health\n"
+        "    match: {path_regex: '/health$'}\n"
+        "    forward_only: true\n"
+    )
+    table = load_routing_table(str(rules))
+
+    decision = table.route('/gateway/v1/chat/completions', CIMultiDict({'X-Team': 'ml-infra'}))
+    assert (decision.provider, decision.forward_only, decision.rule) == ('anthropic', False, 'proxy-gateway')
+
+    decision = table.route('/gateway/v1/chat/completions', CIMultiDict({'X-Team': 'web'}))
+    assert (decision.provider, decision.rule) == ('openai', None)
+
+    decision = table.route('/v1/health', CIMultiDict({'x-api-key': 'k'}))
+    assert (decision.provider, decision.forward_only, decision.rule) == ('anthropic', True, 'health')
+
+
+def test_invalid_rules_are_rejected(tmp_path):
+    rules = tmp_path / 'rules.yaml'
+    rules.write_text("rules:\n  - name: a\n    match: {path_prefix: /a}\n  - name: a\n    provider: openai\n")
+    with pytest.raises(ValueError, match='duplicate'):
+        load_routing_table(str(rules))
+    rules.write_text("rules:\n  - match: {path_prefix: /a}\n    provider: nobody\n")
+    with pytest.raises(ValueError, match='unknown provider'):
+        load_routing_table(str(rules))
+
+
+# --- Mock upstream ---
+
+@pytest.mark.parametrize('provider,path,body,model', [
+    ('openai', '/v1/chat/completions', {'model': 'gpt-4o'}, 'gpt-4o'),
+    ('databricks', '/serving-endpoints/databricks-claude-sonnet/invocations', {}, 'databricks-claude-sonnet'),
+    ('google', '/v1beta/models/gemini-2.5-pro:generateContent', {}, 'gemini-2.5-pro'),
+    ('openai', '/v1/chat/completions', {}, 'mock-model'),
+])
+def test_mock_upstream_reports_the_requested_model(provider, path, body, model):
+    completion = MockUpstream(tokens=3).complete(provider, path, json.dumps(body).encode())
+    assert json.loads(b''.join(completion.head))['model' if provider != 'google' else 'modelVersion'] == model
+
+
+# --- Response cache ---
+
+def test_cache_evicts_the_least_recently_used_entry(tmp_path):
+    async def run():
+        cache = ResponseCache(str(tmp_path), max_entries=2)
+        await cache.put('a', {'status': 200})
+        await cache.put('b', {'status': 201})
+        assert await cache.get('a') == {'status': 200}  # 'b' is now the least recently used
+        await cache.put('c', {'status': 202})
+        return [await cache.get(key) for key in 'abc']
+
+    assert asyncio.run(run()) == [{'status': 200}, None, {'status': 202}]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['a.json', 'c.json']
+
+
+def test_cache_expires_entries_after_the_ttl(tmp_path):
+    async def run():
+        cache = ResponseCache(str(tmp_path), ttl=60.0)
+        await cache.put('a', {'status': 200})
+        fresh = await cache.get('a')
+        cache.index['a'] -= 61.0
+        return fresh, await cache.get('a'), 'a' in cache.index
+
+    assert asyncio.run(run()) == ({'status': 200}, None, False)
+    assert not (tmp_path / 'a.json').exists()
+
+
+def test_cache_index_is_rebuilt_from_disk(tmp_path):
+    async def run():
+        await ResponseCache(str(tmp_path)).put('a', {'status': 200})
+        return await ResponseCache(str(tmp_path)).get('a')
+
+    assert asyncio.run(run()) == {'status': 200}
+
+
+def test_cache_only_lets_one_request_lead(tmp_path):
+    async def run():
+        cache = ResponseCache(str(tmp_path))
+        leader = cache.lead('a')
+        follower = cache.lead('a')
+        cache.finish('a', leader)
+        return leader, follower, cache.lead('a')
+
+    leader, follower, after = asyncio.run(run())
+    assert leader is not None and follower is None and after is not None
+
+
+def test_credential_fingerprint_separates_api_keys():
+    anonymous = credential_fingerprint(CIMultiDict())
+    alice = credential_fingerprint(CIMultiDict({'Authorization': 'Bearer alice'}))
+    assert alice == credential_fingerprint(CIMultiDict({'authorization': 'Bearer alice'}))
+    assert len({anonymous, alice, credential_fingerprint(CIMultiDict({'Authorization': 'Bearer bob'})),
+                credential_fingerprint(CIMultiDict({'x-api-key': 'alice'}))}) == 4
+
+
+async def coalesced_exchange(tmp_path, monkeypatch, leader_disconnects: bool):
+    """
+    Send two identical requests while the upstream streams its first event and then
+    either finishes or breaks off, optionally dropping the leading client mid-stream.
+
+    Returns:
+        The follower's body or exception, and the cache keys stored
+    """
+    release = asyncio.Event()
+
+    async def upstream_handler(request):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        await response.write(b'data: 1\n\n')
+        await release.wait()
+        if leader_disconnects:
+            await response.write(b'data: 2\n\n')
+            await response.write_eof()
+        else:
+            request.transport.close()
+        return response
+
+    upstream_app = web.Application()
+    upstream_app.router.add_post('/v1/chat/completions', upstream_handler)
+    cache = ResponseCache(str(tmp_path))
+    async with serve(upstream_app) as upstream:
+        monkeypatch.setenv('OPENAI_REAL_HOST', upstream)
+        async with serve(await create_app(ErrorProxy(cache=cache))) as proxy, \
+                aiohttp.ClientSession() as leader, aiohttp.ClientSession() as follower:
+            url = f'{proxy}/v1/chat/completions'
+            request = {'json': {'model': 'gpt-4o'}, 'headers': {'Authorization': 'Bearer k'}}
+
+            async def follow():
+                async with follower.post(url, **request) as response:
+                    return await response.read()
+
+            leading = await leader.post(url, **request)
+            assert await leading.content.readuntil(b'\n\n') == b'data: 1\n\n'
+            following = asyncio.create_task(follow())
+            await asyncio.sleep(0.1)
+            if leader_disconnects:
+                leading.close()
+                await asyncio.sleep(0.1)
+            release.set()
+            if not leader_disconnects:
+                with pytest.raises(aiohttp.ClientPayloadError):
+                    await leading.read()
+            try:
+                result = await following
+            except aiohttp.ClientPayloadError as error:
+                result = error
+    return result, list(cache.index)
+
+
+def test_coalesced_followers_get_the_whole_stream_after_the_leader_disconnects(tmp_path, monkeypatch):
+    body, cached = asyncio.run(coalesced_exchange(tmp_path, monkeypatch, leader_disconnects=True))
+    assert body == b'data: 1\n\ndata: 2\n\n'
+    assert len(cached) == 1
+
+
+def test_coalesced_followers_see_an_upstream_failure_as_a_broken_stream(tmp_path, monkeypatch):
+    result, cached = asyncio.run(coalesced_exchange(tmp_path, monkeypatch, leader_disconnects=False))
+    assert isinstance(result, aiohttp.ClientPayloadError)
+    assert cached == []
+
+
+# --- Shared fault state (--workers) ---
+
+def take_errors_in_worker(shared: SharedFaultState, worker_id: int, attempts: int, fired):
+    """Worker process body: try to take an error on every attempt and count the hits."""
+    worker = ErrorProxy(shared=shared, worker_id=worker_id)
+    worker.sync()
+    fired[worker_id] = sum(worker.take_error('openai', '/v1/chat/completions') is not None for _ in range(attempts))
+
+
+def test_counts_are_exact_across_worker_processes():
+    shared = SharedFaultState(4)
+    assert apply_command(ErrorProxy(shared=shared), 'r 50') is None
+    context = multiprocessing.get_context('fork')
+    fired = context.RawArray('q', 4)
+    workers = [context.Process(target=take_errors_in_worker, args=(shared, worker_id, 40, fired))
+               for worker_id in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(10)
+        assert worker.exitcode == 0
+    assert sum(fired) == 50
+
+
+def test_counts_taken_by_one_worker_are_visible_to_the_others():
+    shared = SharedFaultState(2)
+    first, second = ErrorProxy(shared=shared, worker_id=0), ErrorProxy(shared=shared, worker_id=1)
+    assert apply_command(first, 'u 3') is None
+    second.sync()
+    assert second.get_error_config() == (ErrorMode.SERVER_ERROR, 3, 0.0)
+    assert first.take_error('openai', '/v1/chat/completions') == ErrorMode.SERVER_ERROR
+    assert first.take_error('openai', '/v1/chat/completions') == ErrorMode.SERVER_ERROR
+    assert second.get_error_config() == (ErrorMode.SERVER_ERROR, 1, 0.0)
+    assert second.take_error('openai', '/v1/chat/completions') == ErrorMode.SERVER_ERROR
+    assert first.take_error('openai', '/v1/chat/completions') is None
+
+
+def test_a_stale_snapshot_cannot_take_from_a_reused_slot():
+    shared = SharedFaultState(2)
+    first, second = ErrorProxy(shared=shared, worker_id=0), ErrorProxy(shared=shared, worker_id=1)
+    assert apply_command(first, 'r 1') is None
+    second.sync()
+    stale_rule = second.profiles[(None, None, None)].error
+    # The rule is replaced and its slot handed out again
+    assert apply_command(first, 'u 100%') is None
+    slot, generation = shared.allocate(5, set())
+    while slot != stale_rule.slot:
+        slot, generation = shared.allocate(5, set())
+    assert generation != stale_rule.generation
+    assert not stale_rule.fire(random.Random(0))
+    assert shared.remaining(slot, generation) == 5
+
+
+# --- Stream faults ---
+
+class FakeTransport:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+
+class FakeRequest:
+    def __init__(self):
+        self.transport = FakeTransport()
+
+
+class FakeResponse:
+    """Collects what a StreamResponse would send."""
+
+    def __init__(self):
+        self.body = b''
+        self.ended = False
+
+    async def write(self, data: bytes):
+        self.body += data
+
+    async def write_eof(self):
+        self.ended = True
+
+
+LF_EVENTS = [b'data: {"n": 1}\n\n', b'data: {"n": 2}\n\n', b'data: {"n": 3}\n\n']
+CRLF_EVENTS = [event.replace(b'\n', b'\r\n') for event in LF_EVENTS]
+
+
+def inject(spec: str, chunks: list[bytes], provider: str = 'openai', stall_for: float = 0.05):
+    """
+    Relay chunks through a StreamFaultInjector the way the proxy does.
+
+    Returns:
+        The response, the request and how many times the fault fired
+    """
+    async def run():
+        request, response = FakeRequest(), FakeResponse()
+        fired = []
+        injector = StreamFaultInjector(StreamFaultSpec.parse(spec), request, provider, lambda: fired.append(1))
+        stats = RequestStats(RouteDecision(provider, False, None), 'POST', '/v1/chat/completions')
+        for chunk in chunks:
+            if not await injector.write(response, chunk, stats):
+                break
+        # A stall only ends when the client gives up
+        asyncio.get_running_loop().call_later(stall_for, request.transport.close)
+        await injector.finish(response)
+        assert stats.bytes_out == len(response.body)
+        return response, request, len(fired)
+
+    return asyncio.run(run())
+
+
+def rechunk(data: bytes, size: int) -> list[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('events', [LF_EVENTS, CRLF_EVENTS], ids=['lf', 'crlf'])
+@pytest.mark.parametrize('size', [1, 5, 1000], ids=['bytewise', 'split', 'whole'])
+def test_duplicate_repeats_exactly_one_whole_event(events, size):
+    response, _, fired = inject('duplicate:2', rechunk(b''.join(events), size))
+    assert response.body == events[0] + events[1] + events[1] + events[2]
+    assert response.ended and fired == 1
+
+
+@pytest.mark.parametrize('events', [LF_EVENTS, CRLF_EVENTS], ids=['lf', 'crlf'])
+def test_malformed_event_is_inserted_at_an_event_boundary(events):
+    response, _, _ = inject('malformed:1', rechunk(b''.join(events), 7))
+    assert response.body == events[0] + MALFORMED_SSE_EVENT + events[1] + events[2]
+
+
+def test_abort_truncates_the_stream_and_closes_the_connection():
+    response, request, fired = inject('abort:2', [b''.join(LF_EVENTS)])
+    assert response.body == LF_EVENTS[0] + LF_EVENTS[1]
+    assert request.transport.closed and not response.ended and fired == 1
+
+
+def test_abort_at_a_byte_position_cuts_mid_event():
+    response, request, _ = inject('abort:20b', rechunk(b''.join(LF_EVENTS), 8))
+    assert response.body == b''.join(LF_EVENTS)[:20]
+    assert request.transport.closed and not response.ended
+
+
+@pytest.mark.parametrize('provider', ['openai', 'anthropic'])
+def test_error_event_ends_the_stream_cleanly(provider):
+    response, request, _ = inject('error:1', [LF_EVENTS[0], LF_EVENTS[1] + LF_EVENTS[2]], provider)
+    assert response.body == LF_EVENTS[0] + stream_error_event(provider)
+    assert response.ended and not request.transport.closed
+    assert stream_error_event('anthropic').startswith(b'event: error\n')
+
+
+def test_stall_keeps_the_connection_open_until_the_client_gives_up():
+    response, request, _ = inject('stall:1', [b''.join(LF_EVENTS)], stall_for=0.3)
+    assert response.body == LF_EVENTS[0]
+    assert not response.ended and request.transport.closed
+
+
+def test_faults_later_than_the_stream_never_fire():
+    response, _, fired = inject('duplicate:5', LF_EVENTS)
+    assert response.body == b''.join(LF_EVENTS) and response.ended and fired == 0
+
+
+# --- Context windows ---
+
+def test_estimate_counts_prompt_text_and_message_overhead():
+    emulator = ContextEmulator(chars_per_token=4.0)
+    payload = {
+        'model': 'gpt-4o',
+        'messages': [{'role': 'user', 'content': 'x' * 400}, {'role': 'assistant', 'content': 'y' * 396}],
+        'tools': [{'name': 'shell', 'description': 'z' * 100}],
+        'metadata': {'notes': 'w' * 10000},  # Not part of the prompt
+    }
+    # 'user', 'assistant', 'shell' and the text: 812 + 100 characters, plus 2 messages
+    assert emulator.estimate_tokens(payload) == (4 + 9 + 400 + 396 + 5 + 100) // 4 + 2 * 4
+
+
+def test_estimate_counts_images_at_a_fixed_cost():
+    emulator = ContextEmulator()
+    data = 'A' * 100000
+    openai = {'messages': [{'role': 'user', 'content': [{'type': 'image_url', 'image_url': {'url': data}}]}]}
+    google = {'contents': [{'parts': [{'inlineData': {'mimeType': 'image/png', 'data': data}}]}]}
+    anthropic = {'messages': [{'role': 'user', 'content': [{'type': 'image', 'source': {'data': data}}]}]}
+    for payload in (openai, google, anthropic):
+        assert ContextEmulator.IMAGE_TOKENS <= emulator.estimate_tokens(payload) < ContextEmulator.IMAGE_TOKENS + 10
+
+
+def test_model_limits_are_matched_by_glob_with_overrides_first():
+    emulator = ContextEmulator([('claude-3-haiku*', 50000)])
+    assert emulator.limit_for('claude-3-haiku-20240307') == 50000
+    assert emulator.limit_for('Claude-Sonnet-4') == 200000
+    assert emulator.limit_for('gpt-4o-mini') == 128000
+    assert emulator.model_limit('/v1beta/models/gemini-2.5-pro:generateContent', {}) == ('gemini-2.5-pro', 1048576)
+    assert emulator.model_limit('/serving-endpoints/databricks-claude/invocations', {}) == \
+        ('databricks-claude', 200000)
+    assert emulator.model_limit('/v1/chat/completions', {}) is None
+
+
+def test_parse_context_limit():
+    assert ContextEmulator.parse_limit('gpt-4o=32k') == ('gpt-4o', 32000)
+    assert ContextEmulator.parse_limit(' claude* = 1.5m') == ('claude*', 1500000)
+    for invalid in ('gpt-4o', '=5', 'gpt-4o=0'):
+        with pytest.raises(ValueError):
+            ContextEmulator.parse_limit(invalid)
+
+
+@pytest.mark.parametrize('provider,status,message', [
+    ('openai', 400, "This model's maximum context length is 1000 tokens. However, your messages resulted in 1500"),
+    ('anthropic', 400, 'prompt is too long: 1500 tokens > 1000 maximum'),
+    ('google', 400, 'The input token count (1500) exceeds the maximum number of tokens allowed (1000).'),
+    ('databricks', 400, 'The total number of tokens in the request exceeds the maximum allowed (1500 > 1000)'),
+])
+def test_context_length_errors_use_each_providers_format(provider, status, message):
+    error = context_length_error(provider, 1500, 1000)
+    assert error['status'] == status
+    body_message = error['body']['message'] if provider == 'databricks' else error['body']['error']['message']
+    assert body_message.startswith(message)
+
+
+def test_prompts_over_the_context_window_are_cut_off():
+    proxy = ErrorProxy(context=ContextEmulator([('tiny', 100)], chars_per_token=1.0))
+
+    def emulate(chars: int):
+        body = json.dumps({'model': 'tiny', 'messages': [{'role': 'user', 'content': 'x' * chars}]}).encode()
+        stats = RequestStats(RouteDecision('anthropic', False, None), 'POST', '/v1/messages')
+        return proxy._emulate_limits(make_mocked_request('POST', '/v1/messages'), body, stats), stats
+
+    # 'user' and the overhead of one message
+    response, stats = emulate(100 - 4 - 4)
+    assert response is None and stats.injected is None
+    response, stats = emulate(100 - 4 - 4 + 1)
+    assert response.status == 400 and stats.injected == 'CONTEXT_LENGTH'
+    assert json.loads(response.body)['error']['message'] == 'prompt is too long: 101 tokens > 100 maximum'
+
+
+# --- Rate limits ---
+
+def test_token_bucket_refills_continuously_up_to_its_capacity():
+    bucket = TokenBucket(600)  # 10 per second
+    bucket.level = 0.0
+    bucket.refill(bucket.updated + 2.0)
+    assert bucket.level == pytest.approx(20.0)
+    assert bucket.wait_time(50) == pytest.approx(3.0)
+    assert bucket.wait_time(10) == 0.0
+    assert bucket.reset_time() == pytest.approx(58.0)
+    bucket.refill(bucket.updated + 3600.0)
+    assert bucket.level == 600.0
+
+
+def test_token_bucket_never_fits_more_than_its_capacity():
+    assert TokenBucket(600).wait_time(601) == float('inf')
+
+
+def limited_request(key: str = 'Bearer alice'):
+    return make_mocked_request('POST', '/v1/chat/completions', headers={'Authorization': key})
+
+
+def test_rate_limiter_refuses_with_the_providers_headers():
+    limiter = RateLimiter({None: (2, 1000)})
+    assert limiter.take('openai', limited_request(), 400) is None
+    assert limiter.take('openai', limited_request(), 400) is None
+    exceeded = limiter.take('openai', limited_request(), 100)
+    assert exceeded.resource == 'requests'
+    assert exceeded.retry_after == pytest.approx(30.0, abs=0.1)
+    assert exceeded.headers['retry-after'] == '30'
+    assert exceeded.headers['x-ratelimit-limit-requests'] == '2'
+    assert exceeded.headers['x-ratelimit-remaining-requests'] == '0'
+    assert exceeded.headers['x-ratelimit-remaining-tokens'] == '200'
+    assert 'Limit 2, Used 2, Requested 1' in exceeded.body['error']['message']
+    # Other API keys have their own buckets
+    assert limiter.take('openai', limited_request('Bearer bob'), 100) is None
+
+
+def test_rate_limiter_reports_the_bucket_that_ran_out():
+    limiter = RateLimiter({'anthropic': (0, 600)})
+    assert limiter.take('openai', limited_request(), 10 ** 6) is None  # No limit for other providers
+    assert limiter.take('anthropic', limited_request(), 500) is None
+    exceeded = limiter.take('anthropic', limited_request(), 200)
+    assert (exceeded.resource, exceeded.retry_after) == ('tokens', pytest.approx(10.0, abs=0.1))
+    assert exceeded.headers['retry-after'] == '10'
+    assert exceeded.headers['anthropic-ratelimit-tokens-remaining'] == '100'
+    assert 'anthropic-ratelimit-requests-limit' not in exceeded.headers
+
+
+def test_requests_larger_than_the_token_limit_are_never_retryable():
+    limiter = RateLimiter({None: (60, 1000)})
+    exceeded = limiter.take('openai', limited_request(), 1001)
+    assert (exceeded.resource, exceeded.retry_after) == ('tokens', None)
+    assert 'retry-after' not in exceeded.headers
+    assert exceeded.body['error']['message'].startswith('Request too large for tokens per min: Limit 1000')
+    # Nothing was taken from the buckets
+    assert exceeded.headers['x-ratelimit-remaining-requests'] == '60'
+    google = limiter.take('google', limited_request(), 1001)
+    assert 'details' not in google.body['error']
+
+
+def test_parse_limit():
+    assert RateLimiter.parse_limit('anthropic:rpm=50,tpm=40k') == ('anthropic', 50, 40000)
+    assert RateLimiter.parse_limit('tpm=1.5m') == (None, 0, 1500000)
+    for invalid in ('nobody:rpm=1', 'rpm', 'rpm=0', 'qps=3'):
+        with pytest.raises(ValueError):
+            RateLimiter.parse_limit(invalid)
+
+
+# --- Concurrency limits ---
+
+def test_requests_beyond_the_limit_wait_in_order():
+    async def run():
+        limiter = ConcurrencyLimiter(1, queue_size=2)
+        order = []
+
+        async def request(name: str):
+            assert await limiter.acquire() is None
+            order.append(name)
+            await asyncio.sleep(0)
+            limiter.release()
+
+        await asyncio.gather(*(request(name) for name in 'abc'))
+        return order, limiter.in_flight, len(limiter.waiters)
+
+    assert asyncio.run(run()) == (['a', 'b', 'c'], 0, 0)
+
+
+def test_a_full_queue_turns_requests_away():
+    async def run():
+        limiter = ConcurrencyLimiter(1, queue_size=1)
+        assert await limiter.acquire() is None
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        refused = await limiter.acquire()
+        limiter.release()
+        return refused, await waiting, limiter.in_flight
+
+    assert asyncio.run(run()) == ('queue_full', None, 1)
+
+
+def test_no_queue_turns_away_everything_beyond_the_limit():
+    async def run():
+        limiter = ConcurrencyLimiter(2)
+        return [await limiter.acquire() for _ in range(3)]
+
+    assert asyncio.run(run()) == [None, None, 'queue_full']
+
+
+def test_requests_waiting_past_the_timeout_give_up_their_place():
+    async def run():
+        limiter = ConcurrencyLimiter(1, queue_size=4, timeout=0.01)
+        assert await limiter.acquire() is None
+        result = await limiter.acquire()
+        # The slot goes back to the pool, not to the request that gave up
+        limiter.release()
+        return result, limiter.in_flight, len(limiter.waiters)
+
+    assert asyncio.run(run()) == ('timeout', 0, 0)
+
+
+def test_cancelled_waiters_leave_the_queue():
+    async def run():
+        limiter = ConcurrencyLimiter(1, queue_size=4)
+        assert await limiter.acquire() is None
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        return len(limiter.waiters)
+
+    assert asyncio.run(run()) == 0
+
+
+def test_turned_away_requests_get_the_providers_overload_error():
+    async def run():
+        proxy = ErrorProxy(concurrency_limits={'anthropic': (1, 0, 0.0)})
+        stats = [RequestStats(RouteDecision(provider, False, None), 'POST', '/v1/messages')
+                 for provider in ('anthropic', 'anthropic', 'openai')]
+        return [await proxy._admit(request_stats) for request_stats in stats], stats
+
+    (held, refused, unlimited), stats = asyncio.run(run())
+    assert held[0] is not None and held[1] is None
+    assert refused[0] is None and refused[1].status == 529 and stats[1].injected == 'OVERLOADED'
+    assert json.loads(refused[1].body)['error']['type'] == 'overloaded_error'
+    assert unlimited == (None, None)
+
+
+def test_parse_concurrency_limit():
+    assert ConcurrencyLimiter.parse_limit('anthropic:4,queue=16,timeout=30s') == ('anthropic', 4, 16, 30.0)
+    assert ConcurrencyLimiter.parse_limit('8') == (None, 8, 0, 0.0)
+    for invalid in ('0', 'nobody:4', '4,queue=-1', '4,burst=2'):
+        with pytest.raises(ValueError):
+            ConcurrencyLimiter.parse_limit(invalid)
+
+
+# --- Scenarios ---
+
+SCENARIO = """
+seed: 42
+phases:
+  - name: warmup
+    requests: 3
+  - name: flaky
+    requests: 5
+    commands: ["r 50%"]
+  - name: outage
+    duration: 10s
+    commands: ["u 100%"]
+  - name: recovery
+"""
+
+
+def load_scenario(tmp_path, text: str = SCENARIO) -> Scenario:
+    path = tmp_path / 'scenario.yaml'
+    path.write_text(text)
+    return Scenario.load(str(path))
+
+
+def run_scenario(scenario: Scenario, requests: int, seed=None) -> list[tuple[str, ErrorMode]]:
+    """Send requests through a scenario one at a time; returns the phase and injected error of each."""
+    proxy = ErrorProxy(seed=scenario.seed if seed is None else seed, scenario=scenario)
+    results = []
+    for _ in range(requests):
+        proxy.request_count += 1
+        scenario.advance(proxy, arriving=True)
+        results.append((scenario.phase.name, proxy.take_error('openai', '/v1/chat/completions')))
+    return results
+
+
+def test_scenario_phases_switch_at_their_request_offsets(tmp_path):
+    phases = [phase for phase, _ in run_scenario(load_scenario(tmp_path), 10)]
+    assert phases == ['warmup'] * 3 + ['flaky'] * 5 + ['outage'] * 2
+
+
+def test_scenario_seed_reproduces_the_same_injections(tmp_path):
+    first = run_scenario(load_scenario(tmp_path), 10)
+    assert run_scenario(load_scenario(tmp_path), 10) == first
+    assert all(error is None for _, error in first[:3])
+    assert all(error == ErrorMode.SERVER_ERROR for _, error in first[8:])
+    flaky = [error for phase, error in first if phase == 'flaky']
+    assert ErrorMode.RATE_LIMIT in flaky and None in flaky
+    # Another seed draws another sequence
+    seeds = [[error for _, error in run_scenario(load_scenario(tmp_path), 8, seed)][3:] for seed in range(8)]
+    assert len({tuple(errors) for errors in seeds}) > 1
+
+
+def test_timed_phases_end_exactly_at_their_duration(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('proxy.time.monotonic', lambda: now[0])
+    scenario = load_scenario(tmp_path)
+    run_scenario(scenario, 8)
+    proxy = ErrorProxy(scenario=scenario)
+    proxy.request_count = 8
+    scenario.advance(proxy)
+    assert scenario.phase.name == 'outage' and scenario.phase_started == 1000.0
+    now[0] += 9.9
+    scenario.advance(proxy)
+    assert scenario.phase.name == 'outage'
+    # Checked late, the next phase still starts at the boundary
+    now[0] += 0.5
+    scenario.advance(proxy)
+    assert scenario.phase.name == 'recovery' and scenario.phase_started == 1010.0
+    assert proxy.take_error('openai', '/v1/chat/completions') is None
+
+
+def test_scenario_phases_reach_the_workers(tmp_path):
+    shared = SharedFaultState(2)
+    scenario = load_scenario(tmp_path, "phases:\n  - requests: 2\n  - commands: ['c 3 @anthropic']\n")
+    parent = ErrorProxy(shared=shared, scenario=scenario)
+    workers = [ErrorProxy(shared=shared, worker_id=worker_id) for worker_id in range(2)]
+
+    def handle(worker: ErrorProxy) -> ErrorMode:
+        # What handle_request does in a worker; the parent's scenario task advances on its own
+        worker.sync()
+        worker.request_count += 1
+        shared.request_counts[worker.worker_id] = worker.request_count
+        return worker.take_error('anthropic', '/v1/messages')
+
+    assert [handle(workers[0]), handle(workers[1])] == [None, None]
+    scenario.advance(parent)
+    assert scenario.phase.name == 'phase 2'
+    errors = [handle(workers[i % 2]) for i in range(5)]
+    assert errors == [ErrorMode.CONTEXT_LENGTH] * 3 + [None] * 2
+
+
+# --- Bandwidth ---
+
+class Recorder:
+    """A response that records when each write went out on a fake clock."""
+
+    def __init__(self, clock: list[float]):
+        self.clock = clock
+        self.writes: list[tuple[float, int]] = []
+
+    async def write(self, data: bytes):
+        self.writes.append((self.clock[0], len(data)))
+
+
+def fake_clock(monkeypatch) -> list[float]:
+    """Replace the proxy's clock with one that only moves while something sleeps."""
+    clock = [0.0]
+
+    async def sleep(seconds: float):
+        clock[0] += seconds
+
+    monkeypatch.setattr('proxy.time.monotonic', lambda: clock[0])
+    monkeypatch.setattr('proxy.asyncio.sleep', sleep)
+    return clock
+
+
+def paced(clock: list[float], pacer: BandwidthPacer, *bodies: bytes) -> list[Recorder]:
+    """Send bodies through a pacer concurrently, one response each."""
+    responses = [Recorder(clock) for _ in bodies]
+
+    async def run():
+        await asyncio.gather(*(pacer.send(response, body) for response, body in zip(responses, bodies)))
+
+    asyncio.run(run())
+    return responses
+
+
+def test_writes_within_the_burst_go_out_immediately(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    (response,) = paced(clock, BandwidthPacer(10000, burst=1000), b'x' * 1000)
+    assert response.writes == [(0.0, 1000)]
+
+
+def test_large_writes_trickle_out_at_the_rate(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    (response,) = paced(clock, BandwidthPacer(10000, burst=1000), b'x' * 3500)
+    assert [size for _, size in response.writes] == [1000, 1000, 1000, 500]
+    assert [round(at, 6) for at, _ in response.writes] == [0.0, 0.1, 0.2, 0.25]
+
+
+def test_responses_sharing_a_pacer_share_its_bandwidth(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    first, second = paced(clock, BandwidthPacer(10000, burst=1000), b'x' * 2000, b'x' * 2000)
+    # 4000 bytes at 10000 B/s, less the initial burst
+    assert round(max(at for at, _ in first.writes + second.writes), 6) == 0.3
+
+
+def test_default_burst_is_50ms_of_bandwidth():
+    assert BandwidthPacer(1e6).burst == 50000
+    assert BandwidthPacer(1000).burst == BandwidthPacer.MIN_BURST
+
+
+def test_parse_bandwidth_limit():
+    assert BandwidthPacer.parse_limit('anthropic:1mbps,per-connection') == ('anthropic', 125000.0, 0, True)
+    assert BandwidthPacer.parse_limit('64kb/s,burst=8kb') == (None, 65536.0, 8192, False)
+    for invalid in ('nobody:1mbps', '0kbps', '1mbps,burst=0', '1mbps,fast'):
+        with pytest.raises(ValueError):
+            BandwidthPacer.parse_limit(invalid)
+
+
+# --- Token usage ---
+
+@pytest.mark.parametrize('usage,expected', [
+    ({'input_tokens': 100, 'cache_creation_input_tokens': 20, 'cache_read_input_tokens': 30, 'output_tokens': 7},
+     (150, 7, 30)),
+    ({'prompt_tokens': 120, 'completion_tokens': 8, 'prompt_tokens_details': {'cached_tokens': 64}}, (120, 8, 64)),
+    ({'input_tokens': 90, 'output_tokens': 5, 'input_tokens_details': {'cached_tokens': 10}}, (90, 5, 10)),
+    ({'promptTokenCount': 50, 'candidatesTokenCount': 9, 'thoughtsTokenCount': 4, 'cachedContentTokenCount': 16},
+     (50, 13, 16)),
+    ({'prompt_tokens': 3, 'completion_tokens': None, 'prompt_tokens_details': None}, (3, 0, 0)),
+], ids=['anthropic', 'openai', 'openai-responses', 'google', 'nulls'])
+def test_normalize_usage(usage, expected):
+    assert normalize_usage(usage) == expected
+
+
+def tap(body: bytes, streaming: bool, chunk_size: int = 7):
+    usage_tap = UsageTap(streaming, 0.0)
+    for chunk in rechunk(body, chunk_size):
+        usage_tap.feed(chunk)
+    return usage_tap.finish()
+
+
+def test_tap_reads_anthropic_streams_with_running_totals():
+    body = (
+        b'event: message_start\n'
+        b'data: {"type": "message_start", "message": {"model": "claude-sonnet-4", '
+        b'"usage": {"input_tokens": 10, "cache_read_input_tokens": 90, "output_tokens": 1}}}\n\n'
+        b'event: content_block_delta\ndata: {"type": "content_block_delta", "delta": {"text": "hi"}}\n\n'
+        b'event: message_delta\ndata: {"type": "message_delta", "usage": {"output_tokens": 42}}\n\n'
+    )
+    assert tap(body, True)[:4] == ('claude-sonnet-4', 100, 42, 90)
+
+
+def test_tap_reads_openai_streams_with_crlf_boundaries():
+    body = (
+        b'data: {"model": "gpt-4o", "choices": [{"delta": {"content": "hi"}}]}\r\n\r\n'
+        b'data: {"model": "gpt-4o", "choices": [], "usage": {"prompt_tokens": 12, "completion_tokens": 3}}\r\n\r\n'
+        b'data: [DONE]\r\n\r\n'
+    )
+    assert tap(body, True)[:4] == ('gpt-4o', 12, 3, 0)
+
+
+def test_tap_reads_google_streams():
+    body = b''.join(
+        b'data: ' + json.dumps({'modelVersion': 'gemini-2.5-pro',
+                                'usageMetadata': {'promptTokenCount': 20, 'candidatesTokenCount': count}}).encode()
+        + b'\r\n\r\n'
+        for count in (1, 5, 9)
+    )
+    assert tap(body, True)[:4] == ('gemini-2.5-pro', 20, 9, 0)
+
+
+@pytest.mark.parametrize('body,expected', [
+    ({'model': 'claude-sonnet-4', 'content': [], 'usage': {'input_tokens': 5, 'output_tokens': 6}},
+     ('claude-sonnet-4', 5, 6, 0)),
+    ({'model': 'gpt-4o', 'choices': [], 'usage': {'prompt_tokens': 7, 'completion_tokens': 8}}, ('gpt-4o', 7, 8, 0)),
+    ({'modelVersion': 'gemini-2.5-flash', 'candidates': [],
+      'usageMetadata': {'promptTokenCount': 9, 'candidatesTokenCount': 10}}, ('gemini-2.5-flash', 9, 10, 0)),
+], ids=['anthropic', 'openai', 'google'])
+def test_tap_reads_whole_bodies(body, expected):
+    assert tap(json.dumps(body).encode(), False)[:4] == expected
+
+
+def test_tap_finds_usage_at_the_end_of_a_large_body():
+    body = json.dumps({'model': 'gpt-4o', 'choices': [{'message': {'content': 'x' * 200000}}],
+                       'usage': {'prompt_tokens': 1, 'completion_tokens': 50000}}).encode()
+    assert tap(body, False, 4096)[:4] == ('gpt-4o', 1, 50000, 0)
+
+
+def test_tap_without_usage_reports_nothing():
+    assert tap(b'data: {"choices": []}\n\n', True) is None
+    assert tap(b'{"error": {"message": "nope"}}', False) is None